@@ -21,25 +21,31 @@ Gdybyś kiedyś chciał prawdziwy cross-encoder (Jina API / self-host bge-rerank
 podmieniasz tylko krok scorujący — reszta pipeline zostaje bez zmian.
 
 Uruchom:  streamlit run internal_linking.py
+Bez UI:   python seo_cli.py linking --sources src.txt --targets cele.txt -o linki.csv
 """
 
-import json
-import re
+import os
+import uuid
 
 import numpy as np
 import pandas as pd
 import streamlit as st
-from sklearn.metrics.pairwise import cosine_similarity
 
-from seo_utils import (require_login, get_client, scrape_sources,
-                       scrape_topics, embed_texts, chat_json, norm_url)
+from seo_utils import (require_login, get_client, llm_cache_sidebar, telemetry_sidebar, usage_summary,
+                       TableSink, LiveTable, output_path, result_file_uploader, filter_table, table_download,
+                       similarity_graph_file, load_similarity_graph, graph_pair_blocks,
+                       prefilter_topk_recall)
+from jobs import submit_job
+from seo_pipelines import (LINK_COLUMNS, MAX_SRC_CHARS, parse_targets, linking_inputs, linking_candidates,
+                           rerank_links, link_relevance, sort_link_rows)
 
 st.set_page_config(page_title="Internal Linking Planner", page_icon="🔗", layout="wide")
 require_login("Internal Linking")
-client = get_client()
+client = get_client("Internal Linking")
+use_llm_cache = llm_cache_sidebar()
+telemetry_sidebar()
 
 MODELS = ["gpt-5.4-mini","gpt-4o-mini", "gpt-4o", "gpt-5-mini"]
-MAX_SRC_CHARS = 14000  # ile tekstu źródłowego wysyłamy do modelu (kontrola tokenów)
 
 st.title("🔗 Planer linkowania wewnętrznego")
 st.markdown(
@@ -95,79 +101,42 @@ c1, c2, c3 = st.columns(3)
 top_k = c1.slider("Kandydatów na źródło (cosinus zbiera)", 1, 25, 8)
 min_sim = c2.slider("Min. podobieństwo cosinus (sito wstępne)", 0.0, 0.6, 0.15, 0.05)
 model = c3.selectbox("Model (rerank + anchory)", MODELS)
+fast_cos = st.checkbox(
+    "⚡ Szybki cosinus (prefiks 256 wymiarów + dokładny rescoring)",
+    help="Wstępna lista kandydatów z cosinusa na pierwszych 256 wymiarach, potem dokładny cosinus na pełnych wektorach. "
+         "Opłaca się przy tysiącach źródeł/celów; recall@k względem trybu dokładnego pokazujemy po analizie.",
+)
 
-run = st.button("🚀 Analizuj możliwości linkowania", type="primary")
-
-
-# ---------- PROMPTY ----------
-SYSTEM_BASE = """Jesteś ekspertem SEO od linkowania wewnętrznego (internal linking) dla polskich serwisów.
-Dostajesz JEDEN tekst źródłowy oraz listę stron docelowych (każda opisana frazą/tematem).
-Dla KAŻDEJ strony docelowej zrób dwie rzeczy:
-
-A) RERANKING — oceń "relevance" 0-100: jak bardzo sensowny i merytorycznie uzasadniony jest link
-   z tego tekstu do tej strony (temat + kontekst tekstu). Oceń KAŻDĄ stronę — to służy do ułożenia
-   kolejności, niczego nie odrzucamy.
-B) ANCHORY — zaproponuj konkretne anchory wg zasad trybu poniżej.
-
-ZASADY ANCHORÓW:
-- Link uzasadniony merytorycznie; anchor pasuje do strony docelowej ORAZ do kontekstu zdania.
-- Anchor 1-5 słów, naturalny, bez exact-match spamu.
-- Maksymalnie 2 propozycje na jedną stronę docelową; brak dobrej propozycji → pusta lista (ale "relevance" i tak oceń).
-- "kontekst" = zdanie/fragment z tekstu, którego dotyczy anchor.
-- Jeśli przy stronie docelowej jest adnotacja [JUŻ PODLINKOWANE], link z tego tekstu już istnieje:
-  obniż relevance i NIE proponuj duplikatu (chyba że sensowny jest dodatkowy link w innym miejscu).
-"""
-
-MODE1 = """
-TRYB: NIE MOŻNA EDYTOWAĆ TEKSTU.
-- Wolno użyć WYŁĄCZNIE fragmentów występujących DOSŁOWNIE w tekście źródłowym.
-- "anchor" musi być dokładnym ciągiem skopiowanym 1:1 z tekstu (z zachowaniem odmiany).
-- Jeśli brak naturalnego, dosłownego dopasowania — pusta lista propozycji (relevance oceń mimo to).
-- "typ" zawsze = "istniejacy", "propozycja_zmiany" zawsze = null.
-"""
-
-MODE2 = """
-TRYB: MOŻNA EDYTOWAĆ TEKST.
-- Najpierw szukaj anchorów obecnych dosłownie (typ = "istniejacy", propozycja_zmiany = null).
-- Jeśli brak dobrego dopasowania, zaproponuj DROBNĄ zmianę (typ = "nowy"): przeredagowanie zdania
-  lub dołożenie jednego krótkiego, naturalnego zdania mieszczącego link.
-- Dla typu "nowy" w "propozycja_zmiany" podaj pełną nową/zmienioną treść zdania, anchor w **gwiazdkach**.
-- Zmiany minimalne, nie psują stylu ani sensu.
-"""
-
-SCHEMA = """
-FORMAT ODPOWIEDZI — wyłącznie poprawny JSON:
-{
-  "wyniki": [
-    {
-      "target_id": <numer w nawiasie []>,
-      "relevance": <0-100>,
-      "propozycje": [
-        {"typ":"istniejacy|nowy","anchor":"...","kontekst":"...","propozycja_zmiany":null,"trafnosc":0-100,"uzasadnienie":"..."}
-      ]
-    }
-  ]
-}
-"""
-
-
-def _norm(s):
-    return re.sub(r"\s+", " ", str(s).lower()).strip()
+with st.expander("⚙️ Współbieżność i limity API"):
+    cw, cr, ct = st.columns(3)
+    max_workers = cw.number_input("Równoległe zapytania", min_value=1, max_value=32, value=8, key="il_workers")
+    rpm = cr.number_input("Limit zapytań / min (RPM)", min_value=1, value=500, step=50, key="il_rpm")
+    tpm = ct.number_input("Limit tokenów / min (TPM)", min_value=1000, value=200_000, step=10_000, key="il_tpm")
 
+c_run, c_bg = st.columns(2)
+run = c_run.button("🚀 Analizuj możliwości linkowania", type="primary")
+if c_bg.button("⏳ W tle (kolejka zadań)", key="il_bg",
+               help="Liczy proces roboczy — można zamknąć kartę, propozycje czekają na stronie Kolejka zadań."):
+    if input_mode.startswith("Dwie"):
+        pools = ["--sources", "sources.txt", "--targets", "targets.txt"]
+        files = {"sources.txt": src_raw, "targets.txt": tgt_raw}
+    else:
+        pools, files = ["--pool", "pool.txt"], {"pool.txt": pool_raw}
+    if not all(v.strip() for v in files.values()):
+        st.warning("Podaj dane wejściowe (źródła i cele albo wspólną pulę).")
+    else:
+        job_id = submit_job(
+            "linking",
+            pools + ["--top-k", top_k, "--min-sim", min_sim, "--model", model, "--workers", max_workers,
+                     "--rpm", rpm, "--tpm", tpm, "--out-sep", ";"]
+            + (["--edit"] if edit_allowed else []) + (["--fast"] if fast_cos else [])
+            + ([] if use_llm_cache else ["--no-cache"]),
+            files=files, user=st.session_state.get("username"), title="Linkowanie wewnętrzne",
+        )
+        st.success(f"Zadanie {job_id} w kolejce — postęp i propozycje na stronie „Kolejka zadań”.")
 
-def parse_targets(raw):
-    out = []
-    for line in raw.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        if ";" in line:
-            u, f = line.split(";", 1)
-            out.append((u.strip(), f.strip()))
-        else:
-            out.append((line, ""))
-    return out
 
+# Prompty, parsowanie celów, cosinus i rerank: seo_pipelines.py (wspólne z seo_cli.py)
 
 if run:
     # --- 1. zbuduj pule wg trybu ---
@@ -182,49 +151,34 @@ if run:
         st.warning("Podaj dane wejściowe (źródła i cele albo wspólną pulę).")
         st.stop()
 
-    # --- 2. scraping źródeł (tekst + linki) i tematów celów ---
+    # --- 2. scraping + embeddingi źródeł (tekst + linki) i tematów celów — jednym potokiem ---
     pb = st.progress(0.0, text="Pobieranie treści źródłowych...")
-    src_map = scrape_sources(src_urls, progress=lambda p: pb.progress(p, text="Pobieranie treści źródłowych..."))
-
-    tgt_urls = [u for u, _ in targets]
-    missing = [u for u, f in targets if not f]
-    pb.progress(0.0, text="Pobieranie tematów stron docelowych...")
-    topic_map = scrape_topics(missing, progress=lambda p: pb.progress(p, text="Pobieranie tematów stron docelowych...")) if missing else {}
-    tgt_topic = [f if f else (topic_map.get(u, "") or u) for u, f in targets]
+    inp = linking_inputs(client, src_urls, targets, report=lambda text, frac: pb.progress(frac, text=text))
     pb.empty()
-
-    s_urls, s_texts, s_links = [], [], []
-    for u in src_urls:
-        d = src_map.get(u)
-        if d and d.get("text"):
-            s_urls.append(u)
-            s_texts.append(d["text"][:MAX_SRC_CHARS])
-            s_links.append(d.get("links") or {})
+    s_urls, tgt_urls = inp["s_urls"], inp["tgt_urls"]
+    if inp["embed_errors"]:
+        st.warning(f"Błąd API embeddingów dla {len(inp['embed_errors'])} źródeł: "
+                   f"{next(iter(inp['embed_errors'].values()))}")
     if not s_urls:
         st.error("Nie udało się pobrać treści żadnego źródła.")
         st.stop()
 
     # --- 3. COSINUS: zbierz kandydatów ---
     with st.spinner("Etap 1 — cosinus (zbieranie kandydatów)..."):
-        vecs = embed_texts(client, s_texts + tgt_topic)
-        s_vecs, t_vecs = vecs[:len(s_texts)], vecs[len(s_texts):]
-        sim = cosine_similarity(s_vecs, t_vecs)  # [n_src, n_tgt]
-
-    tgt_norm = [norm_url(u) for u in tgt_urls]
-    candidates = {}
-    for i in range(len(s_urls)):
-        src_n = norm_url(s_urls[i])
-        picks = []
-        for j in np.argsort(sim[i])[::-1]:
-            if tgt_norm[j] == src_n:           # nie linkuj do samego siebie
-                continue
-            if sim[i][j] < min_sim:
-                break
-            picks.append((int(j), float(sim[i][j])))
-            if len(picks) >= top_k:
-                break
-        if picks:
-            candidates[i] = picks
+        candidates = linking_candidates(inp, top_k, min_sim, prefilter=fast_cos)
+        if fast_cos:
+            st.caption(f"⚡ Tryb szybki (prefiks) — recall@{top_k} względem dokładnego cosinusa: "
+                       f"{prefilter_topk_recall(inp['s_vecs'], inp['t_vecs'], top_k + 1, min_sim):.3f} (próbka źródeł).")
+
+    # graf kandydatów (źródło → cel, cosinus) — do eksportu bez ponownego liczenia
+    flat = [(i, j, sc) for i, picks in candidates.items() for j, sc in picks]
+    st.session_state["il_graph"] = {
+        "row_urls": s_urls, "col_urls": tgt_urls,
+        "src": np.array([f[0] for f in flat], dtype=np.int32),
+        "dst": np.array([f[1] for f in flat], dtype=np.int32),
+        "score": np.array([f[2] for f in flat], dtype=np.float32),
+    }
+    st.session_state.pop("il_graph_export", None)
 
     n_calls = len(candidates)
     if n_calls == 0:
@@ -233,88 +187,55 @@ if run:
     st.caption(f"Cosinus: {sum(len(v) for v in candidates.values())} par-kandydatów "
                f"→ rerank + anchory: {n_calls} zapytań do modelu ({model}).")
 
-    # --- 4. RERANK + ANCHOR (jeden strzał na źródło) ---
-    system = SYSTEM_BASE + (MODE2 if edit_allowed else MODE1) + SCHEMA
-    rows = []
+    # --- 4. RERANK + ANCHOR (jeden strzał na źródło, źródła równolegle) ---
     pb2 = st.progress(0.0, text="Rerank + propozycje anchorów...")
-
-    for n, (i, picks) in enumerate(candidates.items()):
-        links_i = s_links[i]
-        existing = {j: (tgt_norm[j] in links_i) for j, _ in picks}
-
-        block = "\n".join(
-            f"[{k}] URL: {tgt_urls[j]} | TEMAT: {tgt_topic[j]}"
-            + (" [JUŻ PODLINKOWANE]" if existing[j] else "")
-            for k, (j, _) in enumerate(picks)
-        )
-        user = (f'TEKST ŹRÓDŁOWY (URL: {s_urls[i]}):\n"""\n{s_texts[i]}\n"""\n\n'
-                f"STRONY DOCELOWE (używaj target_id = numer w []):\n{block}")
-
-        rerank_map = {}
-        try:
-            data = json.loads(chat_json(client, model, system, user))
-            for w in data.get("wyniki", []):
-                try:
-                    k = int(w.get("target_id"))
-                    j, score = picks[k]
-                except (TypeError, ValueError, IndexError):
-                    continue
-                relevance = w.get("relevance", "")
-                rerank_map[j] = relevance
-                text_norm = _norm(s_texts[i])
-
-                valid = []
-                for prop in (w.get("propozycje") or [])[:2]:
-                    typ = prop.get("typ", "istniejacy")
-                    anchor = (prop.get("anchor") or "").strip()
-                    if not anchor:
-                        continue
-                    if not edit_allowed and (typ != "istniejacy" or _norm(anchor) not in text_norm):
-                        continue
-                    valid.append((typ, anchor, prop))
-
-                base = {
-                    "zrodlo": s_urls[i], "cel": tgt_urls[j], "fraza_docelowa": tgt_topic[j],
-                    "relevance": relevance, "similarity": round(score, 3),
-                    "juz_podlinkowane": "TAK" if existing[j] else "",
-                    "istniejacy_anchor": links_i.get(tgt_norm[j], "") if existing[j] else "",
-                }
-                if valid:
-                    for typ, anchor, prop in valid:
-                        rows.append({**base, "typ": typ, "anchor": anchor,
-                                     "trafnosc": prop.get("trafnosc", ""),
-                                     "kontekst": (prop.get("kontekst") or "")[:300],
-                                     "propozycja_zmiany": prop.get("propozycja_zmiany") or ""})
-                else:
-                    rows.append({**base, "typ": "", "anchor": "", "trafnosc": "",
-                                 "kontekst": "", "propozycja_zmiany": ""})
-        except Exception as e:
-            for j, score in picks:
-                rows.append({"zrodlo": s_urls[i], "cel": tgt_urls[j], "fraza_docelowa": tgt_topic[j],
-                             "relevance": "", "similarity": round(score, 3),
-                             "juz_podlinkowane": "TAK" if existing[j] else "",
-                             "istniejacy_anchor": "", "typ": "BŁĄD", "anchor": "",
-                             "trafnosc": "", "kontekst": str(e)[:120], "propozycja_zmiany": ""})
-        pb2.progress((n + 1) / n_calls)
+    done = [0]
+    # propozycje lecą do pliku źródło po źródle, w kolejności ukończenia — podgląd w trakcie,
+    # a błąd na końcu albo „Zatrzymaj” nie zabiera tego, co już policzone (partial_download)
+    live_path = output_path(f"linking_{uuid.uuid4().hex[:12]}.csv")
+    live = LiveTable("il_live", "linkowanie_wewnetrzne.csv", path=live_path, sep=";")
+
+    with TableSink(live_path, LINK_COLUMNS, sep=";") as sink:
+        def on_result(i, out):
+            done[0] += 1
+            sink.write(sorted(out, key=link_relevance, reverse=True))
+            pb2.progress(done[0] / n_calls, text=f"Rerank + propozycje anchorów... {done[0]}/{n_calls} źródeł")
+            live.update(f"{done[0]}/{n_calls} źródeł, {sink.rows} propozycji")
+
+        rows, calls, call_rows = rerank_links(client, model, inp, candidates, edit_allowed, use_cache=use_llm_cache,
+                                              max_workers=max_workers, rpm=rpm, tpm=tpm, on_result=on_result)
 
     pb2.empty()
+    live.clear()
     if not rows:
         st.info("Brak wyników.")
         st.stop()
 
-    df = pd.DataFrame(rows)
-    df["_rel"] = pd.to_numeric(df["relevance"], errors="coerce").fillna(-1)
-    df = df.sort_values(["zrodlo", "_rel"], ascending=[True, False]).drop(columns="_rel").reset_index(drop=True)
-
-    st.session_state["il_df"] = df
+    st.session_state["il_df"] = sort_link_rows(rows)
+    st.session_state["il_usage"] = (usage_summary(model, calls), pd.DataFrame(call_rows))
     # snapshot istniejących linków (z treści głównej) do podglądu
     ex_rows = []
     for u in s_urls:
-        for href, anchor in (src_map.get(u, {}) or {}).get("links", {}).items():
+        for href, anchor in (inp["src_map"].get(u, {}) or {}).get("links", {}).items():
             ex_rows.append({"zrodlo": u, "link": href, "anchor": anchor})
     st.session_state["il_existing"] = pd.DataFrame(ex_rows)
 
 
+LiveTable.partial_download("il_live")
+
+with st.expander("📂 Wczytaj zapisane propozycje (.csv / .parquet)"):
+    st.caption("Wynik wcześniejszej analizy (z aplikacji, CLI albo kolejki zadań) — do filtrowania bez ponownych zapytań.")
+    loaded = result_file_uploader("il_load")
+    if loaded is not None:
+        missing = [c for c in LINK_COLUMNS if c not in loaded.columns]
+        if missing:
+            st.error(f"Brak kolumn: {', '.join(missing)}.")
+        else:
+            st.session_state["il_df"] = sort_link_rows(loaded.astype(object).fillna("").to_dict("records"))
+            st.session_state.pop("il_usage", None)
+            st.session_state.pop("il_existing", None)
+
+
 # ---------- RENDER ----------
 if "il_df" in st.session_state:
     df = st.session_state["il_df"]
@@ -327,11 +248,17 @@ if "il_df" in st.session_state:
             st.warning("⚠️ Możliwa nadoptymalizacja — anchory powtarzają się ≥4×: "
                        + ", ".join(f"„{a}” ({c})" for a, c in spam.items()))
 
-    cols = ["zrodlo", "cel", "fraza_docelowa", "relevance", "similarity",
-            "juz_podlinkowane", "istniejacy_anchor", "typ", "anchor",
-            "trafnosc", "kontekst", "propozycja_zmiany"]
+    cols = LINK_COLUMNS
+    f1, f2 = st.columns(2)
+    min_rel = f1.slider("Min. rerank (relevance)", 0, 100, 0, 5, key="il_min_rel")
+    hide_linked = f2.checkbox("Ukryj już podlinkowane", key="il_hide_linked")
+    view = df[pd.to_numeric(df["relevance"], errors="coerce").fillna(-1) >= min_rel] if min_rel else df
+    if hide_linked:
+        view = view[view["juz_podlinkowane"] != "TAK"]
+    view = filter_table(view, "il")
+    st.caption(f"{len(view)} z {len(df)} pozycji")
     st.dataframe(
-        df[cols], use_container_width=True,
+        view[cols], use_container_width=True,
         column_config={
             "zrodlo": st.column_config.LinkColumn("Źródło"),
             "cel": st.column_config.LinkColumn("Cel"),
@@ -340,14 +267,69 @@ if "il_df" in st.session_state:
             "juz_podlinkowane": st.column_config.TextColumn("Już linkowane?"),
         },
     )
-    st.download_button(
-        "📥 Pobierz propozycje (CSV)",
-        df[cols].to_csv(sep=";", index=False).encode("utf-8"),
-        "linkowanie_wewnetrzne.csv", "text/csv",
-    )
+    table_download(view[cols], "linkowanie_wewnetrzne.csv", key="il_dl")
+
+    if st.session_state.get("il_usage"):
+        summary, calls_df = st.session_state["il_usage"]
+        with st.expander("📊 Zużycie tokenów i cache promptów (rerank)"):
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Zapytania API", f"{summary['api_calls']} / {summary['calls']}",
+                      help="Pozostałe wzięte z lokalnego cache odpowiedzi.")
+            m2.metric("Trafienia cache promptu", f"{summary['prefix_hit_ratio']:.0%}",
+                      help="cached_tokens / prompt_tokens — jaka część wejścia poszła z cache prefiksu providera.")
+            m3.metric("Koszt", "—" if summary["cost_usd"] is None else f"${summary['cost_usd']:.4f}",
+                      help="Brak ceny w tabeli MODEL_PRICES → koszt nieznany.")
+            m4.metric("Latencja p50 / p95", f"{summary['latency_p50']:.1f} / {summary['latency_p95']:.1f} s")
+            st.caption(f"Tokeny: {summary['prompt_tokens']:,} wejścia (w tym {summary['cached_tokens']:,} z cache), "
+                       f"{summary['completion_tokens']:,} wyjścia"
+                       + ("" if summary["prefix_savings_usd"] is None
+                          else f", cache promptu zaoszczędził ${summary['prefix_savings_usd']:.4f}")
+                       + f". MAX_SRC_CHARS = {MAX_SRC_CHARS}, kandydatów na źródło = {top_k}.")
+            st.dataframe(calls_df, use_container_width=True)
 
     ex = st.session_state.get("il_existing")
     if ex is not None and len(ex):
         with st.expander(f"🔗 Istniejące linki w tekstach źródłowych ({len(ex)})"):
             st.dataframe(ex, use_container_width=True,
                          column_config={"link": st.column_config.TextColumn("Link (znorm.)")})
+
+
+# ---------- GRAF KANDYDATÓW (eksport / wczytanie bez przeliczania) ----------
+with st.expander("💾 Graf kandydatów cosinus (.npz / .parquet)"):
+    g = st.session_state.get("il_graph")
+    if g is not None and len(g["src"]):
+        fmt = st.radio("Format:", ["npz", "parquet"], horizontal=True, key="il_graph_fmt",
+                       format_func=lambda f: {"npz": "CSR .npz (numpy)", "parquet": "Parquet (pyarrow)"}[f])
+        if st.button("Przygotuj plik", key="il_graph_btn"):
+            try:
+                st.session_state["il_graph_export"] = (fmt, similarity_graph_file(
+                    "il_graph", g["row_urls"], graph_pair_blocks(g), col_urls=g["col_urls"], fmt=fmt))
+            except ImportError:
+                st.error("Eksport do Parquet wymaga pakietu `pyarrow`.")
+        export = st.session_state.get("il_graph_export")
+        if export and os.path.exists(export[1]):
+            fmt_ready, path = export
+            with open(path, "rb") as f:
+                st.download_button(f"📥 Pobierz graf kandydatów (.{fmt_ready})", f,
+                                   f"graf_kandydatow.{fmt_ready}", "application/octet-stream",
+                                   on_click="ignore")
+
+    up = st.file_uploader("Wczytaj zapisany graf kandydatów:", type=["npz", "parquet"], key="il_graph_up")
+    if up is not None:
+        try:
+            lg = load_similarity_graph(up)
+            st.dataframe(
+                pd.DataFrame({
+                    "zrodlo": [lg["row_urls"][i] for i in lg["src"].tolist()],
+                    "cel": [lg["col_urls"][j] for j in lg["dst"].tolist()],
+                    "similarity": np.round(lg["score"], 3),
+                }),
+                use_container_width=True,
+                column_config={
+                    "zrodlo": st.column_config.LinkColumn("Źródło"),
+                    "cel": st.column_config.LinkColumn("Cel"),
+                    "similarity": st.column_config.NumberColumn("Cosinus", format="%.3f"),
+                },
+            )
+        except Exception as e:
+            st.error(f"Nie udało się wczytać grafu: {e}")
@@ -0,0 +1,327 @@
+"""
+jobs.py — kolejka zadań w tle (SQLite w .seo_data/) + procesy robocze.
+
+Strona nie liczy niczego sama: zapisuje pliki wejściowe i argumenty seo_cli.py
+(submit_job), a worker w osobnym procesie odpala to samo narzędzie co w CLI.
+Postęp, log, ETA i ścieżka wyniku siedzą w bazie — strona tylko je odpytuje,
+więc rerun, zamknięta karta czy drugi użytkownik nie przerywają obliczeń,
+a gotowy plik da się pobrać po ponownym połączeniu.
+
+Uruchom workery z katalogu aplikacji (np. w systemd/tmux obok `streamlit run`):
+    python jobs.py worker -n 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from seo_utils import DATA_DIR, TELEMETRY, reset_local_state, set_local_user
+
+QUEUE_DB = os.path.join(DATA_DIR, "queue.sqlite")
+QUEUE_DIR = os.path.join(DATA_DIR, "queue")     # katalog na zadanie: pliki wejściowe + wynik
+STALE_AFTER = 120        # s bez heartbeatu → worker uznany za martwy, zadanie wraca do kolejki
+HEARTBEAT_EVERY = 15
+KEEP_DAYS = 14           # po tylu dniach zakończone zadania i ich pliki są sprzątane
+MAX_REQUEUES = 3         # tyle razy zadanie może wrócić po martwym workerze, potem → failed
+
+STATUS_LABELS = {
+    "queued": "⏳ w kolejce", "running": "⚙️ w toku", "done": "✅ gotowe",
+    "partial": "🟡 gotowe z brakami", "failed": "❌ błąd", "cancelled": "⛔ anulowane",
+}
+ACTIVE = ("queued", "running")
+ONE_SHOT_FLAGS = ("--fresh",)    # tylko pierwsze uruchomienie; po requeue wznawiamy z checkpointu
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _conn():
+    """Nowe połączenie na wywołanie — baza jest współdzielona między procesami."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(QUEUE_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id TEXT PRIMARY KEY, tool TEXT NOT NULL, user TEXT, title TEXT, args TEXT NOT NULL, "
+        "output TEXT NOT NULL, status TEXT NOT NULL, cancel INTEGER DEFAULT 0, "
+        "progress REAL DEFAULT 0, message TEXT DEFAULT '', log TEXT DEFAULT '', "
+        "created REAL NOT NULL, started REAL, finished REAL, heartbeat REAL, worker TEXT, "
+        "requeues INTEGER DEFAULT 0)"
+    )
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(jobs)")}
+    if "requeues" not in cols:     # baza sprzed licznika ponowień
+        conn.execute("ALTER TABLE jobs ADD COLUMN requeues INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created)")
+    return conn
+
+
+def job_dir(job_id):
+    return os.path.join(QUEUE_DIR, job_id)
+
+
+# =========================================================
+# STRONY  (zgłaszanie i odpytywanie)
+# =========================================================
+def submit_job(tool, args, files=None, user=None, title="", output="wynik.csv"):
+    """
+    Zgłasza zadanie seo_cli.py: tool = podkomenda, args = reszta argumentów.
+    files = {nazwa: bytes|str} zapisywane w katalogu zadania; argument równy nazwie
+    pliku jest podmieniany na pełną ścieżkę. Wynik trafia do <katalog>/<output>.
+    Zwraca id zadania.
+    """
+    job_id = uuid.uuid4().hex[:12]
+    d = job_dir(job_id)
+    os.makedirs(d, exist_ok=True)
+    files = files or {}
+    for name, data in files.items():
+        with open(os.path.join(d, name), "wb") as f:
+            f.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+    argv = [tool] + [os.path.join(d, a) if a in files else str(a) for a in args]
+    out = os.path.join(d, output)
+    conn = _conn()
+    with conn:
+        conn.execute("INSERT INTO jobs (id, tool, user, title, args, output, status, created) "
+                     "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                     (job_id, tool, user, title, json.dumps(argv, ensure_ascii=False), out, time.time()))
+    conn.close()
+    return job_id
+
+
+def eta_seconds(job):
+    """Szacunek z dotychczasowego tempa (None, dopóki jest za mało danych)."""
+    if job["status"] != "running" or not job["started"] or job["progress"] < 0.02:
+        return None
+    elapsed = time.time() - job["started"]
+    return elapsed * (1 - job["progress"]) / job["progress"]
+
+
+def list_jobs(user=None, limit=50):
+    conn = _conn()
+    if user is None:
+        rows = conn.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+    else:
+        rows = conn.execute("SELECT * FROM jobs WHERE user = ? ORDER BY created DESC LIMIT ?",
+                            (user, limit)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def get_job(job_id):
+    conn = _conn()
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def cancel_job(job_id):
+    """W kolejce → anulowane od razu; w toku → worker przerwie przy najbliższym raporcie postępu."""
+    conn = _conn()
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'",
+                     (time.time(), job_id))
+        conn.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND status = 'running'", (job_id,))
+    conn.close()
+
+
+def job_result_path(job):
+    """(ścieżka, częściowy?) — gotowy plik albo zapisywany na bieżąco .part; None, gdy nic jeszcze nie ma."""
+    if os.path.exists(job["output"]):
+        return job["output"], False
+    if os.path.exists(job["output"] + ".part"):
+        return job["output"] + ".part", True
+    return None, False
+
+
+# =========================================================
+# WORKER
+# =========================================================
+class JobProgress:
+    """report(tekst, ułamek) + log(msg) jak StderrProgress w seo_cli, tylko do bazy.
+    Przy każdym zapisie sprawdza flagę anulowania (JobCancelled)."""
+
+    def __init__(self, job_id, every=1.0):
+        self.job_id, self.every, self._last = job_id, every, 0.0
+
+    def __call__(self, text, frac):
+        now = time.monotonic()
+        if frac < 1.0 and now - self._last < self.every:
+            return
+        self._last = now
+        conn = _conn()
+        with conn:
+            conn.execute("UPDATE jobs SET progress = ?, message = ?, heartbeat = ? WHERE id = ?",
+                         (min(max(frac, 0.0), 1.0), text, time.time(), self.job_id))
+            cancel = conn.execute("SELECT cancel FROM jobs WHERE id = ?", (self.job_id,)).fetchone()[0]
+        conn.close()
+        if cancel:
+            raise JobCancelled()
+
+    def log(self, msg):
+        conn = _conn()
+        with conn:
+            conn.execute("UPDATE jobs SET log = log || ? WHERE id = ?", (msg + "\n", self.job_id))
+        conn.close()
+
+
+def _claim(worker):
+    """Atomowo bierze najstarsze zadanie z kolejki (BEGIN IMMEDIATE = jeden worker naraz)."""
+    conn = _conn()
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        # zadania martwych workerów wracają do kolejki — checkpointy oszczędzą powtórkę;
+        # zadanie, które za każdym razem zabija workera, po MAX_REQUEUES powrotach kończy jako failed
+        dead = conn.execute("SELECT id, cancel, requeues FROM jobs WHERE status = 'running' AND heartbeat < ?",
+                            (now - STALE_AFTER,)).fetchall()
+        for job in dead:
+            if job["cancel"]:
+                conn.execute("UPDATE jobs SET status = 'cancelled', finished = ?, worker = NULL WHERE id = ?",
+                             (now, job["id"]))
+            elif job["requeues"] >= MAX_REQUEUES:
+                conn.execute("UPDATE jobs SET status = 'failed', finished = ?, worker = NULL, "
+                             "log = log || ? WHERE id = ?",
+                             (now, f"BŁĄD: worker padł {job['requeues'] + 1} razy w trakcie zadania.\n", job["id"]))
+            else:
+                conn.execute("UPDATE jobs SET status = 'queued', worker = NULL, requeues = requeues + 1 "
+                             "WHERE id = ?", (job["id"],))
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET status = 'running', started = ?, heartbeat = ?, worker = ?, "
+                         "progress = 0, message = '' WHERE id = ?", (now, now, worker, row["id"]))
+        conn.execute("COMMIT")
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def _finish(job_id, status):
+    conn = _conn()
+    with conn:
+        conn.execute("UPDATE jobs SET status = ?, finished = ?, progress = CASE WHEN ? IN ('done', 'partial') "
+                     "THEN 1.0 ELSE progress END WHERE id = ?", (status, time.time(), status, job_id))
+    conn.close()
+
+
+def _heartbeat(job_id, stop):
+    # długie pojedyncze zapytanie do API nie może wyglądać jak martwy worker
+    while not stop.wait(HEARTBEAT_EVERY):
+        conn = _conn()
+        with conn:
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+        conn.close()
+
+
+def _consume_one_shot(job):
+    """argv zadania; flagi jednorazowe (--fresh) są od razu usuwane z bazy, żeby zadanie
+    wrócone do kolejki po padnięciu workera nie skasowało znów własnego checkpointu."""
+    argv = json.loads(job["args"])
+    kept = [a for a in argv if a not in ONE_SHOT_FLAGS]
+    if len(kept) != len(argv):
+        conn = _conn()
+        with conn:
+            conn.execute("UPDATE jobs SET args = ? WHERE id = ?", (json.dumps(kept, ensure_ascii=False), job["id"]))
+        conn.close()
+    return argv
+
+
+def run_job(job):
+    import seo_cli   # leniwie: pandas/pyarrow ładuje dopiero proces roboczy
+
+    argv = _consume_one_shot(job)
+    progress = JobProgress(job["id"])
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job["id"], stop), daemon=True).start()
+    reset_local_state()  # cache z poprzednich zadań nie przeżywają w workerze
+    set_local_user(job["user"])
+    TELEMETRY.clear()    # podsumowanie zużycia tylko dla tego zadania
+    try:
+        code = seo_cli.main(argv + ["-o", job["output"]], progress=progress)
+        status = {seo_cli.EXIT_OK: "done", seo_cli.EXIT_PARTIAL: "partial"}.get(code, "failed")
+    except JobCancelled:
+        status = "cancelled"
+    except Exception as e:
+        progress.log(f"BŁĄD: {type(e).__name__}: {e}")
+        status = "failed"
+    finally:
+        stop.set()
+    usage = seo_cli.usage_line()
+    if usage:
+        progress.log(usage)
+    _finish(job["id"], status)
+    return status
+
+
+def cleanup(days=KEEP_DAYS):
+    """Usuwa zakończone zadania starsze niż `days` dni razem z katalogami."""
+    conn = _conn()
+    old = [r["id"] for r in conn.execute(
+        "SELECT id FROM jobs WHERE status NOT IN ('queued', 'running') AND finished < ?",
+        (time.time() - days * 86400,))]
+    with conn:
+        conn.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in old])
+    conn.close()
+    for i in old:
+        shutil.rmtree(job_dir(i), ignore_errors=True)
+    return len(old)
+
+
+def worker_loop(poll=2.0):
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        job = _claim(name)
+        if job is None:
+            time.sleep(poll)
+            continue
+        run_job(job)
+
+
+def run_workers(n=2, poll=2.0):
+    """n procesów roboczych; każdy bierze po jednym zadaniu naraz."""
+    cleanup()
+    procs = [multiprocessing.Process(target=worker_loop, args=(poll,), daemon=True) for _ in range(n)]
+    for p in procs:
+        p.start()
+    try:
+        while True:
+            for k, p in enumerate(procs):
+                if not p.is_alive():     # padnięty proces zastępujemy nowym
+                    procs[k] = multiprocessing.Process(target=worker_loop, args=(poll,), daemon=True)
+                    procs[k].start()
+            time.sleep(5)
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="jobs.py", description="Kolejka zadań SEO w tle.")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    w = sub.add_parser("worker", help="uruchom procesy robocze")
+    w.add_argument("-n", "--procs", type=int, default=2, help="liczba procesów")
+    w.add_argument("--poll", type=float, default=2.0, help="co ile sekund sprawdzać kolejkę")
+    sub.add_parser("list", help="ostatnie zadania")
+    c = sub.add_parser("cleanup", help="usuń stare zakończone zadania")
+    c.add_argument("--days", type=int, default=KEEP_DAYS)
+    args = p.parse_args(argv)
+    if args.cmd == "worker":
+        run_workers(args.procs, args.poll)
+    elif args.cmd == "list":
+        for j in list_jobs():
+            print(f"{j['id']}  {STATUS_LABELS.get(j['status'], j['status']):<22} {j['progress']:>4.0%}  "
+                  f"{j['tool']:<10} {j['user'] or '':<12} {j['title'] or ''}")
+    else:
+        print(f"Usunięto {cleanup(args.days)} zadań.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from openai import OpenAI
 import io
 import logging
@@ -13,6 +13,9 @@ import matplotlib.pyplot as plt
 import plotly.express as px
 from sklearn.metrics.pairwise import cosine_similarity
 
+from seo_utils import (RateLimiter, run_indexed_batches, pipeline_map, pipeline_progress, scrape_and_embed,
+                       meta_text, llm_cache_sidebar, metered_client, telemetry_sidebar, table_download)
+
 # --- KONFIGURACJA LOGOWANIA ---
 logging.basicConfig(
     level=logging.INFO,
@@ -90,11 +93,13 @@ if not st.session_state['logged_in']:
 st.sidebar.title(f"👤 {st.session_state['username']}")
 if st.sidebar.button("Wyloguj"):
     logout()
+use_llm_cache = llm_cache_sidebar()
+telemetry_sidebar()
 
 # 2. INICJALIZACJA KLIENTA OPENAI
 try:
     api_key = st.secrets["OPENAI_API_KEY"]
-    client = OpenAI(api_key=api_key)
+    client = metered_client(OpenAI(api_key=api_key), "Embeddingi")
 except Exception:
     client = None
 
@@ -184,7 +189,8 @@ def get_seo_metadata(url):
         response = requests.get(url, headers=headers, timeout=10)
         response.raise_for_status()
         
-        soup = BeautifulSoup(response.content, 'html.parser')
+        # parsujemy tylko <title> i <meta> — reszta dokumentu nie jest tu potrzebna
+        soup = BeautifulSoup(response.content, 'html.parser', parse_only=SoupStrainer(['title', 'meta']))
         
         title_tag = soup.find('title')
         title = title_tag.get_text().strip() if title_tag else ""
@@ -199,27 +205,9 @@ def get_seo_metadata(url):
     except Exception:
         return None, None
 
-def generate_keyword_ai(url, title, description, user_instructions, client):
-    """
-    Główna funkcja z Twoim nowym PROMPTEM.
-    """
-    # Zabezpieczenie danych
-    if pd.isna(title): title = ""
-    if pd.isna(description): description = ""
-    if pd.isna(url): url = ""
-
-    if not title and not description:
-        return "Brak danych"
-
-    # --- TWÓJ NOWY PROMPT ---
-    prompt = f"""
+KEYWORD_RULES = """
     Jesteś Ekspertem SEO i Specjalistą ds. Semantyki. Twoim zadaniem jest przeanalizowanie danych wejściowych i wyekstrahowanie JEDNEJ, najbardziej trafnej głównej frazy kluczowej (Main Keyword).
 
-    ### DANE WEJŚCIOWE:
-    URL: {url}
-    Title: {title}
-    Description: {description}
-
     ### DODATKOWE INSTRUKCJE OD UŻYTKOWNIKA:
     "{user_instructions}"
 
@@ -242,24 +230,56 @@ def generate_keyword_ai(url, title, description, user_instructions, client):
     Input: URL: /kontakt, Title: Skontaktuj się z nami - Firma X, Desc: Adres i telefon...
     Output: Firma X kontakt
 
-    ### FORMAT WYJŚCIOWY:
-    - Zwróć WYŁĄCZNIE samą frazę kluczową.
+    ### FORMAT WYJŚCIOWY (dla każdej strony):
+    - WYŁĄCZNIE sama fraza kluczowa.
     - Nie używaj cudzysłowów, punktorów ani znaków interpunkcyjnych na końcu.
     - Nie pisz "Oto fraza" ani żadnych wyjaśnień.
     """
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a helpful SEO assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0
-        )
-        return response.choices[0].message.content.strip()
-    except Exception:
-        return "Błąd API"
+
+def _keyword_record(url, title, description):
+    """(url, title, desc) → jedna linia danych wejściowych albo None, gdy nie ma z czego wyznaczyć frazy."""
+    title = "" if pd.isna(title) else str(title)
+    description = "" if pd.isna(description) else str(description)
+    url = "" if pd.isna(url) else str(url)
+    if not title and not description:
+        return None
+    return " ".join(f"URL: {url} | Title: {title} | Description: {description}".split())
+
+def generate_keywords_batch(records, user_instructions, client, use_cache=True, batch_size=40, max_workers=8,
+                            progress=None, limiter=None):
+    """
+    Wiele stron na jedno zapytanie: instrukcje i few-shot idą raz na batch (w system),
+    a strony jako ponumerowane wiersze → JSON {numer: fraza}. Batche lecą równolegle,
+    braki wracają w mniejszych batchach (run_indexed_batches). Cache per strona (row_cache) —
+    zakładka 1 składa paczki w kolejności pobrań, więc te same strony co run trafiają do innych batchy.
+    records: lista (url, title, description). Zwraca listę fraz w tej samej kolejności —
+    "Brak danych" dla pustych wierszy, "Błąd API" dla tych, które nie przeszły.
+    progress(ile_gotowych, ile_wszystkich) po każdym batchu.
+    limiter → wspólny RateLimiter, gdy funkcja jest wołana równolegle dla wielu paczek.
+    """
+    lines = [_keyword_record(*r) for r in records]
+    rows = [i for i, line in enumerate(lines) if line is not None]
+    done = [0]
+
+    def on_rows(got):
+        done[0] += len(got)
+        if progress:
+            progress(done[0], len(rows))
+
+    results, _ = run_indexed_batches(
+        client.with_options(max_retries=0), "gpt-4o-mini",
+        KEYWORD_RULES.format(user_instructions=user_instructions),
+        lambda block: "### DANE WEJŚCIOWE (jedna strona na wiersz):\n" + block,
+        lines, rows, batch_size, limiter=limiter, max_workers=max_workers, temperature=0.0,
+        use_cache=use_cache, on_rows=on_rows, row_cache=True,
+    )
+    return [results.get(i, "Błąd API") if line is not None else "Brak danych"
+            for i, line in enumerate(lines)]
+
+def ta_status(r):
+    if r < 0.25: return "🟢 CORE (Rdzeń)"
+    if r < 0.55: return "🟡 SUPPORT (Wsparcie)"
+    return "🔴 OFF-TOPIC (Do weryfikacji)"
 
 # --- INTERFEJS UŻYTKOWNIKA ---
 
@@ -306,43 +326,52 @@ with tab1:
         if not url_list:
             st.warning("Podaj listę URLi.")
         else:
+            progress_bar = st.progress(0.0, text="Start...")
+
+            # Etap 1: metadane równolegle; etap 2: frazy batchami, gdy tylko uzbiera się paczka —
+            # sieć i LLM pracują jednocześnie
+            def to_process(url, meta):
+                return meta if meta[0] is not None else None
+
+            limiter = RateLimiter()   # jeden na wszystkie paczki — 4 równoległe process() dzielą limit
+
+            def process(batch):
+                # Używamy instrukcji z Tab 1
+                kws = generate_keywords_batch([(u, t, d) for u, (t, d) in batch], user_prefs_t1, client,
+                                              use_cache=use_llm_cache, max_workers=1, limiter=limiter)
+                return {u: kw for (u, _), kw in zip(batch, kws)}
+
+            metas, keywords, _ = pipeline_map(
+                url_list, get_seo_metadata, process, to_process=to_process,
+                batch_full=lambda buf: len(buf) >= 40, fetch_workers=16, process_workers=4,
+                progress=pipeline_progress(progress_bar, "Metadane", "Frazy"),
+            )
+
             results_t1 = []
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            total = len(url_list)
-            
-            for i, url in enumerate(url_list):
-                status_text.text(f"Pobieranie ({i+1}/{total}): {url}")
-                
-                title, desc = get_seo_metadata(url)
-                
-                if title is not None:
-                    # Używamy instrukcji z Tab 1
-                    keyword = generate_keyword_ai(url, title, desc, user_prefs_t1, client)
-                else:
-                    title, desc, keyword = "Błąd", "Błąd", "Błąd"
-                
+            for url in url_list:
+                title, desc = metas.get(url) or (None, None)
+                if title is None:
+                    title, desc = "Błąd", "Błąd"
                 results_t1.append({
-                    "fraza": keyword,
+                    "fraza": keywords.get(url, "Błąd"),
                     "meta title": title,
                     "meta description": desc,
                     "url": url
                 })
-                progress_bar.progress((i + 1) / total)
-            
+
             progress_bar.empty()
-            status_text.success("✅ Gotowe!")
+            failed = sum(r["fraza"] == "Błąd API" for r in results_t1)
+            if failed:
+                st.warning(f"⚠️ Nie udało się wyznaczyć fraz dla {failed} URL-i (błąd API).")
+            st.success("✅ Gotowe!")
             
             df_t1 = pd.DataFrame(results_t1)
-            df_t1 = df_t1[["fraza", "meta title", "meta description", "url"]]
-            
-            st.dataframe(df_t1, use_container_width=True)
-            st.download_button(
-                "📥 Pobierz CSV (Wynik)",
-                df_t1.to_csv(sep=';', index=False).encode('utf-8'),
-                "wynik_scraping.csv",
-                "text/csv"
-            )
+            # wynik w sesji — tabela i pobieranie poniżej przeżywają rerun („Przygotuj CSV/Parquet”)
+            st.session_state["emb_t1_out"] = df_t1[["fraza", "meta title", "meta description", "url"]]
+
+    if "emb_t1_out" in st.session_state:
+        st.dataframe(st.session_state["emb_t1_out"], use_container_width=True)
+        table_download(st.session_state["emb_t1_out"], "wynik_scraping.csv", key="emb_t1_dl")
 
 # ==========================================
 # ZAKŁADKA 2: Z PLIKU CSV
@@ -409,41 +438,27 @@ with tab2:
                     st.error("Brak klucza API!")
                     st.stop()
                 
-                results_t2 = []
                 prog_bar_t2 = st.progress(0)
-                total_rows = len(df_in)
-                
-                for i, row in df_in.iterrows():
-                    u_val = str(row[sel_url])
-                    t_val = str(row[sel_tit])
-                    d_val = str(row[sel_des])
-                    
-                    # Używamy instrukcji z Tab 2
-                    kw = generate_keyword_ai(u_val, t_val, d_val, user_prefs_t2, client)
-                    
-                    results_t2.append({
-                        "fraza": kw,
-                        "meta title": t_val,
-                        "meta description": d_val,
-                        "url": u_val
-                    })
-                    
-                    if i % 5 == 0 or i == total_rows - 1:
-                        prog_bar_t2.progress((i + 1) / total_rows)
-                
+                records = [(str(row[sel_url]), str(row[sel_tit]), str(row[sel_des])) for _, row in df_in.iterrows()]
+
+                # Używamy instrukcji z Tab 2; wiele wierszy na zapytanie, batche równolegle
+                keywords = generate_keywords_batch(
+                    records, user_prefs_t2, client, use_cache=use_llm_cache,
+                    progress=lambda n, total: prog_bar_t2.progress(n / max(total, 1),
+                                                                   text=f"Frazy: {n}/{total}"),
+                )
+                results_t2 = [{"fraza": kw, "meta title": t_val, "meta description": d_val, "url": u_val}
+                              for kw, (u_val, t_val, d_val) in zip(keywords, records)]
+
                 prog_bar_t2.empty()
                 st.success("✅ Zakończono!")
                 
                 df_t2 = pd.DataFrame(results_t2)
-                df_t2 = df_t2[["fraza", "meta title", "meta description", "url"]]
-                
-                st.dataframe(df_t2, use_container_width=True)
-                st.download_button(
-                    "📥 Pobierz CSV (Wynik)",
-                    df_t2.to_csv(sep=';', index=False).encode('utf-8'),
-                    "wynik_z_csv.csv",
-                    "text/csv"
-                )
+                st.session_state["emb_t2_out"] = df_t2[["fraza", "meta title", "meta description", "url"]]
+
+            if "emb_t2_out" in st.session_state:
+                st.dataframe(st.session_state["emb_t2_out"], use_container_width=True)
+                table_download(st.session_state["emb_t2_out"], "wynik_z_csv.csv", key="emb_t2_dl")
 
         except Exception as e:
             st.error(f"Błąd odczytu pliku: {e}")
@@ -561,15 +576,13 @@ with tab3:
                         my_bar.empty()
                         st.success("🎉 Analiza zakończona!")
 
-                        st.write("### Wyniki (posortowane wg dopasowania ostatniej kolumny):")
-                        st.dataframe(df_sem.head(10))
+                        st.session_state["emb_sem_out"] = (df_sem, uploaded_sem.name)
 
-                        st.download_button(
-                            label="📥 Pobierz Raport Finalny (CSV)",
-                            data=df_sem.to_csv(sep=';', index=False).encode('utf-8'),
-                            file_name=f"RAPORT_FINALNY_{uploaded_sem.name}",
-                            mime='text/csv',
-                        )
+                sem_out = st.session_state.get("emb_sem_out")
+                if sem_out:
+                    st.write("### Wyniki (posortowane wg dopasowania ostatniej kolumny):")
+                    st.dataframe(sem_out[0].head(10))
+                    table_download(sem_out[0], f"RAPORT_FINALNY_{sem_out[1]}", key="emb_sem_dl")
 
             except Exception as e:
                 st.error(f"Wystąpił błąd podczas przetwarzania pliku: {e}")
@@ -621,50 +634,39 @@ with tab4:
         if len(url_list) < 3:
             st.warning("Podaj przynajmniej 3 adresy URL, aby wyznaczyć sensowny środek tematyczny.")
         else:
-            # Kontenery na dane
-            scraped_data = []
-            embeddings = []
-            
-            # Pasek postępu
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            # --- 1. SCRAPING I EMBEDDINGI ---
-            for i, url in enumerate(url_list):
-                status_text.text(f"Analiza ({i+1}/{len(url_list)}): {url}")
-                
-                try:
-                    # Szybki request po metadane
-                    headers = {'User-Agent': 'Mozilla/5.0'}
-                    r = requests.get(url, headers=headers, timeout=5)
-                    if r.status_code == 200:
-                        soup = BeautifulSoup(r.content, 'html.parser')
-                        
-                        title = soup.title.string.strip() if soup.title and soup.title.string else ""
-                        h1 = soup.find('h1').get_text().strip() if soup.find('h1') else ""
-                        meta = soup.find('meta', attrs={'name': 'description'}) or soup.find('meta', attrs={'name': 'Description'})
-                        desc = meta['content'].strip() if meta else ""
-                        
-                        # Tekst do analizy AI (Title + H1 + Desc)
-                        combined_text = f"{title} {h1} {desc}".strip()
-                        
-                        if len(combined_text) > 10:
-                            # Używamy tej samej funkcji get_embedding co w innych zakładkach
-                            emb = get_embedding(combined_text, client)
-                            embeddings.append(emb)
-                            scraped_data.append({
-                                "url": url,
-                                "title": title,
-                                "h1": h1,
-                                "combined_text": combined_text
-                            })
-                except Exception as e:
-                    pass # Ignorujemy błędy pojedynczych stron
-                
-                progress_bar.progress((i + 1) / len(url_list))
-            
+            progress_bar = st.progress(0.0, text="Start...")
+
+            # --- 1. SCRAPING I EMBEDDINGI (równoległy scraping + batche embeddingów z cache) ---
+            payloads, vecs, emb_errors = scrape_and_embed(
+                client, url_list, kind="meta", progress=pipeline_progress(progress_bar, "Pobieranie", "Embeddingi")
+            )
             progress_bar.empty()
-            status_text.empty()
+
+            scraped_data, embeddings, failures = [], [], {}
+            for url in dict.fromkeys(url_list):
+                payload = payloads.get(url) or {"error": "błąd scrapera"}
+                if url in vecs:
+                    embeddings.append(vecs[url])
+                    scraped_data.append({
+                        "url": url,
+                        "title": payload["title"],
+                        "h1": payload["h1"],
+                        "combined_text": meta_text(payload)
+                    })
+                elif payload.get("error"):
+                    failures[url] = payload["error"]
+                elif url in emb_errors:
+                    failures[url] = f"embedding: {emb_errors[url][:80]}"
+                else:
+                    failures[url] = "za mało tekstu (Title + H1 + Description)"
+
+            if failures:
+                st.warning(f"⚠️ Pominięto {len(failures)} z {len(failures) + len(scraped_data)} URL-i.")
+                with st.expander("Szczegóły pominiętych URL-i"):
+                    df_fail = pd.DataFrame({"url": list(failures), "powód": list(failures.values())})
+                    st.dataframe(df_fail["powód"].value_counts().rename("liczba"), use_container_width=True)
+                    st.dataframe(df_fail, use_container_width=True,
+                                 column_config={"url": st.column_config.LinkColumn()})
             
             # --- 2. OBLICZENIA MATEMATYCZNE ---
             if len(embeddings) > 2:
@@ -683,74 +685,65 @@ with tab4:
                 df_res = pd.DataFrame(scraped_data)
                 df_res['SiteRadius'] = radii
                 
-                # Metryki globalne
-                avg_radius = df_res['SiteRadius'].mean()
-                domain_focus = 1 / (1 + avg_radius)
-                
-                # --- 3. PREZENTACJA WYNIKÓW ---
-                
-                st.success("✅ Analiza zakończona!")
-                
-                # Kafelki z wynikami
-                m1, m2, m3 = st.columns(3)
-                m1.metric("Liczba stron", len(df_res))
-                m2.metric("Domain Focus", f"{domain_focus:.4f}", delta_color="normal", help="Im bliżej 1.0 tym lepiej")
-                m3.metric("Średni Radius", f"{avg_radius:.4f}", help="Niższy wynik = lepsze skupienie")
-                
-                st.divider()
-                
-                # Wykres (Scatter Plot)
-                st.subheader("Mapa Spójności (Wizualizacja)")
-                
                 # Dodajemy losowy jitter do osi Y, żeby punkty się nie nakładały
                 df_res['Y_Random'] = np.random.normal(0, 0.05, len(df_res))
                 df_res['Label'] = df_res['title'].apply(lambda x: x[:60] + "..." if len(x) > 60 else x)
-                
-                fig = px.scatter(
-                    df_res,
-                    x="SiteRadius",
-                    y="Y_Random",
-                    hover_data=["url", "title"],
-                    text="Label",
-                    color="SiteRadius",
-                    color_continuous_scale="RdYlGn_r", # Zielony blisko (0), Czerwony daleko (1)
-                    title="Rozkład treści względem głównego tematu",
-                    labels={"SiteRadius": "Odległość od Centrum (0=Idealnie)"},
-                    height=600
-                )
-                fig.update_yaxes(visible=False, showticklabels=False)
-                fig.update_traces(textposition='top center')
-                fig.add_vline(x=avg_radius, line_dash="dash", annotation_text="Średnia")
-                
-                st.plotly_chart(fig, use_container_width=True)
-                
-                # Tabela danych
-                st.subheader("Szczegółowe Wyniki")
-                
-                def get_status(r):
-                    if r < 0.25: return "🟢 CORE (Rdzeń)"
-                    if r < 0.55: return "🟡 SUPPORT (Wsparcie)"
-                    return "🔴 OFF-TOPIC (Do weryfikacji)"
-                
-                df_res['Status'] = df_res['SiteRadius'].apply(get_status)
-                df_res = df_res.sort_values(by="SiteRadius")
-                
-                st.dataframe(
-                    df_res[['Status', 'SiteRadius', 'url', 'title']],
-                    use_container_width=True,
-                    column_config={
-                        "SiteRadius": st.column_config.NumberColumn(format="%.4f"),
-                        "url": st.column_config.LinkColumn()
-                    }
-                )
-                
-                # Pobieranie
-                st.download_button(
-                    label="📥 Pobierz Raport Topical Authority (CSV)",
-                    data=df_res.to_csv(sep=';', index=False).encode('utf-8'),
-                    file_name="raport_topical_authority.csv",
-                    mime="text/csv"
-                )
-                
+                df_res['Status'] = df_res['SiteRadius'].apply(ta_status)
+                # wynik w sesji — prezentacja poniżej przeżywa rerun („Przygotuj CSV/Parquet”)
+                st.session_state["emb_ta_out"] = df_res.sort_values(by="SiteRadius")
+
             else:
                 st.error("Nie udało się pobrać wystarczającej ilości danych (min. 3 poprawne strony).")
+
+    # --- 3. PREZENTACJA WYNIKÓW (poza blokiem przycisku) ---
+    if "emb_ta_out" in st.session_state:
+        df_res = st.session_state["emb_ta_out"]
+
+        # Metryki globalne
+        avg_radius = df_res['SiteRadius'].mean()
+        domain_focus = 1 / (1 + avg_radius)
+
+        st.success("✅ Analiza zakończona!")
+
+        # Kafelki z wynikami
+        m1, m2, m3 = st.columns(3)
+        m1.metric("Liczba stron", len(df_res))
+        m2.metric("Domain Focus", f"{domain_focus:.4f}", delta_color="normal", help="Im bliżej 1.0 tym lepiej")
+        m3.metric("Średni Radius", f"{avg_radius:.4f}", help="Niższy wynik = lepsze skupienie")
+
+        st.divider()
+
+        # Wykres (Scatter Plot)
+        st.subheader("Mapa Spójności (Wizualizacja)")
+
+        fig = px.scatter(
+            df_res,
+            x="SiteRadius",
+            y="Y_Random",
+            hover_data=["url", "title"],
+            text="Label",
+            color="SiteRadius",
+            color_continuous_scale="RdYlGn_r", # Zielony blisko (0), Czerwony daleko (1)
+            title="Rozkład treści względem głównego tematu",
+            labels={"SiteRadius": "Odległość od Centrum (0=Idealnie)"},
+            height=600
+        )
+        fig.update_yaxes(visible=False, showticklabels=False)
+        fig.update_traces(textposition='top center')
+        fig.add_vline(x=avg_radius, line_dash="dash", annotation_text="Średnia")
+
+        st.plotly_chart(fig, use_container_width=True)
+
+        # Tabela danych
+        st.subheader("Szczegółowe Wyniki")
+        st.dataframe(
+            df_res[['Status', 'SiteRadius', 'url', 'title']],
+            use_container_width=True,
+            column_config={
+                "SiteRadius": st.column_config.NumberColumn(format="%.4f"),
+                "url": st.column_config.LinkColumn()
+            }
+        )
+
+        # Pobieranie
+        table_download(df_res, "raport_topical_authority.csv", key="emb_ta_dl")
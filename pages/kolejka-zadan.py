@@ -0,0 +1,105 @@
+"""
+Kolejka zadań — podgląd zadań uruchomionych „w tle” z narzędzi.
+
+Zadania liczą procesy robocze (python jobs.py worker -n N), nie ta strona:
+można ją zamknąć, przeładować albo wrócić jutro — status, log, ETA
+i wyniki (także częściowe) czekają w .seo_data/queue/.
+"""
+
+import os
+from datetime import datetime
+
+import pandas as pd
+import streamlit as st
+
+from seo_utils import require_login
+from jobs import ACTIVE, STATUS_LABELS, cancel_job, eta_seconds, job_result_path, list_jobs
+
+st.set_page_config(page_title="Kolejka zadań", page_icon="⏳", layout="wide")
+require_login("Kolejka zadań")
+
+st.title("⏳ Kolejka zadań")
+st.caption("Zadania zlecone przyciskiem „W tle” w narzędziach. Strona odświeża się sama, "
+           "a obliczenia trwają niezależnie od tego, czy jest otwarta.")
+
+PREVIEW_ROWS = 200
+
+
+def _fmt_eta(sec):
+    if sec is None:
+        return ""
+    m, s = divmod(int(sec), 60)
+    h, m = divmod(m, 60)
+    return f" · ETA {h}h {m:02d}m" if h else f" · ETA {m}m {s:02d}s"
+
+
+def _fmt_ts(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M") if ts else "—"
+
+
+def _preview(path):
+    """Pierwsze wiersze wyniku — z pliku .part też, bo CSV dopisywany jest po każdym batchu."""
+    try:
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path).head(PREVIEW_ROWS)
+        sep = ";" if open(path, encoding="utf-8-sig").readline().count(";") else ","
+        return pd.read_csv(path, sep=sep, nrows=PREVIEW_ROWS, encoding="utf-8-sig")
+    except Exception:
+        return None
+
+
+def render_job(job):
+    label = STATUS_LABELS.get(job["status"], job["status"])
+    with st.container(border=True):
+        c1, c2 = st.columns([4, 1])
+        c1.markdown(f"**{job['title'] or job['tool']}** · `{job['tool']}` · {label}")
+        c1.caption(f"Zlecone {_fmt_ts(job['created'])} · start {_fmt_ts(job['started'])} · "
+                   f"koniec {_fmt_ts(job['finished'])} · id {job['id']}")
+        if job["status"] in ACTIVE and not job["cancel"]:
+            if c2.button("Anuluj", key=f"cancel_{job['id']}"):
+                cancel_job(job["id"])
+                st.rerun()
+        if job["status"] == "running":
+            st.progress(job["progress"], text=(job["message"] or "Start...") + _fmt_eta(eta_seconds(job)))
+
+        path, partial = job_result_path(job)
+        if path:
+            # plik czytamy dopiero na żądanie — lista odświeża się co kilka sekund
+            key = f"dl_{job['id']}"
+            if st.button("Przygotuj to, co już gotowe" if partial else "Przygotuj wynik", key=f"prep_{job['id']}"):
+                with open(path, "rb") as f:
+                    st.session_state[key] = (partial, f.read())
+            if key in st.session_state:
+                was_partial, payload = st.session_state[key]
+                name = os.path.basename(job["output"])
+                st.download_button(
+                    "📥 Pobierz częściowy wynik" if was_partial else "📥 Pobierz wynik",
+                    payload, ("czesciowy_" if was_partial else "") + name, key=f"btn_{key}",
+                )
+            with st.expander("Podgląd wyniku" + (" (częściowy)" if partial else "")):
+                df = _preview(path)
+                if df is None:
+                    st.caption("Podgląd niedostępny (plik w trakcie zapisu).")
+                else:
+                    st.dataframe(df, use_container_width=True)
+        if job["log"]:
+            with st.expander("Log"):
+                st.code(job["log"], language=None)
+
+
+show_all = st.toggle("Pokaż zadania wszystkich użytkowników", value=False)
+
+
+@st.fragment(run_every=3)
+def job_list():
+    jobs = list_jobs(None if show_all else st.session_state.get("username"))
+    if not jobs:
+        st.info("Brak zadań. Uruchom narzędzie przyciskiem „W tle”, a postęp pojawi się tutaj.")
+        return
+    n_active = sum(j["status"] in ACTIVE for j in jobs)
+    st.caption(f"Aktywne: {n_active} · wszystkich na liście: {len(jobs)}")
+    for job in jobs:
+        render_job(job)
+
+
+job_list()
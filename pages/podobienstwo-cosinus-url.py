@@ -1,16 +1,17 @@
 import streamlit as st
-import requests
 import json
 import bcrypt
 import logging
 import pandas as pd
-import numpy as np
-from bs4 import BeautifulSoup
 from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
-import time
 import os
 
+from seo_utils import (iter_similar_pairs, cannibalization_groups, similarity_graph_file,
+                       load_similarity_graph, graph_pair_blocks, prefilter_recall,
+                       metered_client, telemetry_sidebar, table_download)
+from seo_pipelines import cosine_vectors
+from jobs import submit_job
+
 # --- KONFIGURACJA LOGOWANIA (Z Twojego działającego skryptu) ---
 logging.basicConfig(
     level=logging.INFO,
@@ -64,7 +65,7 @@ def logout():
     st.session_state['logged_in'] = False
     st.session_state['username'] = None
     # Czyścimy dane Matrixa przy wylogowaniu
-    keys_to_remove = ['analysis_done', 'matrix', 'valid_urls_data']
+    keys_to_remove = ['analysis_done', 'vectors', 'graph', 'valid_urls_data']
     for key in keys_to_remove:
         if key in st.session_state:
             del st.session_state[key]
@@ -88,6 +89,7 @@ st.sidebar.title(f"👤 {st.session_state['username']}")
 if st.sidebar.button("Wyloguj"):
     logout()
 
+telemetry_sidebar()
 st.sidebar.markdown("---")
 st.sidebar.header("⚙️ Konfiguracja Matrixa")
 
@@ -111,59 +113,43 @@ if not api_key:
     st.stop()
 # Suwak
 threshold = st.sidebar.slider("Próg podobieństwa", 0.0, 1.0, 0.5, 0.05)
+fast_mode = st.sidebar.checkbox(
+    "⚡ Tryb szybki (prefiks 256 wymiarów + dokładny rescoring)",
+    help="Kandydaci szukani cosinusem na pierwszych 256 wymiarach wektorów, każda znaleziona para liczona "
+         "dokładnie. Wyniki bez zmian, możliwe tylko nieliczne pominięte pary — recall "
+         "sprawdzisz w sekcji wyników. Opłaca się przy tysiącach URL-i."
+)
 
 
 # ==========================================
 # FUNKCJE MATRIXA (BACKEND)
 # ==========================================
 
-@st.cache_data(show_spinner=False)
-def extract_clean_text(url):
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code != 200: return None
-        soup = BeautifulSoup(response.content, 'html.parser')
-        for element in soup(["script", "style", "nav", "footer", "header", "form"]):
-            element.decompose()
-        text = ' '.join(soup.get_text(separator=' ').split())
-        return text[:20000] if len(text) > 100 else None
-    except Exception as e:
-        logger.error(f"Błąd url {url}: {e}")
-        return None
-
-def get_embedding(text, client):
-    text = text.replace("\n", " ")
-    return client.embeddings.create(input=[text], model="text-embedding-3-large").data[0].embedding
-
 def perform_analysis(url_list_raw, api_key_val):
-    client = OpenAI(api_key=api_key_val)
-    urls = [line.strip() for line in url_list_raw.split('\n') if line.strip()]
+    client = metered_client(OpenAI(api_key=api_key_val), "Cosinus URL")
+    urls = list(dict.fromkeys(line.strip() for line in url_list_raw.split('\n') if line.strip()))
     
     if not urls: return None
 
-    progress_bar = st.progress(0)
-    data_list = []
-    embeddings = []
-    
-    for i, url in enumerate(urls):
-        text = extract_clean_text(url)
-        if text:
-            try:
-                emb = get_embedding(text, client)
-                embeddings.append(emb)
-                data_list.append({'url': url, 'short_name': url.split('/')[-1][:25]})
-            except Exception as e:
-                st.warning(f"Błąd API: {e}")
-        progress_bar.progress((i + 1) / len(urls))
-        time.sleep(0.05)
-
-    if len(embeddings) < 2:
+    # Scraping + embeddingi jednym potokiem, strony i wektory z trwałego cache (seo_pipelines)
+    progress_bar = st.progress(0.0, text="Start...")
+    kept, vectors, no_text, errors = cosine_vectors(
+        client, urls, report=lambda text, frac: progress_bar.progress(frac, text=text))
+    progress_bar.empty()
+
+    if no_text:
+        st.warning(f"Pominięto {len(no_text)} URL-i bez treści (błąd pobrania lub < 100 znaków).")
+        logger.info("Bez treści: %s", no_text)
+    if errors:
+        st.warning(f"Błąd API embeddingów dla {len(errors)} URL-i: {next(iter(errors.values()))}")
+
+    if len(kept) < 2:
         st.error("Za mało danych.")
         return None
 
-    matrix = cosine_similarity(embeddings)
-    return {"matrix": matrix, "data": data_list}
+    data_list = [{'url': u, 'short_name': u.split('/')[-1][:25]} for u in kept]
+    # Trzymamy same wektory — macierz podobieństw liczymy blokami przy renderze
+    return {"vectors": vectors, "data": data_list}
 
 # ==========================================
 # APLIKACJA WŁAŚCIWA (MATRIX)
@@ -178,7 +164,19 @@ url_input = st.text_area(
     placeholder="https://site.pl/a\nhttps://site.pl/b"
 )
 
-if st.button("🚀 Uruchom Analizę", type="primary"):
+col_run, col_bg = st.columns(2)
+run_now = col_run.button("🚀 Uruchom Analizę", type="primary")
+if col_bg.button("⏳ Pary w tle (kolejka zadań)", key="cos_bg",
+                 help="Proces roboczy liczy pary powyżej progu do pliku — wynik na stronie Kolejka zadań."):
+    if not url_input.strip():
+        st.warning("Pusta lista URLi.")
+    else:
+        job_id = submit_job("cosine", ["urls.txt", "--threshold", threshold] + (["--fast"] if fast_mode else []),
+                            files={"urls.txt": url_input}, user=st.session_state['username'],
+                            title=f"Pary cosinus > {threshold}")
+        st.success(f"Zadanie {job_id} w kolejce — postęp i wynik na stronie „Kolejka zadań”.")
+
+if run_now:
     if not url_input.strip():
         st.warning("Pusta lista URLi.")
     elif not api_key:
@@ -188,49 +186,150 @@ if st.button("🚀 Uruchom Analizę", type="primary"):
             result = perform_analysis(url_input, api_key)
             if result:
                 st.session_state['analysis_done'] = True
-                st.session_state['matrix'] = result['matrix']
+                st.session_state['vectors'] = result['vectors']
+                st.session_state['graph'] = None
                 st.session_state['valid_urls_data'] = result['data']
+                st.session_state.pop('graph_export', None)
+                st.session_state.pop('fast_recall', None)
+
+# --- WCZYTANIE ZAPISANEGO GRAFU (bez ponownego liczenia) ---
+graph_file = st.file_uploader(
+    "…albo wczytaj zapisany graf podobieństw (.npz / .parquet):",
+    type=["npz", "parquet"],
+    key="graph_uploader"
+)
+if graph_file is not None and st.session_state.get('loaded_graph_id') != (graph_file.name, graph_file.size):
+    try:
+        graph = load_similarity_graph(graph_file)
+        if not graph['square']:
+            raise ValueError("to graf dwudzielny (źródła → cele), np. z planera linkowania.")
+        st.session_state['analysis_done'] = True
+        st.session_state['vectors'] = None
+        st.session_state['graph'] = graph
+        st.session_state['valid_urls_data'] = [{'url': u} for u in graph['row_urls']]
+        st.session_state['loaded_graph_id'] = (graph_file.name, graph_file.size)
+        st.session_state.pop('graph_export', None)
+    except Exception as e:
+        st.error(f"Nie udało się wczytać grafu: {e}")
 
 # --- WYNIKI ---
 if st.session_state.get('analysis_done'):
-    matrix = st.session_state['matrix']
+    vectors = st.session_state.get('vectors')
+    graph = st.session_state.get('graph')
     data = st.session_state['valid_urls_data']
     urls = [d['url'] for d in data]
 
+    def pair_blocks(th):
+        # z wektorów liczymy blokami, z wczytanego grafu tylko filtrujemy progiem
+        if vectors is not None:
+            return iter_similar_pairs(vectors, th, prefilter=fast_mode)
+        return graph_pair_blocks(graph, th)
+
     st.divider()
-    
-    # 1. Obliczanie par (logika przeniesiona wyżej, bez rysowania mapy)
-    pairs = []
-    for i in range(len(matrix)):
-        for j in range(i+1, len(matrix)):
-            if matrix[i][j] >= threshold:
-                pairs.append({
-                    "URL A": urls[i],
-                    "URL B": urls[j],
-                    "Score": round(matrix[i][j], 4)
-                })
-    
-    # 2. Wyświetlanie tabeli i przycisku
-    if pairs:
-        st.subheader(f"Znaleziono {len(pairs)} par z podobieństwem > {threshold}")
-        
-        df = pd.DataFrame(pairs).sort_values("Score", ascending=False)
-        
-        # Wyświetlamy tabelę
-        st.dataframe(
-            df.style.background_gradient(cmap="Greens", subset=["Score"]),
-            use_container_width=True
-        )
-
-        # Generujemy CSV
-        csv = df.to_csv(index=False).encode('utf-8')
-
-        # Przycisk pobierania
-        st.download_button(
-            label="📥 Pobierz wynik jako CSV",
-            data=csv,
-            file_name='wyniki_seo_matrix.csv',
-            mime='text/csv',
-        )
+    if graph is not None:
+        st.caption(f"Wyniki z wczytanego grafu ({len(graph['src'])} par). Próg niższy niż przy zapisie "
+                   "nie doda nowych par — do tego potrzebna jest ponowna analiza.")
+
+    view = st.radio(
+        "Widok wyników:",
+        ["Pary URL-i", "Grupy kanibalizacji"],
+        horizontal=True,
+        help="Grupy = spójne składowe grafu podobieństwa powyżej progu. "
+             "Przy tysiącach wariantów produktów to zamiast milionów par daje kilkaset grup."
+    )
+
+    if view == "Pary URL-i":
+        # 1. Pary liczone blokami (bez gęstej macierzy n×n)
+        pairs = []
+        for ii, jj, ss in pair_blocks(threshold):
+            pairs.extend(
+                {"URL A": urls[i], "URL B": urls[j], "Score": round(float(s), 4)}
+                for i, j, s in zip(ii.tolist(), jj.tolist(), ss.tolist())
+            )
+
+        # 2. Wyświetlanie tabeli i przycisku
+        if pairs:
+            st.subheader(f"Znaleziono {len(pairs)} par z podobieństwem > {threshold}")
+
+            df = pd.DataFrame(pairs).sort_values("Score", ascending=False)
+
+            # Wyświetlamy tabelę
+            st.dataframe(
+                df.style.background_gradient(cmap="Greens", subset=["Score"]),
+                use_container_width=True
+            )
+
+            # Pobieranie: CSV albo Parquet (URL-e jako słownik), plik zapisany raz na wynik
+            table_download(df, 'wyniki_seo_matrix.csv', key='cos_pairs_dl', sep=',')
+        else:
+            st.info(f"Brak par o podobieństwie powyżej {threshold}. Spróbuj zmniejszyć próg suwakiem.")
+
     else:
-        st.info(f"Brak par o podobieństwie powyżej {threshold}. Spróbuj zmniejszyć próg suwakiem.")
+        # Union-find na strumieniu par — krawędzie nie są nigdzie zapisywane
+        groups = cannibalization_groups(len(urls), pair_blocks(threshold))
+
+        if groups:
+            st.subheader(f"Znaleziono {len(groups)} grup kanibalizacji (próg {threshold})")
+            df_groups = pd.DataFrame([{
+                "Reprezentant": urls[g["representative"]],
+                "Rozmiar": g["size"],
+                "Gęstość": round(g["density"], 4),
+                "Śr. podobieństwo": round(g["mean_sim"], 4),
+                "URL-e": " | ".join(urls[m] for m in g["members"]),
+            } for g in groups])
+
+            st.dataframe(
+                df_groups,
+                use_container_width=True,
+                column_config={
+                    "Reprezentant": st.column_config.LinkColumn(),
+                    "Gęstość": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0, format="%.2f"),
+                },
+            )
+            st.caption("Reprezentant = strona najmocniej powiązana z resztą grupy (kandydat na stronę kanoniczną). "
+                       "Gęstość 1.0 = każda para w grupie przekracza próg.")
+
+            table_download(df_groups, 'grupy_kanibalizacji.csv', key='cos_groups_dl', sep=',')
+        else:
+            st.info(f"Brak grup o podobieństwie powyżej {threshold}. Spróbuj zmniejszyć próg suwakiem.")
+
+    # --- EKSPORT GRAFU (kompaktowo, do ponownego wczytania albo narzędzi zewnętrznych) ---
+    with st.expander("💾 Eksport grafu podobieństw (.npz / .parquet)"):
+        st.markdown("Zapisuje pary powyżej progu jako słownik URL-i + indeksy `int32` + wyniki `float16` — "
+                    "wielokrotnie mniej niż CSV, a plik można później wczytać powyżej bez ponownej analizy.")
+        fmt = st.radio("Format:", ["npz", "parquet"], horizontal=True,
+                       format_func=lambda f: {"npz": "CSR .npz (numpy)", "parquet": "Parquet (pyarrow)"}[f])
+        if st.button("Przygotuj plik", key="graph_export_btn"):
+            try:
+                st.session_state['graph_export'] = (fmt, threshold, similarity_graph_file(
+                    'cos_graph', urls, pair_blocks(threshold), fmt=fmt))
+            except ImportError:
+                st.error("Eksport do Parquet wymaga pakietu `pyarrow`.")
+        export = st.session_state.get('graph_export')
+        if export and os.path.exists(export[2]):
+            fmt_ready, th_ready, path = export
+            with open(path, "rb") as f:
+                st.download_button(
+                    label=f"📥 Pobierz graf (.{fmt_ready}, próg {th_ready})",
+                    data=f,
+                    file_name=f'graf_podobienstw.{fmt_ready}',
+                    mime='application/octet-stream',
+                    on_click="ignore",
+                )
+
+    if vectors is not None:
+        with st.expander("⚡ Recall trybu szybkiego (prefiks) względem dokładnego"):
+            st.markdown("Porównuje pary znalezione w trybie szybkim z dokładnymi dla progów 0.5–0.9 "
+                        "(na próbce max 2000 URL-i). Wyniki par są zawsze dokładne — recall < 1 oznacza "
+                        "tylko, że część par tuż przy progu mogła zostać pominięta.")
+            if st.button("Zmierz recall", key="recall_btn"):
+                with st.spinner("Liczenie..."):
+                    st.session_state['fast_recall'] = pd.DataFrame(prefilter_recall(vectors))
+            if 'fast_recall' in st.session_state:
+                st.dataframe(
+                    st.session_state['fast_recall'].rename(columns={
+                        "threshold": "Próg", "exact_pairs": "Pary (dokładnie)",
+                        "found": "Znalezione (tryb szybki)", "recall": "Recall"}),
+                    use_container_width=True,
+                    column_config={"Recall": st.column_config.NumberColumn(format="%.4f")},
+                )
@@ -0,0 +1,323 @@
+"""
+seo_cli.py — narzędzia SEO bez przeglądarki (cron, workery, nocne zadania).
+
+Te same rdzenie co w aplikacji (seo_pipelines.py → seo_utils.py): scraping, embeddingi,
+cache LLM/stron/wektorów w .seo_data, limiter RPM/TPM, checkpointy i telemetria.
+Wyniki lecą strumieniowo do pliku (.csv albo .parquet — wg rozszerzenia), postęp na stderr,
+na koniec podsumowanie zużycia API.
+
+Przykłady:
+    python seo_cli.py macerator frazy.csv -o wyniki.csv --system sys.txt --user user.txt
+    python seo_cli.py meta strony.csv -o meta.parquet --sep ";"
+    python seo_cli.py site-focus urls.txt -o radius.csv --project klient-x
+    python seo_cli.py linking --sources blog.txt --targets oferta.txt -o linki.csv
+    python seo_cli.py cosine urls.txt -o pary.parquet --threshold 0.8
+
+Klucz API: zmienna OPENAI_API_KEY. Kod wyjścia: 0 = OK, 1 = błąd, 3 = część wierszy bez wyniku
+(zapisany postęp pozwala dociągnąć je ponownym uruchomieniem).
+"""
+
+import argparse
+import sys
+import time
+
+import pandas as pd
+
+from seo_utils import (TELEMETRY, TableSink, OrderedRows, get_client, job_fingerprint, load_checkpoint,
+                       clear_checkpoint, usage_summary, iter_similar_pairs, PREFIX_DIMS)
+from seo_pipelines import (macerate_csv, generate_meta_descriptions, meta_prompts, META_SYSTEM_PROMPT,
+                           META_USER_PROMPT, site_focus_audit, parse_targets, linking_inputs,
+                           linking_candidates, rerank_links, link_relevance, LINK_COLUMNS, cosine_vectors)
+
+EXIT_OK, EXIT_ERROR, EXIT_PARTIAL = 0, 1, 3
+
+
+# =========================================================
+# POSTĘP I PODSUMOWANIE  (stderr — stdout zostaje czysty)
+# =========================================================
+class StderrProgress:
+    """report(tekst, ułamek) → stderr. Na terminalu jedna nadpisywana linia,
+    w logu crona pełne linie nie częściej niż co `every` sekund."""
+
+    def __init__(self, tool, every=10.0):
+        self.tool, self.tty = tool, sys.stderr.isatty()
+        self.every = 0.2 if self.tty else every
+        self._last = 0.0
+
+    def __call__(self, text, frac):
+        now = time.monotonic()
+        if frac < 1.0 and now - self._last < self.every:
+            return
+        self._last = now
+        line = f"[{self.tool}] {text} ({frac:.0%})"
+        sys.stderr.write(f"\r{line:<100}" if self.tty else line + "\n")
+        sys.stderr.flush()
+
+    def log(self, msg):
+        if self.tty:
+            sys.stderr.write("\n")
+        sys.stderr.write(f"[{self.tool}] {msg}\n")
+        sys.stderr.flush()
+
+
+def usage_line():
+    """Podsumowanie telemetrii procesu w jednej linii ("" = brak wywołań API)."""
+    rows = TELEMETRY.snapshot()
+    if not rows:
+        return ""
+    known = [r["cost_usd"] for r in rows if r["cost_usd"] is not None]
+    return (f"API: {sum(r['calls'] for r in rows)} wywołań, {sum(r['errors'] for r in rows)} błędów, "
+            f"{sum(r['prompt_tokens'] for r in rows):,} tokenów wejścia "
+            f"({sum(r['cached_tokens'] for r in rows):,} z cache), "
+            f"{sum(r['completion_tokens'] for r in rows):,} wyjścia, koszt ${sum(known):.4f}")
+
+
+def read_lines(path):
+    """Niepuste linie pliku ("-" = stdin)."""
+    fh = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def read_text(path):
+    with open(path, encoding="utf-8") as fh:
+        return fh.read()
+
+
+def _guess_col(cols, needle, given):
+    if given:
+        return given
+    return next((c for c in cols if needle in c.lower()), cols[0])
+
+
+# =========================================================
+# NARZĘDZIA
+# =========================================================
+def cmd_macerator(args, progress):
+    system_prompt, user_prompt = read_text(args.system), read_text(args.user)
+    client = get_client("Macerator")
+
+    with open(args.input, "rb") as fh:
+        # ten sam klucz zadania co w aplikacji → CLI wznawia zadania z UI i odwrotnie
+        job_key = job_fingerprint("macerator", fh, system_prompt, user_prompt, args.model)
+        if args.fresh:
+            clear_checkpoint(job_key)
+        # plik czytany po --chunksize wierszy, wynik dopisywany na bieżąco — pamięć nie rośnie z rozmiarem
+        stats = macerate_csv(
+            fh, args.output, system_prompt, user_prompt, args.model, client, args.batch_size,
+            chunksize=args.chunksize, max_workers=args.workers, rpm=args.rpm, tpm=args.tpm,
+            checkpoint=job_key, use_cache=not args.no_cache, out_sep=args.out_sep, report=progress,
+        )
+    if stats["resumed"]:
+        progress.log(f"Wznowiono zadanie: {stats['resumed']} z {stats['rows']} wierszy z zapisanego postępu.")
+    if stats["errors"]:
+        progress.log(f"{stats['errors']} wierszy bez poprawnej odpowiedzi — uruchom ponownie, by dociągnąć tylko je.")
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+
+def cmd_meta(args, progress):
+    with open(args.input, "rb") as fh:
+        raw = fh.read()
+    df = pd.read_csv(args.input, sep=args.sep, on_bad_lines="warn", engine="python")
+    cols = df.columns.tolist()
+    url_col = _guess_col(cols, "url", args.url_col)
+    title_col = _guess_col(cols, "title", args.title_col)
+    h1_col = _guess_col(cols, "h1", args.h1_col)
+    system_prompt = read_text(args.system) if args.system else META_SYSTEM_PROMPT
+    user_prompt = read_text(args.user) if args.user else META_USER_PROMPT
+    client = get_client("Meta Description")
+
+    job_key = job_fingerprint("meta", raw, args.sep, url_col, title_col, h1_col,
+                              system_prompt, user_prompt, args.model)
+    if args.fresh:
+        clear_checkpoint(job_key)
+    done = load_checkpoint(job_key)
+    total = len(df)
+    if done:
+        progress.log(f"Wznawiam zadanie: {len(done)} z {total} opisów z zapisanego postępu.")
+
+    prompts = meta_prompts(zip(df[url_col], df[title_col], df[h1_col]), user_prompt)
+    records = df.to_dict("records")
+    with TableSink(args.output, cols + ["Generated_Meta_Description", "Length"], sep=args.out_sep,
+                   text_columns=cols) as sink:
+        out = OrderedRows(sink)
+
+        def emit(got):
+            for r, text in got.items():
+                out.put(r, {**records[r], "Generated_Meta_Description": text, "Length": len(text)})
+
+        emit(done)
+        _, errors = generate_meta_descriptions(
+            prompts, system_prompt, args.model, client, [i for i in range(total) if i not in done],
+            batch_size=args.batch_size, max_workers=args.workers, rpm=args.rpm, tpm=args.tpm,
+            repair_rounds=args.repairs, checkpoint=job_key, use_cache=not args.no_cache,
+            progress=lambda n: progress(f"Gotowe (w normie długości) {len(done) + n} z {total}",
+                                        (len(done) + n) / max(total, 1)),
+            on_final=emit,
+        )
+        emit(errors)
+    if errors:
+        progress.log(f"{len(errors)} wierszy bez odpowiedzi — uruchom ponownie, by dociągnąć tylko je.")
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+
+def cmd_site_focus(args, progress):
+    urls = list(dict.fromkeys(read_lines(args.input)))
+    if len(urls) < 3:
+        raise ValueError("Podaj przynajmniej 3 adresy URL, aby wyznaczyć sensowny środek tematyczny.")
+    client = get_client("Site Focus")
+    r = site_focus_audit(client, urls, project=args.project, full_refresh=args.full, report=progress)
+    errors = r["embed_errors"]
+    if errors:
+        progress.log(f"Błąd API embeddingów dla {len(errors)} URL-i: {next(iter(errors.values()))}")
+    with TableSink(args.output, ["Status", "SiteRadius", "url"], sep=args.out_sep) as sink:
+        sink.write({"Status": s, "SiteRadius": float(x), "url": u}
+                   for s, x, u in zip(r["df"]["Status"], r["df"]["SiteRadius"], r["df"]["url"]))
+    progress.log(f"{r['n_ok']}/{r['n_in']} stron, Domain Focus {r['focus']:.4f}, średni radius {r['avg']:.4f}"
+                 + (f", snapshot {r['snapshot']} (nowe: {r['n_new']}, z poprzedniego: {r['n_reused']})"
+                    if r["snapshot"] else ""))
+    if r["diff"] is not None and len(r["diff"]["df"]):
+        progress.log(f"{len(r['diff']['df'])} stron zmieniło status od snapshotu {r['diff']['ts']}.")
+    return EXIT_PARTIAL if errors else EXIT_OK
+
+
+def cmd_linking(args, progress):
+    if args.pool:
+        targets = parse_targets("\n".join(read_lines(args.pool)))
+        src_urls = [u for u, _ in targets]
+    else:
+        if not (args.sources and args.targets):
+            raise ValueError("Podaj --sources i --targets albo --pool.")
+        src_urls = read_lines(args.sources)
+        targets = parse_targets("\n".join(read_lines(args.targets)))
+    client = get_client("Internal Linking")
+
+    inp = linking_inputs(client, src_urls, targets, report=progress)
+    errors = inp["embed_errors"]
+    if errors:
+        progress.log(f"Błąd API embeddingów dla {len(errors)} źródeł: {next(iter(errors.values()))}")
+    if not inp["s_urls"]:
+        raise ValueError("Nie udało się pobrać treści żadnego źródła.")
+    candidates = linking_candidates(inp, args.top_k, args.min_sim, prefilter=args.fast)
+    n_calls = len(candidates)
+    progress.log(f"Cosinus: {sum(len(v) for v in candidates.values())} par-kandydatów "
+                 f"→ rerank + anchory: {n_calls} zapytań do modelu ({args.model}).")
+
+    with TableSink(args.output, LINK_COLUMNS, sep=args.out_sep) as sink:
+        # źródło po źródle, w kolejności wejścia; w obrębie źródła od najwyższego rerankingu
+        out = OrderedRows(sink, flat=True)
+        order = {i: k for k, i in enumerate(candidates)}
+
+        def on_result(i, rows):
+            out.put(order[i], sorted(rows, key=link_relevance, reverse=True))
+            progress(f"Rerank + propozycje anchorów {out.count}/{n_calls} źródeł", out.count / max(n_calls, 1))
+
+        _, calls, _ = rerank_links(client, args.model, inp, candidates, args.edit,
+                                      use_cache=not args.no_cache, max_workers=args.workers,
+                                      rpm=args.rpm, tpm=args.tpm, on_result=on_result)
+    s = usage_summary(args.model, calls)
+    progress.log(f"Rerank: {s['api_calls']}/{s['calls']} zapytań API, cache promptu {s['prefix_hit_ratio']:.0%}.")
+    return EXIT_PARTIAL if errors or len(calls) < n_calls else EXIT_OK
+
+
+def cmd_cosine(args, progress):
+    urls = read_lines(args.input)
+    client = get_client("Cosinus URL")
+    kept, vecs, no_text, errors = cosine_vectors(client, urls, report=progress)
+    if no_text:
+        progress.log(f"Pominięto {len(no_text)} URL-i bez treści (błąd pobrania lub < 100 znaków).")
+    if errors:
+        progress.log(f"Błąd API embeddingów dla {len(errors)} URL-i: {next(iter(errors.values()))}")
+    if len(kept) < 2:
+        raise ValueError("Za mało danych.")
+
+    # pary blokami prosto do pliku — bez gęstej macierzy i bez całej listy w pamięci
+    with TableSink(args.output, ["URL A", "URL B", "Score"], sep=args.out_sep) as sink:
+        for ii, jj, ss in iter_similar_pairs(vecs, args.threshold, prefilter=args.fast):
+            sink.write({"URL A": kept[i], "URL B": kept[j], "Score": round(float(s), 4)}
+                       for i, j, s in zip(ii.tolist(), jj.tolist(), ss.tolist()))
+        n_pairs = sink.rows
+    progress.log(f"{n_pairs} par z podobieństwem > {args.threshold} ({len(kept)} URL-i).")
+    return EXIT_PARTIAL if no_text or errors else EXIT_OK
+
+
+# =========================================================
+# ARGUMENTY
+# =========================================================
+def build_parser():
+    p = argparse.ArgumentParser(prog="seo_cli.py", description=__doc__.split("\n\n")[1],
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="tool", required=True)
+
+    def add(name, fn, help_, input_help, model=None, llm=False):
+        sp = sub.add_parser(name, help=help_)
+        if input_help:
+            sp.add_argument("input", help=input_help)
+        sp.add_argument("-o", "--output", required=True, help="plik wynikowy: .csv albo .parquet")
+        sp.add_argument("--out-sep", default=",", help="separator wyjściowego CSV (domyślnie ',')")
+        if llm:
+            sp.add_argument("--model", default=model)
+            sp.add_argument("--workers", type=int, default=8, help="równoległe zapytania")
+            sp.add_argument("--rpm", type=int, default=500, help="limit zapytań / min")
+            sp.add_argument("--tpm", type=int, default=200_000, help="limit tokenów / min")
+            sp.add_argument("--no-cache", action="store_true", help="bez lokalnego cache odpowiedzi LLM")
+        sp.set_defaults(fn=fn)
+        return sp
+
+    sp = add("macerator", cmd_macerator, "prompt na każdym wierszu kolumny 'input'",
+             "CSV z kolumną 'input'", model="gpt-4o-mini", llm=True)
+    sp.add_argument("--system", required=True, help="plik z promptem systemowym")
+    sp.add_argument("--user", required=True, help="plik z promptem użytkownika (z {input})")
+    sp.add_argument("--batch-size", type=int, default=None, help="wierszy w batchu (domyślnie automatycznie)")
+    sp.add_argument("--chunksize", type=int, default=20_000, help="wierszy CSV wczytywanych naraz")
+    sp.add_argument("--fresh", action="store_true", help="ignoruj zapisany postęp dla tego pliku")
+
+    sp = add("meta", cmd_meta, "Meta Description z URL + Title + H1", "CSV z URL, Title, H1",
+             model="gpt-4o-mini", llm=True)
+    sp.add_argument("--sep", default=",", help="separator wejściowego CSV")
+    sp.add_argument("--url-col")
+    sp.add_argument("--title-col")
+    sp.add_argument("--h1-col")
+    sp.add_argument("--system", help="plik z promptem systemowym (domyślnie wbudowany)")
+    sp.add_argument("--user", help="plik z szablonem promptu ({url}, {title}, {h1})")
+    sp.add_argument("--batch-size", type=int, default=None, help="wierszy w batchu (domyślnie automatycznie)")
+    sp.add_argument("--repairs", type=int, default=2, help="rundy poprawek długości")
+    sp.add_argument("--fresh", action="store_true", help="ignoruj zapisany postęp dla tego pliku")
+
+    sp = add("site-focus", cmd_site_focus, "Site Focus & Radius", "plik z URL-ami (jeden w linii, '-' = stdin)")
+    sp.add_argument("--project", default="", help="nazwa projektu → snapshoty i przyrostowe audyty")
+    sp.add_argument("--full", action="store_true", help="przelicz wszystko od nowa (bez zapisanych wektorów)")
+
+    sp = add("linking", cmd_linking, "planer linkowania wewnętrznego", None, model="gpt-4o-mini", llm=True)
+    sp.add_argument("--sources", help="URL-e źródeł (jeden w linii)")
+    sp.add_argument("--targets", help="cele: 'URL' albo 'URL ; fraza' w linii")
+    sp.add_argument("--pool", help="jedna pula 'URL' / 'URL ; fraza' — każdy z każdym")
+    sp.add_argument("--top-k", type=int, default=8, help="kandydatów na źródło")
+    sp.add_argument("--min-sim", type=float, default=0.15, help="min. podobieństwo cosinus")
+    sp.add_argument("--edit", action="store_true", help="dozwolone drobne zmiany tekstu")
+    sp.add_argument("--fast", action="store_true", help=f"cosinus na prefiksie {PREFIX_DIMS} wymiarów + dokładny rescoring")
+
+    sp = add("cosine", cmd_cosine, "pary URL-i podobne cosinusowo", "plik z URL-ami (jeden w linii, '-' = stdin)")
+    sp.add_argument("--threshold", type=float, default=0.5, help="próg podobieństwa")
+    sp.add_argument("--fast", action="store_true", help=f"prefiks {PREFIX_DIMS} wymiarów + dokładny rescoring")
+    return p
+
+
+def main(argv=None, progress=None):
+    """progress = obiekt z __call__(tekst, ułamek) i log(msg); domyślnie stderr (kolejka podaje swój)."""
+    args = build_parser().parse_args(argv)
+    progress = progress or StderrProgress(args.tool)
+    try:
+        code = args.fn(args, progress)
+    except (ValueError, RuntimeError, OSError, KeyError) as e:
+        progress.log(f"BŁĄD: {e}")
+        code = EXIT_ERROR
+    if isinstance(progress, StderrProgress) and usage_line():
+        sys.stderr.write(usage_line() + "\n")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,634 @@
+"""
+seo_pipelines.py — rdzenie narzędzi bez UI.
+
+Strony Streamlit i seo_cli.py wołają te same funkcje: scraping, embeddingi i LLM
+idą przez seo_utils (cache, limiter, checkpointy, telemetria), a tutaj nie ma
+ani jednego st.* — postęp i wyniki częściowe oddajemy przez callbacki.
+Konwencja raportowania: report(tekst, ułamek 0–1).
+"""
+
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from seo_utils import (RateLimiter, BatchSizer, run_indexed_batches, run_llm_jobs, append_checkpoint,
+                       load_checkpoint, chat_json_resp, estimate_tokens, job_fingerprint, usage_tokens,
+                       scrape_and_embed, stage_progress, embed_texts, norm_url, iter_top_similar,
+                       load_vector_store, save_vector_store, latest_snapshot, save_snapshot,
+                       TableSink, OrderedRows)
+
+
+# =========================================================
+# MACERATOR  (kolumna 'input' → wynik promptu, wiele wierszy na zapytanie)
+# =========================================================
+def macerate_rows(inputs, system_prompt, user_prompt, model, client, batch_size=None,
+                  max_workers=8, rpm=500, tpm=200_000, checkpoint=None, done_rows=None,
+                  use_cache=True, on_rows=None, row_offset=0):
+    """
+    Batche lecą równolegle (max_workers) pod limiterem RPM/TPM.
+    batch_size=None → rozmiar batcha dobiera BatchSizer (tokeny wejścia/wyjścia, korekta w locie).
+    Odpowiedź to ścisły JSON kluczowany numerem wiersza — wiersze bez poprawnego wpisu idą
+    ponownie w mniejszych batchach, reszta batcha zostaje.
+    checkpoint=klucz → każdy ukończony batch ląduje w pliku zadania; wiersze z done_rows
+    (domyślnie wczytane z checkpointu) nie są wysyłane ponownie.
+    on_rows({wiersz: wynik}) po każdym batchu (tylko poprawne wiersze).
+    row_offset → w checkpoincie wiersze są zapisane jako row_offset + indeks (część większego pliku).
+
+    Zwraca (wyniki, błędy, sizer): {wiersz: wynik} łącznie z wznowionymi,
+    {wiersz: komunikat} i BatchSizer (None przy stałym rozmiarze).
+    """
+    # klamry we frazach zostają jak są — .format() parsuje tylko szablon (tam {{ }} = dosłowne klamry)
+    keywords = [str(x) for x in inputs]
+    if done_rows is None:
+        done_rows = chunk_checkpoint(checkpoint, row_offset, len(keywords)) if checkpoint else {}
+    pending = [i for i in range(len(keywords)) if i not in done_rows]
+
+    def _on_rows(got):
+        # do checkpointu trafiają tylko poprawne wiersze — braki wrócą w kolejnej rundzie
+        if checkpoint and got:
+            append_checkpoint(checkpoint, [row_offset + r for r in got], list(got.values()))
+        if on_rows:
+            on_rows(got)
+
+    # retry po 429 robi limiter, nie klient (inaczej limiter nie widzi przeciążenia)
+    api = client.with_options(max_retries=0)
+    sizer = BatchSizer() if batch_size is None else None
+    results, errors = run_indexed_batches(
+        api, model, system_prompt, lambda block: user_prompt.format(input=block),
+        keywords, pending, batch_size,
+        limiter=RateLimiter(rpm=rpm, tpm=tpm),
+        max_workers=max_workers,
+        use_cache=use_cache,
+        on_rows=_on_rows,
+        sizer=sizer,
+    )
+    results.update(done_rows)
+    return results, errors, sizer
+
+
+def chunk_checkpoint(checkpoint, offset, n):
+    """Gotowe wiersze offset..offset+n z checkpointu zadania, z indeksami względem początku części."""
+    return {r - offset: v for r, v in load_checkpoint(checkpoint, rows=range(offset, offset + n)).items()}
+
+
+def macerate_csv(src, out_path, system_prompt, user_prompt, model, client, batch_size=None,
+                 chunksize=20_000, max_workers=8, rpm=500, tpm=200_000, checkpoint=None,
+                 use_cache=True, out_sep=",", report=None):
+    """
+    Macerator strumieniowo: CSV (ścieżka albo plik binarny) czytany po `chunksize` wierszy,
+    każda część przez macerate_rows, wyniki dopisywane do out_path (.csv / .parquet)
+    w kolejności wejścia, gdy tylko są gotowe. W pamięci jest tylko bieżąca część.
+    checkpoint=klucz → jeden checkpoint zadania z bezwzględnymi numerami wierszy: wznowienie
+    (także z innym chunksize) czyta plik od nowa, ale gotowe wiersze bierze z dysku (bez API).
+    report(tekst, ułamek) — ułamek z pozycji w pliku wejściowym.
+    Zwraca {"rows", "resumed", "errors", "batch_size"}; ValueError bez kolumny 'input'.
+    """
+    fh = open(src, "rb") if isinstance(src, str) else src
+    fh.seek(0, os.SEEK_END)
+    size = max(fh.tell(), 1)
+    fh.seek(0)
+    stats = {"rows": 0, "resumed": 0, "errors": 0, "batch_size": None}
+    sink = out = None
+    frac_end = 0.0
+    try:
+        for n, chunk in enumerate(pd.read_csv(fh, encoding="utf-8", chunksize=chunksize)):
+            if sink is None:
+                if "input" not in chunk.columns:
+                    raise ValueError("Plik CSV musi zawierać kolumnę o nazwie 'input'.")
+                sink = TableSink(out_path, list(chunk.columns) + ["wynik"], sep=out_sep,
+                                 text_columns=chunk.columns)
+                out = OrderedRows(sink)
+            base, records = stats["rows"], chunk.to_dict("records")
+            # pozycja czytnika jest przed nami (bufor), ale rośnie monotonicznie — wystarczy do paska
+            frac_start, frac_end = frac_end, max(frac_end, min(fh.tell() / size, 1.0))
+
+            def emit(got, base=base, records=records, frac_start=frac_start, frac_end=frac_end):
+                for r, value in sorted(got.items()):
+                    out.put(base + r, {**records[r], "wynik": value})
+                if report:
+                    done = out.count - base
+                    report(f"Przetworzono {out.count} wierszy (część {n + 1})",
+                           frac_start + (frac_end - frac_start) * done / max(len(records), 1))
+
+            done_rows = chunk_checkpoint(checkpoint, base, len(records)) if checkpoint else {}
+            stats["resumed"] += len(done_rows)
+            emit(done_rows)
+            _, errors, sizer = macerate_rows(
+                chunk["input"].tolist(), system_prompt, user_prompt, model, client, batch_size,
+                max_workers=max_workers, rpm=rpm, tpm=tpm, checkpoint=checkpoint, done_rows=done_rows,
+                use_cache=use_cache, on_rows=emit, row_offset=base,
+            )
+            emit(errors)
+            stats["rows"] += len(records)
+            stats["errors"] += len(errors)
+            if sizer:
+                # kolejna część startuje z rozmiaru wyuczonego na poprzedniej
+                batch_size, stats["batch_size"] = None, sizer.size
+        if sink is None:
+            raise ValueError("Plik CSV nie zawiera wierszy.")
+        sink.close()
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        raise
+    finally:
+        if isinstance(src, str):
+            fh.close()
+    return stats
+
+
+# =========================================================
+# META DESCRIPTION  (Title + H1 → opis 130–155 znaków)
+# =========================================================
+META_MIN_LEN, META_MAX_LEN = 130, 155
+
+META_SYSTEM_PROMPT = """Jesteś ekspertem SEO i Copywriterem. Twoim celem jest zwiększenie CTR (Click Through Rate) z wyników wyszukiwania Google.
+Zasady pisania:
+1. Długość: od 130 do 155 znaków (to krytyczne, nie przekraczaj tego).
+2. Zawrzyj słowa kluczowe z Title i H1, ale w naturalny sposób.
+3. Język korzyści (benefit-oriented).
+4. Zakończ Call to Action (np. Sprawdź!, Zobacz ofertę, Wejdź).
+5. Nie używaj cudzysłowów na początku i końcu odpowiedzi.
+6. Pisz w języku Polskim."""
+
+META_USER_PROMPT = """Stwórz Meta Description dla podstrony.
+Dane:
+- URL: {url}
+- Meta Title: {title}
+- Nagłówek H1: {h1}
+
+Meta Description:"""
+
+META_BATCH_HEADER = f"""Poniżej są dane kilku podstron — każda w osobnym wierszu z numerem.
+Dla KAŻDEJ napisz osobny Meta Description zgodnie z zasadami, od {META_MIN_LEN} do {META_MAX_LEN} znaków.
+
+"""
+META_REPAIR_NOTE = (" || POPRAWKA: poprzednia wersja miała {n} znaków, a musi mieć od "
+                    f"{META_MIN_LEN} do {META_MAX_LEN}. Napisz nową o właściwej długości. "
+                    "Poprzednia wersja: {prev}")
+
+
+def meta_len_ok(text):
+    return META_MIN_LEN <= len(text) <= META_MAX_LEN
+
+
+def _meta_len_miss(text):
+    """O ile znaków tekst wypada poza widełki (0 = w normie)."""
+    return max(META_MIN_LEN - len(text), len(text) - META_MAX_LEN, 0)
+
+
+def meta_prompts(records, template):
+    """(url, title, h1) → prompt wiersza spłaszczony do jednej linii, bo w batchu
+    jeden wiersz = jedna podstrona. Zmienna spoza {url}/{title}/{h1} w szablonie → KeyError."""
+    return [" ".join(template.format(url=str(u), title=str(t), h1=str(h)).split())
+            for u, t, h in records]
+
+
+def generate_meta_descriptions(prompts, system_prompt, model, client, rows, batch_size=None,
+                               max_workers=8, rpm=500, tpm=200_000, repair_rounds=2,
+                               checkpoint=None, use_cache=True, progress=None, on_final=None):
+    """Wiele wierszy na zapytanie (JSON kluczowany numerem), batche równolegle pod limiterem.
+    Opisy spoza 130–155 znaków wracają w kolejnych rundach — tylko one, z podaną długością
+    poprzedniej wersji. Zostaje wersja najbliższa widełkom.
+    prompts[r] = wypełniony prompt wiersza w jednej linii. progress(ile_gotowych) po każdym batchu,
+    on_final({wiersz: opis}) dla opisów już ostatecznych (w normie od razu, reszta na końcu).
+    Zwraca (opisy, błędy): {wiersz: opis} i {wiersz: komunikat}."""
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    api = client.with_options(max_retries=0)
+    in_range = set()
+
+    def on_rows(got):
+        ok = {r: t for r, t in got.items() if meta_len_ok(t) and r not in in_range}
+        in_range.update(ok)
+        if checkpoint and ok:
+            append_checkpoint(checkpoint, list(ok), list(ok.values()))
+        if on_final and ok:
+            on_final(ok)
+        if progress:
+            progress(len(in_range))
+
+    def run(items, todo):
+        return run_indexed_batches(api, model, system_prompt, lambda block: META_BATCH_HEADER + block,
+                                   items, todo, batch_size, limiter=limiter, max_workers=max_workers,
+                                   use_cache=use_cache, on_rows=on_rows)
+
+    best, errors = run(prompts, rows)
+    for _ in range(repair_rounds):
+        bad = [r for r in best if not meta_len_ok(best[r])]
+        if not bad:
+            break
+        items = {r: prompts[r] + META_REPAIR_NOTE.format(n=len(best[r]), prev=best[r]) for r in bad}
+        fixed, _ = run(items, bad)
+        for r, text in fixed.items():
+            if _meta_len_miss(text) < _meta_len_miss(best[r]):
+                best[r] = text
+
+    # wersje nadal poza widełkami też zapisujemy — wznowienie nie płaci za nie drugi raz
+    rest = {r: t for r, t in best.items() if r not in in_range}
+    if checkpoint and rest:
+        append_checkpoint(checkpoint, list(rest), list(rest.values()))
+    if on_final and rest:
+        on_final(rest)
+    return best, errors
+
+
+# =========================================================
+# SITE FOCUS  (centroid domeny + Site Radius, snapshoty projektu)
+# =========================================================
+def sf_status(r):
+    if r < 0.25:
+        return "🟢 CORE"
+    if r < 0.55:
+        return "🟡 SUPPORT"
+    return "🔴 OFF-TOPIC"
+
+
+def sf_provisional_rows(vecs):
+    """Radius wstępny {url: wektor} względem centroidu tego, co już policzone — do podglądu na żywo.
+    Lista dictów (url, SiteRadius, Status) od najbliższych środka."""
+    if not vecs:
+        return []
+    urls = list(vecs)
+    mat = np.stack([vecs[u] for u in urls]).astype(np.float64)
+    centroid = mat.mean(axis=0)
+    cos = (mat @ centroid) / (np.linalg.norm(mat, axis=1) * np.linalg.norm(centroid) + 1e-12)
+    rows = [{"url": u, "SiteRadius": round(float(r), 4), "Status": sf_status(r)} for u, r in zip(urls, 1.0 - cos)]
+    return sorted(rows, key=lambda r: r["SiteRadius"])
+
+
+def site_focus_audit(client, urls, project="", full_refresh=False, report=None, on_vectors=None):
+    """
+    Audyt Site Focus: treść główna → embeddingi → centroid → radius każdej strony.
+    project="" → bez snapshotów; inaczej pobierane i embedowane są tylko strony spoza
+    poprzedniego audytu, centroid to suma bieżąca (poprzednia + nowe − usunięte),
+    a "diff" zawiera strony, które zmieniły status. ValueError, gdy < 3 stron z treścią.
+    on_vectors({url: wektor}) — najpierw strony z poprzedniego audytu, potem każdy batch nowych.
+    Zwraca dict: df, avg, focus, n_ok, n_in, n_new, n_reused, snapshot, diff
+    oraz embed_errors {url: błąd} dla stron, których nie dało się zembedować.
+    """
+    urls = list(dict.fromkeys(urls))
+    project = project.strip()
+    store = load_vector_store(project) if project else {}
+    prev = latest_snapshot(project) if project else None
+    if full_refresh:
+        store, prev = {}, None
+
+    # strony z poprzedniego audytu, których wektory mamy → bez ponownego scrapingu/embeddingu
+    url_set = set(urls)
+    prev_urls = prev["urls"] if prev else []
+    kept = [u for u in prev_urls if u in url_set and u in store]
+    kept_set = set(kept)
+    removed = [u for u in prev_urls if u not in url_set]   # tylko te, których już nie ma na liście
+    todo = [u for u in urls if u not in kept_set]
+    # suma bieżąca działa tylko, gdy znamy stary wektor każdej strony, która z niej wypada
+    # (usunięte) albo wraca z nowym wektorem (była w audycie, ale bez wektora w magazynie)
+    incremental = prev is not None and all(u in store for u in prev_urls)
+    if incremental:
+        vec_sum = prev["vec_sum"].copy()
+        for u in removed:
+            vec_sum -= store[u]
+
+    if on_vectors and kept:
+        on_vectors({u: store[u] for u in kept})
+    _, new_vecs, embed_errors = scrape_and_embed(client, todo, progress=stage_progress(report, "Pobieranie treści"),
+                                                 on_vectors=on_vectors)
+    valid_new = [(u, new_vecs[u]) for u in todo if u in new_vecs]
+
+    if len(kept) + len(valid_new) < 3:
+        hint = (f" Błąd API embeddingów dla {len(embed_errors)} URL-i: {next(iter(embed_errors.values()))}"
+                if embed_errors else " Sprawdź URL-e.")
+        raise ValueError(f"Pobrano poprawnie tylko {len(kept) + len(valid_new)} stron (min. 3).{hint}")
+
+    store.update(valid_new)
+
+    # centroid jako suma bieżąca: poprzednia suma − usunięte (stare wektory, sprzed update) + nowe
+    new_set = {u for u, _ in valid_new}
+    urls_v = [u for u in urls if u in kept_set or u in new_set]
+    if incremental:
+        for u, v in valid_new:
+            vec_sum += v
+    else:
+        vec_sum = np.sum([store[u] for u in urls_v], axis=0, dtype=np.float64)
+    mat = np.stack([store[u] for u in urls_v]).astype(np.float64)
+    centroid = vec_sum / len(urls_v)
+    cos = (mat @ centroid) / (np.linalg.norm(mat, axis=1) * np.linalg.norm(centroid) + 1e-12)
+    radii = 1.0 - cos
+
+    df = pd.DataFrame({"url": urls_v, "SiteRadius": radii})
+    df["Status"] = df["SiteRadius"].apply(sf_status)
+    df = df.sort_values("SiteRadius").reset_index(drop=True)
+
+    # --- diff względem ostatniego snapshotu ---
+    diff = None
+    if prev:
+        before = {u: (s, float(r)) for u, s, r in zip(prev["urls"], prev["status"], prev["radii"])}
+        diff_rows = []
+        for u, r, s in zip(df["url"], df["SiteRadius"], df["Status"]):
+            old = before.get(u)
+            if old is None:
+                diff_rows.append({"url": u, "Było": "— (nowa)", "Jest": s, "Radius przed": None, "Radius teraz": r})
+            elif old[0] != s:
+                diff_rows.append({"url": u, "Było": old[0], "Jest": s, "Radius przed": old[1], "Radius teraz": r})
+        for u in removed:
+            s_old, r_old = before[u]
+            diff_rows.append({"url": u, "Było": s_old, "Jest": "— (usunięta)", "Radius przed": r_old, "Radius teraz": None})
+        diff = {"ts": prev["ts"], "df": pd.DataFrame(diff_rows)}
+
+    ts = None
+    if project:
+        save_vector_store(project, store)
+        ts = save_snapshot(project, df["url"].tolist(), df["SiteRadius"].to_numpy(),
+                           df["Status"].tolist(), vec_sum, len(urls_v))
+
+    avg = float(df["SiteRadius"].mean())
+    return {
+        "df": df,
+        "avg": avg,
+        "focus": 1.0 / (1.0 + avg),
+        "n_ok": len(urls_v),
+        "n_in": len(urls),
+        "n_new": len(valid_new),
+        "n_reused": len(kept),
+        "snapshot": ts,
+        "diff": diff,
+        "embed_errors": embed_errors,
+    }
+
+
+# =========================================================
+# LINKOWANIE WEWNĘTRZNE  (cosinus → rerank + anchory)
+# =========================================================
+MAX_SRC_CHARS = 14000  # ile tekstu źródłowego wysyłamy do modelu (kontrola tokenów)
+
+LINK_COLUMNS = ["zrodlo", "cel", "fraza_docelowa", "relevance", "similarity",
+                "juz_podlinkowane", "istniejacy_anchor", "typ", "anchor",
+                "trafnosc", "kontekst", "propozycja_zmiany"]
+
+SYSTEM_BASE = """Jesteś ekspertem SEO od linkowania wewnętrznego (internal linking) dla polskich serwisów.
+Dostajesz JEDEN tekst źródłowy oraz listę stron docelowych (każda opisana frazą/tematem).
+Dla KAŻDEJ strony docelowej zrób dwie rzeczy:
+
+A) RERANKING — oceń "relevance" 0-100: jak bardzo sensowny i merytorycznie uzasadniony jest link
+   z tego tekstu do tej strony (temat + kontekst tekstu). Oceń KAŻDĄ stronę — to służy do ułożenia
+   kolejności, niczego nie odrzucamy.
+B) ANCHORY — zaproponuj konkretne anchory wg zasad trybu poniżej.
+
+ZASADY ANCHORÓW:
+- Link uzasadniony merytorycznie; anchor pasuje do strony docelowej ORAZ do kontekstu zdania.
+- Anchor 1-5 słów, naturalny, bez exact-match spamu.
+- Maksymalnie 2 propozycje na jedną stronę docelową; brak dobrej propozycji → pusta lista (ale "relevance" i tak oceń).
+- "kontekst" = zdanie/fragment z tekstu, którego dotyczy anchor.
+- Jeśli przy stronie docelowej jest adnotacja [JUŻ PODLINKOWANE], link z tego tekstu już istnieje:
+  obniż relevance i NIE proponuj duplikatu (chyba że sensowny jest dodatkowy link w innym miejscu).
+"""
+
+MODE1 = """
+TRYB: NIE MOŻNA EDYTOWAĆ TEKSTU.
+- Wolno użyć WYŁĄCZNIE fragmentów występujących DOSŁOWNIE w tekście źródłowym.
+- "anchor" musi być dokładnym ciągiem skopiowanym 1:1 z tekstu (z zachowaniem odmiany).
+- Jeśli brak naturalnego, dosłownego dopasowania — pusta lista propozycji (relevance oceń mimo to).
+- "typ" zawsze = "istniejacy", "propozycja_zmiany" zawsze = null.
+"""
+
+MODE2 = """
+TRYB: MOŻNA EDYTOWAĆ TEKST.
+- Najpierw szukaj anchorów obecnych dosłownie (typ = "istniejacy", propozycja_zmiany = null).
+- Jeśli brak dobrego dopasowania, zaproponuj DROBNĄ zmianę (typ = "nowy"): przeredagowanie zdania
+  lub dołożenie jednego krótkiego, naturalnego zdania mieszczącego link.
+- Dla typu "nowy" w "propozycja_zmiany" podaj pełną nową/zmienioną treść zdania, anchor w **gwiazdkach**.
+- Zmiany minimalne, nie psują stylu ani sensu.
+"""
+
+SCHEMA = """
+FORMAT ODPOWIEDZI — wyłącznie poprawny JSON:
+{
+  "wyniki": [
+    {
+      "target_id": <numer w nawiasie []>,
+      "relevance": <0-100>,
+      "propozycje": [
+        {"typ":"istniejacy|nowy","anchor":"...","kontekst":"...","propozycja_zmiany":null,"trafnosc":0-100,"uzasadnienie":"..."}
+      ]
+    }
+  ]
+}
+"""
+
+
+def _norm(s):
+    return re.sub(r"\s+", " ", str(s).lower()).strip()
+
+
+def parse_targets(raw):
+    out = []
+    for line in raw.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if ";" in line:
+            u, f = line.split(";", 1)
+            out.append((u.strip(), f.strip()))
+        else:
+            out.append((line, ""))
+    return out
+
+
+def linking_inputs(client, src_urls, targets, report=None):
+    """
+    Scraping + embeddingi źródeł (tekst + linki) i tematów celów — jednym potokiem.
+    targets = [(url, fraza albo "")]; cel bez frazy dostaje Title+H1 strony.
+    Zwraca dict: s_urls, s_texts, s_links, s_vecs (źródła z treścią), tgt_urls, tgt_topic,
+    tgt_norm, t_vecs, src_map (surowy wynik scrapera źródeł) oraz embed_errors {url źródła: błąd}.
+    """
+    src_map, src_vecs, embed_errors = scrape_and_embed(client, src_urls, kind="source", embed_chars=MAX_SRC_CHARS,
+                                                       progress=stage_progress(report, "Źródła"))
+
+    tgt_urls = [u for u, _ in targets]
+    missing = [u for u, f in targets if not f]
+    topic_map = scrape_and_embed(client, missing, kind="topic",
+                                 progress=stage_progress(report, "Tematy celów"))[0] if missing else {}
+    tgt_topic = [f if f else (topic_map.get(u, "") or u) for u, f in targets]
+
+    s_urls, s_texts, s_links = [], [], []
+    for u in src_urls:
+        d = src_map.get(u)
+        if d and d.get("text") and u in src_vecs:
+            s_urls.append(u)
+            s_texts.append(d["text"][:MAX_SRC_CHARS])
+            s_links.append(d.get("links") or {})
+    return {
+        "s_urls": s_urls, "s_texts": s_texts, "s_links": s_links,
+        "s_vecs": np.stack([src_vecs[u] for u in s_urls]) if s_urls else None,
+        "tgt_urls": tgt_urls, "tgt_topic": tgt_topic, "tgt_norm": [norm_url(u) for u in tgt_urls],
+        "t_vecs": embed_texts(client, tgt_topic),   # tematy z potoku są już w cache
+        "src_map": src_map,
+        "embed_errors": embed_errors,
+    }
+
+
+def linking_candidates(inp, top_k, min_sim, prefilter=False):
+    """Cosinus: {indeks źródła: [(indeks celu, podobieństwo), ...]} — max top_k, bez linku do siebie."""
+    candidates = {}
+    # k + 1, bo jeden z najbliższych celów może być samym źródłem
+    for i, top in iter_top_similar(inp["s_vecs"], inp["t_vecs"], top_k + 1, min_sim, prefilter=prefilter):
+        src_n = norm_url(inp["s_urls"][i])
+        picks = [(j, sc) for j, sc in top if inp["tgt_norm"][j] != src_n][:top_k]   # nie linkuj do samego siebie
+        if picks:
+            candidates[i] = picks
+    return candidates
+
+
+def linking_system(edit_allowed):
+    return SYSTEM_BASE + (MODE2 if edit_allowed else MODE1) + SCHEMA
+
+
+def rerank_links(client, model, inp, candidates, edit_allowed, use_cache=True,
+                 max_workers=8, rpm=500, tpm=200_000, on_result=None):
+    """
+    RERANK + ANCHOR: jeden strzał na źródło, źródła równolegle pod limiterem.
+    on_result(i, wiersze) z wątku głównego po każdym źródle (wiersze błędu też).
+    Zwraca (wiersze, odpowiedzi, wiersze_zużycia) w kolejności źródeł — tabela identyczna
+    jak przy przebiegu sekwencyjnym.
+    """
+    s_urls, s_texts, s_links = inp["s_urls"], inp["s_texts"], inp["s_links"]
+    tgt_urls, tgt_topic, tgt_norm = inp["tgt_urls"], inp["tgt_topic"], inp["tgt_norm"]
+    # Układ pod cache promptów providera: wszystko stałe (zasady, tryb, schemat) w system,
+    # potem tekst źródła, na końcu zmienna lista celów — ponowny przebieg tego samego źródła
+    # (inne top_k / progi) trafia w prefiks aż do listy celów.
+    system = linking_system(edit_allowed)
+    cache_group = "il-" + job_fingerprint(model, system)
+    # retry po 429 robi limiter, nie klient (inaczej limiter nie widzi przeciążenia)
+    api = client.with_options(max_retries=0)
+
+    def build_job(i, picks):
+        links_i = s_links[i]
+        existing = {j: (tgt_norm[j] in links_i) for j, _ in picks}
+        block = "\n".join(
+            f"[{k}] URL: {tgt_urls[j]} | TEMAT: {tgt_topic[j]}"
+            + (" [JUŻ PODLINKOWANE]" if existing[j] else "")
+            for k, (j, _) in enumerate(picks)
+        )
+        user = (f'TEKST ŹRÓDŁOWY (URL: {s_urls[i]}):\n"""\n{s_texts[i]}\n"""\n\n'
+                f"STRONY DOCELOWE (używaj target_id = numer w []):\n{block}")
+        return i, picks, existing, user
+
+    def rerank_source(job):
+        """Jedno źródło → (wiersze tabeli, odpowiedź z usage). Bez st.*, więc bezpieczne w wątkach."""
+        i, picks, existing, user = job
+        links_i = s_links[i]
+        # wszystkie ponowienia (429 i 5xx/timeout) robi _call_limited przez limiter run_llm_jobs
+        resp = chat_json_resp(api, model, system, user, use_cache=use_cache, prompt_cache_key=cache_group,
+                              max_retries=0)
+        data = json.loads(resp["content"])
+        out = []
+        text_norm = _norm(s_texts[i])
+        for w in data.get("wyniki", []):
+            try:
+                k = int(w.get("target_id"))
+                j, score = picks[k]
+            except (TypeError, ValueError, IndexError):
+                continue
+            relevance = w.get("relevance", "")
+
+            valid = []
+            for prop in (w.get("propozycje") or [])[:2]:
+                typ = prop.get("typ", "istniejacy")
+                anchor = (prop.get("anchor") or "").strip()
+                if not anchor:
+                    continue
+                if not edit_allowed and (typ != "istniejacy" or _norm(anchor) not in text_norm):
+                    continue
+                valid.append((typ, anchor, prop))
+
+            base = {
+                "zrodlo": s_urls[i], "cel": tgt_urls[j], "fraza_docelowa": tgt_topic[j],
+                "relevance": relevance, "similarity": round(score, 3),
+                "juz_podlinkowane": "TAK" if existing[j] else "",
+                "istniejacy_anchor": links_i.get(tgt_norm[j], "") if existing[j] else "",
+            }
+            if valid:
+                for typ, anchor, prop in valid:
+                    out.append({**base, "typ": typ, "anchor": anchor,
+                                "trafnosc": prop.get("trafnosc", ""),
+                                "kontekst": (prop.get("kontekst") or "")[:300],
+                                "propozycja_zmiany": prop.get("propozycja_zmiany") or ""})
+            else:
+                out.append({**base, "typ": "", "anchor": "", "trafnosc": "",
+                            "kontekst": "", "propozycja_zmiany": ""})
+        return out, resp
+
+    def rows_of(job, out):
+        if not isinstance(out, Exception):
+            return out[0]
+        i, picks, existing, _ = job
+        return [{"zrodlo": s_urls[i], "cel": tgt_urls[j], "fraza_docelowa": tgt_topic[j],
+                 "relevance": "", "similarity": round(score, 3),
+                 "juz_podlinkowane": "TAK" if existing[j] else "",
+                 "istniejacy_anchor": "", "typ": "BŁĄD", "anchor": "",
+                 "trafnosc": "", "kontekst": str(out)[:120], "propozycja_zmiany": ""}
+                for j, score in picks]
+
+    jobs = [build_job(i, picks) for i, picks in candidates.items()]
+    outputs = run_llm_jobs(
+        rerank_source, jobs,
+        limiter=RateLimiter(rpm=rpm, tpm=tpm),
+        max_workers=max_workers,
+        # wejście + zgrubnie ~150 tokenów odpowiedzi na kandydata
+        est_tokens=lambda job: estimate_tokens(system + job[3]) + 150 * len(job[1]),
+        on_result=(lambda k, out: on_result(jobs[k][0], rows_of(jobs[k], out))) if on_result else None,
+    )
+
+    # scalanie w kolejności źródeł
+    rows, calls, call_rows = [], [], []
+    for job, out in zip(jobs, outputs):
+        rows.extend(rows_of(job, out))
+        if isinstance(out, Exception):
+            continue
+        i, picks = job[0], job[1]
+        resp = out[1]
+        calls.append(resp)
+        p_tok, c_tok, o_tok = usage_tokens(resp.get("usage"))
+        call_rows.append({"zrodlo": s_urls[i], "znaki_tekstu": len(s_texts[i]), "kandydaci": len(picks),
+                          "prompt_tokens": p_tok, "cached_tokens": c_tok, "completion_tokens": o_tok,
+                          "latencja_s": round(resp.get("latency") or 0.0, 2),
+                          "lokalny_cache": "TAK" if resp.get("cached") else ""})
+    return rows, calls, call_rows
+
+
+def link_relevance(row):
+    """Ocena rerankingu jako liczba (puste / błąd → -1) — do sortowania wierszy jednego źródła."""
+    try:
+        return float(row["relevance"])
+    except (TypeError, ValueError):
+        return -1.0
+
+
+def sort_link_rows(rows):
+    """Tabela propozycji: w obrębie źródła od najwyższego rerankingu."""
+    df = pd.DataFrame(rows)
+    df["_rel"] = pd.to_numeric(df["relevance"], errors="coerce").fillna(-1)
+    return df.sort_values(["zrodlo", "_rel"], ascending=[True, False]).drop(columns="_rel").reset_index(drop=True)
+
+
+# =========================================================
+# MACIERZ COSINUSOWA URL-i  (czysta treść → wektory do iter_similar_pairs)
+# =========================================================
+PAGE_TTL_DAYS = 7  # strona pobrana w ciągu tygodnia nie jest ściągana ponownie
+
+
+def cosine_vectors(client, urls, page_ttl_days=PAGE_TTL_DAYS, report=None):
+    """
+    Scraping czystej treści równolegle, embeddingi w batchach pakowanych wg tokenów — oba
+    etapy naraz. Strony i wektory z trwałego cache (.seo_data) nie kosztują ani sieci, ani API.
+    Zwraca (urls z wektorem, macierz float32, URL-e bez treści, {url: błąd embeddingu}).
+    """
+    urls = list(dict.fromkeys(urls))
+    texts, vecs, errors = scrape_and_embed(client, urls, kind="clean", page_ttl_days=page_ttl_days,
+                                           progress=stage_progress(report, "Pobieranie", "Embeddingi"))
+    no_text = [u for u in urls if not texts.get(u)]
+    kept = [u for u in urls if u in vecs]
+    mat = np.array([vecs[u] for u in kept], dtype=np.float32)
+    return kept, mat, no_text, errors
@@ -11,9 +11,26 @@ Reszta zależności (streamlit, openai, bcrypt, requests, beautifulsoup4,
 numpy, pandas, scikit-learn, plotly) i tak już masz.
 """
 
+import csv
+import hashlib
+import importlib.util
+import io
 import json
+import os
+import random
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+from itertools import chain, islice
+from types import SimpleNamespace
 from urllib.parse import urljoin, urlparse
 
 import bcrypt
@@ -21,9 +38,10 @@ import numpy as np
 import requests
 import streamlit as st
 from bs4 import BeautifulSoup
-from openai import OpenAI
+from openai import APIConnectionError, APITimeoutError, OpenAI
 
 USER_DATA_PATH = "users.json"
+DATA_DIR = ".seo_data"  # trwałe dane narzędzi (snapshoty audytów itp.)
 EMBED_MODEL = "text-embedding-3-large"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -74,10 +92,51 @@ def require_login(app_name="SEO Tool"):
     st.stop()
 
 
+# =========================================================
+# STAN  (sesja Streamlit albo proces CLI)
+# =========================================================
+_LOCAL_STATE = {}
+
+
+def in_streamlit():
+    """True pod `streamlit run` (jest sesja użytkownika); False w CLI, cronie i workerach."""
+    try:
+        return st.runtime.exists()
+    except Exception:
+        return False
+
+
+def set_local_user(name):
+    """Użytkownik przypisywany wywołaniom API poza Streamlit (np. właściciel zadania w kolejce)."""
+    _LOCAL_STATE["username"] = name
+
+
+def reset_local_state():
+    """Czyści stan procesu (cache scrapingu/embeddingów, użytkownik) — worker kolejki
+    robi to przed każdym zadaniem, inaczej cache rosłyby przez cały czas życia procesu."""
+    _LOCAL_STATE.clear()
+
+
+def state_dict(name, factory=dict):
+    """Obiekt stanu pod nazwą: w aplikacji w st.session_state, poza nią w słowniku procesu
+    → cache scrapingu/embeddingów działa tak samo w stronach i w seo_cli.py."""
+    store = st.session_state if in_streamlit() else _LOCAL_STATE
+    if name not in store:
+        store[name] = factory()
+    return store[name]
+
+
 # =========================================================
 # OPENAI
 # =========================================================
-def get_client():
+def get_client(tool="SEO Tool"):
+    """Klient OpenAI z telemetrią (tokeny, koszt, latencja) przypisaną do narzędzia i użytkownika.
+    Poza Streamlit klucz bierze z OPENAI_API_KEY (RuntimeError, gdy go brak)."""
+    if not in_streamlit():
+        key = os.environ.get("OPENAI_API_KEY")
+        if not key:
+            raise RuntimeError("Brak klucza: ustaw zmienną środowiskową OPENAI_API_KEY.")
+        return metered_client(OpenAI(api_key=key), tool)
     key = None
     try:
         key = st.secrets["OPENAI_API_KEY"]
@@ -86,27 +145,1231 @@ def get_client():
     if not key:
         st.info("Podaj klucz OpenAI API (secrets lub panel boczny).")
         st.stop()
-    return OpenAI(api_key=key)
+    return metered_client(OpenAI(api_key=key), tool)
 
 
-def chat_json(client, model, system, user, temperature=0.2):
+# Parametry opcjonalne, które model może odrzucić (np. reasoning-owe bez temperature).
+# Odrzucony raz → zapamiętany per model i już nigdy niewysyłany (do restartu serwera).
+_REJECTED_PARAMS = {}
+_PARAMS_LOCK = threading.Lock()
+TRANSIENT_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _rejected_param(e, names):
+    """Nazwa parametru z `names`, który API odrzuciło (400), albo None."""
+    if getattr(e, "status_code", None) != 400:
+        return None
+    param = getattr(e, "param", None)
+    if param in names:
+        return param
+    msg = str(e).lower()
+    if "unsupported" in msg or "not supported" in msg or "does not support" in msg:
+        return next((n for n in names if n in msg), None)
+    return None
+
+
+def _is_transient(e):
+    """Warto ponowić: 429, 5xx, timeout, zerwane połączenie. Błędy 4xx (prompt, parametry) — nie."""
+    if isinstance(e, (APITimeoutError, APIConnectionError)):
+        return True
+    return getattr(e, "status_code", None) in TRANSIENT_STATUS
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0, retry_after=None):
+    """Wykładniczo z pełnym jitterem; retry-after z nagłówka ma pierwszeństwo."""
+    if retry_after:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def chat_json_resp(client, model, system, user, temperature=0.2, use_cache=None, prompt_cache_key=None,
+                   max_retries=4):
     """
-    Wymusza poprawny JSON (response_format) i jest odporny na modele
-    reasoning-owe, które potrafią odrzucać parametr temperature.
+    Wymusza poprawny JSON (response_format). Parametry odrzucane przez model (np. temperature
+    w modelach reasoning-owych) zdejmuje llm_chat i zapamiętuje per model. Błędy przejściowe
+    (429, 5xx, timeout) → ponowienie z wykładniczym backoffem i jitterem, inne lecą od razu.
+    max_retries=0 → każdy błąd idzie wyżej (gdy ponowienia robi RateLimiter / run_llm_jobs).
+    Zwraca pełną odpowiedź llm_chat (content, usage, latency, ...); ucięty/niepoprawny JSON
+    nie trafia do cache, więc kolejne uruchomienie spyta model jeszcze raz.
+    Stały prompt idzie w system, zmienna treść w user — prefiks łapie cache promptów providera.
     """
-    base = dict(
-        model=model,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        response_format={"type": "json_object"},
-    )
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+    fmt = {"type": "json_object"}
+    for attempt in range(max_retries + 1):
+        try:
+            return llm_chat(client, model, messages, temperature=temperature, response_format=fmt,
+                            use_cache=use_cache, cache_if=is_json, prompt_cache_key=prompt_cache_key)
+        except Exception as e:
+            if attempt == max_retries or not _is_transient(e):
+                raise
+            time.sleep(backoff_delay(attempt, retry_after=_retry_after(e)))
+
+
+def chat_json(client, model, system, user, temperature=0.2, use_cache=None):
+    """Jak chat_json_resp, ale zwraca sam tekst JSON."""
+    return chat_json_resp(client, model, system, user, temperature, use_cache)["content"]
+
+
+# =========================================================
+# KOSZTY I ZUŻYCIE TOKENÓW
+# =========================================================
+# USD za 1M tokenów: (wejście, wejście z cache promptu, wyjście).
+# Model spoza tabeli → koszt nieznany (None), reszta statystyk działa normalnie.
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-5.4-mini": (0.75, 0.075, 4.50),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+    "text-embedding-3-large": (0.13, 0.13, 0.0),
+}
+
+
+def model_price(model):
+    """Cena po najdłuższym pasującym prefiksie (gpt-4o-mini-2024-07-18 → gpt-4o-mini)."""
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_PRICES[name]
+    return None
+
+
+def usage_tokens(usage):
+    """usage (dict z model_dump) → (prompt, cached, completion)."""
+    usage = usage or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return (usage.get("prompt_tokens") or 0, details.get("cached_tokens") or 0,
+            usage.get("completion_tokens") or 0)
+
+
+def usage_cost(model, usage):
+    price = model_price(model)
+    if price is None:
+        return None
+    p, c, o = usage_tokens(usage)
+    return ((p - c) * price[0] + c * price[1] + o * price[2]) / 1e6
+
+
+def _pct(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(round(q / 100 * (len(sorted_vals) - 1))))]
+
+
+def usage_summary(model, calls):
+    """
+    calls: odpowiedzi llm_chat z jednego przebiegu → tokeny, trafienia cache promptu
+    providera (prefix_hit_ratio = cached / prompt), koszt i opóźnienia. Trafienia
+    lokalnego cache (cached=True) nic nie kosztują i nie wchodzą do tokenów ani latencji.
+    """
+    api = [c for c in calls if c and not c.get("cached")]
+    p = c = o = 0
+    for r in api:
+        tp, tc, to = usage_tokens(r.get("usage"))
+        p, c, o = p + tp, c + tc, o + to
+    price = model_price(model)
+    lat = sorted(r.get("latency") or 0.0 for r in api)
+    return {
+        "calls": len(calls),
+        "api_calls": len(api),
+        "local_cache_hits": len(calls) - len(api),
+        "prompt_tokens": p,
+        "cached_tokens": c,
+        "completion_tokens": o,
+        "prefix_hit_ratio": c / p if p else 0.0,
+        "cost_usd": usage_cost(model, {"prompt_tokens": p, "completion_tokens": o,
+                                       "prompt_tokens_details": {"cached_tokens": c}}),
+        "prefix_savings_usd": c * (price[0] - price[1]) / 1e6 if price else None,
+        "latency_p50": _pct(lat, 50),
+        "latency_p95": _pct(lat, 95),
+    }
+
+
+# =========================================================
+# TELEMETRIA  (każde wywołanie OpenAI: tokeny, koszt, latencja, błędy)
+# =========================================================
+class Telemetry:
+    """
+    Agregaty per (narzędzie, użytkownik, model): liczba wywołań, błędy wg typu,
+    tokeny, koszt i ostatnie latencje (do percentyli). Bezpieczne w wątkach.
+    Jedna instancja globalna (cały serwer) + jedna na sesję przeglądarki.
+    """
+
+    def __init__(self, max_latencies=5000):
+        self._rows = {}
+        self._max_lat = max_latencies
+        self._lock = threading.Lock()
+
+    def record(self, tool, user, model, kind, usage=None, latency=0.0, error=None):
+        p, c, o = usage_tokens(usage)
+        cost = usage_cost(model, usage) if usage else None
+        with self._lock:
+            r = self._rows.setdefault((tool, user or "", model), {
+                "kind": kind, "calls": 0, "errors": 0, "error_types": {},
+                "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                "cost_usd": 0.0 if model_price(model) else None,
+                "latencies": deque(maxlen=self._max_lat),
+            })
+            r["calls"] += 1
+            if error is not None:
+                r["errors"] += 1
+                name = str(getattr(error, "status_code", None) or type(error).__name__)
+                r["error_types"][name] = r["error_types"].get(name, 0) + 1
+                return
+            r["prompt_tokens"] += p
+            r["cached_tokens"] += c
+            r["completion_tokens"] += o
+            if cost is not None and r["cost_usd"] is not None:
+                r["cost_usd"] += cost
+            r["latencies"].append(latency)
+
+    def snapshot(self):
+        """Wiersze (dict) z percentylami latencji — do tabeli i eksportu JSON."""
+        with self._lock:
+            items = sorted((k, {**v, "latencies": sorted(v["latencies"]), "error_types": dict(v["error_types"])})
+                           for k, v in self._rows.items())
+        out = []
+        for (tool, user, model), r in items:
+            lat = r.pop("latencies")
+            out.append({"tool": tool, "user": user, "model": model, **r,
+                        "latency_p50": round(_pct(lat, 50), 3),
+                        "latency_p90": round(_pct(lat, 90), 3),
+                        "latency_p99": round(_pct(lat, 99), 3)})
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+
+TELEMETRY = Telemetry()
+
+
+def session_telemetry():
+    return state_dict("_telemetry", Telemetry)
+
+
+class MeteredClient:
+    """
+    Cienka nakładka na klienta OpenAI: chat.completions.create i embeddings.create
+    mierzą czas i usage, a wynik trafia do telemetrii globalnej i sesyjnej.
+    Narzędzie i użytkownik są ustalane przy tworzeniu (w wątku głównym), więc wywołania
+    z wątków roboczych też są poprawnie przypisane. Resztę atrybutów przepuszcza dalej.
+    """
+
+    def __init__(self, client, tool, user=None, session=None):
+        self._client, self.tool, self.user, self._session = client, tool, user, session
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.embeddings = SimpleNamespace(create=self._embed_create)
+
+    def with_options(self, **kwargs):
+        return MeteredClient(self._client.with_options(**kwargs), self.tool, self.user, self._session)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _chat_create(self, **kwargs):
+        return self._call("chat", self._client.chat.completions.create, **kwargs)
+
+    def _embed_create(self, **kwargs):
+        return self._call("embedding", self._client.embeddings.create, **kwargs)
+
+    def _call(self, kind, fn, **kwargs):
+        model = kwargs.get("model", "")
+        sinks = [TELEMETRY] + ([self._session] if self._session is not None else [])
+        t0 = time.monotonic()
+        try:
+            resp = fn(**kwargs)
+        except Exception as e:
+            for t in sinks:
+                t.record(self.tool, self.user, model, kind, error=e)
+            raise
+        latency = time.monotonic() - t0
+        usage = resp.usage.model_dump() if getattr(resp, "usage", None) else None
+        for t in sinks:
+            t.record(self.tool, self.user, model, kind, usage, latency)
+        return resp
+
+
+def metered_client(client, tool):
+    """Owiń klienta OpenAI telemetrią (idempotentne). Wołaj w wątku głównym strony.
+    Poza Streamlit użytkownik = konto systemowe (np. cron na workerze)."""
+    if isinstance(client, MeteredClient):
+        return client
+    if in_streamlit():
+        user = st.session_state.get("username")
+    else:
+        user = _LOCAL_STATE.get("username") or os.environ.get("USER")
+    return MeteredClient(client, tool, user, session_telemetry())
+
+
+def telemetry_sidebar():
+    """Panel w sidebarze: zużycie API tej sesji albo całego serwera + eksport JSON."""
+    with st.sidebar.expander("📈 Zużycie API"):
+        scope = st.radio("Zakres", ["Ta sesja", "Cały serwer"], horizontal=True, key="telemetry_scope")
+        rows = (session_telemetry() if scope == "Ta sesja" else TELEMETRY).snapshot()
+        if not rows:
+            st.caption("Brak wywołań API.")
+            return
+        known = [r["cost_usd"] for r in rows if r["cost_usd"] is not None]
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Wywołania", sum(r["calls"] for r in rows))
+        c2.metric("Błędy", sum(r["errors"] for r in rows))
+        c3.metric("Koszt", f"${sum(known):.4f}",
+                  help="Tylko modele z tabeli MODEL_PRICES; trafienia lokalnego cache nic nie kosztują.")
+        st.dataframe(
+            [{k: r[k] for k in ("tool", "user", "model", "calls", "errors", "prompt_tokens",
+                                "cached_tokens", "completion_tokens", "cost_usd",
+                                "latency_p50", "latency_p90")} for r in rows],
+            use_container_width=True,
+        )
+        st.download_button(
+            "📥 Eksport JSON",
+            json.dumps({"scope": "session" if scope == "Ta sesja" else "global",
+                        "generated": datetime.now().isoformat(timespec="seconds"),
+                        "rows": rows}, ensure_ascii=False, indent=2),
+            "telemetria_api.json", "application/json", key="telemetry_export",
+        )
+
+
+# =========================================================
+# CACHE ODPOWIEDZI LLM  (SQLite w .seo_data/, klucz = model + prompty + parametry)
+# =========================================================
+LLM_CACHE = {"enabled": True, "ttl_days": 30, "max_entries": 200_000, "prune_every_s": 600}
+_CACHE_STATS = {"hits": 0, "misses": 0}
+_STATS_LOCK = threading.Lock()
+_DB_LOCAL = threading.local()
+
+
+def _db():
+    """Połączenie SQLite per wątek (sqlite3 nie lubi współdzielenia połączeń między wątkami)."""
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(DATA_DIR, "cache.sqlite"), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                     "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache(created)")
+        conn.execute("CREATE TABLE IF NOT EXISTS emb_cache "
+                     "(key TEXT PRIMARY KEY, vec BLOB NOT NULL, created REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS page_cache "
+                     "(kind TEXT, url TEXT, payload TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (kind, url))")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+        _DB_LOCAL.conn = conn
+    return conn
+
+
+def llm_cache_key(model, messages, temperature=None, response_format=None):
+    raw = json.dumps([model, messages, temperature, response_format], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cache_get(key):
+    row = _db().execute("SELECT response, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    if not row or time.time() - row[1] > LLM_CACHE["ttl_days"] * 86400:
+        return None
+    return json.loads(row[0])
+
+
+def _cache_put(key, value):
+    conn, now = _db(), time.time()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)",
+                     (key, json.dumps(value, ensure_ascii=False), now))
+        # czas ostatniego przycięcia siedzi w bazie: warunkowy upsert jest atomowy, więc
+        # raz na prune_every_s przycina dokładnie jeden wątek/proces (strony, CLI, workery)
+        due = conn.execute("INSERT INTO cache_meta VALUES ('llm_pruned', ?) ON CONFLICT(name) "
+                           "DO UPDATE SET value = excluded.value WHERE value < ?",
+                           (now, now - LLM_CACHE["prune_every_s"])).rowcount
+    if due:
+        _cache_prune(conn)
+
+
+def _cache_prune(conn):
+    with conn:
+        conn.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - LLM_CACHE["ttl_days"] * 86400,))
+        n = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if n > LLM_CACHE["max_entries"]:
+            conn.execute("DELETE FROM llm_cache WHERE key IN "
+                         "(SELECT key FROM llm_cache ORDER BY created LIMIT ?)", (n - LLM_CACHE["max_entries"],))
+
+
+def llm_cache_stats():
+    n, size = _db().execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(response)), 0) FROM llm_cache").fetchone()
+    hits, misses = _CACHE_STATS["hits"], _CACHE_STATS["misses"]
+    return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": n, "bytes": size}
+
+
+def clear_llm_cache():
+    with _db() as conn:
+        conn.execute("DELETE FROM llm_cache")
+
+
+def llm_chat(client, model, messages, temperature=None, response_format=None, use_cache=None,
+             cache_if=None, prompt_cache_key=None):
+    """
+    Jedno wywołanie chat.completions przez cache odpowiedzi. Bez st.* — bezpieczne w wątkach.
+    Zwraca dict: content, finish_reason, usage, latency (s, 0 przy trafieniu), cached. Ucięte (finish_reason="length")
+    i puste odpowiedzi nie są zapisywane w cache; cache_if(content) → False też nie
+    (np. niepoprawny JSON, żeby kolejne uruchomienie mogło spróbować jeszcze raz).
+    prompt_cache_key grupuje zapytania o wspólnym prefiksie u providera (nie wchodzi do klucza cache).
+    temperature / prompt_cache_key odrzucone przez model (400) → zapamiętane i zdjęte, jedno ponowienie.
+    """
+    use_cache = LLM_CACHE["enabled"] if use_cache is None else use_cache
+    key = llm_cache_key(model, messages, temperature, response_format) if use_cache else None
+    if key:
+        hit = _cache_get(key)
+        with _STATS_LOCK:
+            _CACHE_STATS["hits" if hit else "misses"] += 1
+        if hit:
+            return {**hit, "latency": 0.0, "cached": True}
+
+    with _PARAMS_LOCK:
+        rejected = set(_REJECTED_PARAMS.get(model, ()))
+    optional = {k: v for k, v in (("temperature", temperature), ("prompt_cache_key", prompt_cache_key))
+                if v is not None and k not in rejected}
+    while True:
+        params = {}
+        if "temperature" in optional:
+            params["temperature"] = optional["temperature"]
+        if response_format is not None:
+            params["response_format"] = response_format
+        if "prompt_cache_key" in optional:
+            params["extra_body"] = {"prompt_cache_key": optional["prompt_cache_key"]}
+        t0 = time.monotonic()
+        try:
+            resp = client.chat.completions.create(model=model, messages=messages, **params)
+        except Exception as e:
+            bad = _rejected_param(e, optional)
+            if bad is None:
+                raise
+            with _PARAMS_LOCK:
+                _REJECTED_PARAMS.setdefault(model, set()).add(bad)
+            optional.pop(bad)
+            continue
+        break
+    latency = time.monotonic() - t0
+    choice = resp.choices[0]
+    out = {
+        "content": choice.message.content or "",
+        "finish_reason": choice.finish_reason,
+        "usage": resp.usage.model_dump() if getattr(resp, "usage", None) else None,
+    }
+    if (key and out["content"].strip() and out["finish_reason"] != "length"
+            and (cache_if is None or cache_if(out["content"]))):
+        _cache_put(key, out)
+    return {**out, "latency": latency, "cached": False}
+
+
+def is_json(text):
     try:
-        resp = client.chat.completions.create(temperature=temperature, **base)
+        json.loads(text)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def llm_cache_sidebar():
+    """Przełącznik + statystyki cache w panelu bocznym. Zwraca True, gdy cache ma być używany."""
+    with st.sidebar.expander("🗄️ Cache odpowiedzi LLM"):
+        on = st.checkbox("Używaj cache", value=True, key="llm_cache_on",
+                         help="Te same prompty + model + parametry zwracają zapisaną odpowiedź zamiast "
+                              f"płacić ponownie. Ważność: {LLM_CACHE['ttl_days']} dni.")
+        stats = llm_cache_stats()
+        c1, c2 = st.columns(2)
+        c1.metric("Trafienia", stats["hits"])
+        c2.metric("Hit rate", f"{stats['hit_rate']:.0%}")
+        st.caption(f"{stats['entries']} odpowiedzi w cache ({stats['bytes'] / 1e6:.1f} MB). "
+                   "Statystyki od startu serwera.")
+        if st.button("Wyczyść cache", key="llm_cache_clear"):
+            clear_llm_cache()
+    return on
+
+
+# =========================================================
+# RÓWNOLEGŁE ZAPYTANIA DO LLM  (limiter RPM/TPM + adaptacja po 429)
+# =========================================================
+class RateLimiter:
+    """
+    Token bucket na zapytania i tokeny na minutę, wspólny dla wszystkich wątków.
+    Po 429 (backoff) tempo spada o połowę i wszyscy czekają retry-after;
+    każda poprawna odpowiedź (success) po trochu przywraca tempo do limitu.
+    """
+
+    def __init__(self, rpm=500, tpm=200_000):
+        self.rpm, self.tpm = float(rpm), float(tpm)
+        self.rate = 1.0                      # mnożnik limitów, obniżany po 429
+        self._req, self._tok = self.rpm, self.tpm
+        self._t = time.monotonic()
+        self._pause_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        dt, self._t = now - self._t, now
+        self._req = min(self.rpm * self.rate, self._req + dt * self.rpm * self.rate / 60)
+        self._tok = min(self.tpm * self.rate, self._tok + dt * self.tpm * self.rate / 60)
+
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                need = min(tokens, self.tpm * self.rate)   # pojedynczy duży request nie może czekać w nieskończoność
+                wait_s = self._pause_until - now
+                if wait_s <= 0:
+                    if self._req >= 1 and self._tok >= need:
+                        self._req -= 1
+                        self._tok -= need
+                        return
+                    wait_s = max((1 - self._req) * 60 / (self.rpm * self.rate),
+                                 (need - self._tok) * 60 / (self.tpm * self.rate), 0.01)
+            time.sleep(min(wait_s, 1.0))
+
+    def backoff(self, retry_after=None):
+        with self._lock:
+            self.rate = max(0.1, self.rate * 0.5)
+            self._pause_until = max(self._pause_until, time.monotonic() + (retry_after or 2.0))
+
+    def success(self):
+        with self._lock:
+            self.rate = min(1.0, self.rate + 0.02)
+
+
+def _is_rate_limit(e):
+    return getattr(e, "status_code", None) == 429
+
+
+def _retry_after(e):
+    try:
+        return float(e.response.headers.get("retry-after"))
     except Exception:
-        resp = client.chat.completions.create(**base)  # model bez temperature
-    return resp.choices[0].message.content
+        return None
+
+
+def _call_limited(fn, job, limiter, tokens=0, max_retries=5):
+    """fn(job) przez limiter; 429 → backoff limitera i ponowienie (max_retries razy).
+    Inne błędy przejściowe (5xx, timeout, zerwane połączenie) → pauza backoff_delay i ponowienie,
+    bo klient idzie z max_retries=0 — inaczej krótka seria 5xx zjada wszystkie rundy w milisekundy."""
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            out = fn(job)
+        except Exception as e:
+            if attempt < max_retries and _is_rate_limit(e):
+                limiter.backoff(_retry_after(e))
+                continue
+            if attempt < max_retries and _is_transient(e):
+                time.sleep(backoff_delay(attempt, retry_after=_retry_after(e)))
+                continue
+            raise
+        limiter.success()
+        return out
+
+
+def run_llm_jobs(fn, jobs, limiter=None, max_workers=8, est_tokens=None,
+                 max_retries=5, on_result=None):
+    """
+    Wywołuje fn(job) równolegle (max_workers wątków), każde wywołanie przechodzi
+    przez limiter. 429 → limiter.backoff(), 5xx/timeout → backoff_delay; ponowienie max_retries razy.
+    Zwraca wyniki w KOLEJNOŚCI jobs; job, który padł, ma w wyniku obiekt wyjątku.
+    on_result(index, wynik) woła się z wątku głównego po każdym zakończonym jobie
+    (pasek postępu, zapis częściowych wyników).
+    """
+    limiter = limiter or RateLimiter()
+    est_tokens = est_tokens or (lambda job: 0)
+
+    results = [None] * len(jobs)
+    if not jobs:
+        return results
+    # w locie najwyżej max_workers jobów (jak w run_indexed_batches) — wyjątek z on_result
+    # (np. anulowanie zadania) nie zostawia w kolejce executora reszty płatnych wywołań
+    todo, running = iter(enumerate(jobs)), {}
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        while True:
+            for k, job in islice(todo, max_workers - len(running)):
+                running[ex.submit(_call_limited, fn, job, limiter, est_tokens(job), max_retries)] = k
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                k = running.pop(fut)
+                try:
+                    results[k] = fut.result()
+                except Exception as e:
+                    results[k] = e
+                if on_result:
+                    on_result(k, results[k])
+    return results
+
+
+# =========================================================
+# BATCHE LLM KLUCZOWANE NUMEREM WIERSZA  (ścisły JSON schema + ponawianie braków)
+# =========================================================
+INDEXED_INSTRUCTION = """
+
+### FORMAT ODPOWIEDZI (ma pierwszeństwo przed przykładami powyżej):
+Każdy wiersz wejścia zaczyna się numerem w nawiasie kwadratowym, np. [0].
+Zwróć obiekt JSON, w którym KLUCZEM jest ten numer (sam numer jako tekst, bez nawiasów),
+a WARTOŚCIĄ wynik dla tego wiersza. Nie pomijaj żadnego numeru."""
+
+
+def index_schema(n):
+    """response_format wymuszający klucze "0".."n-1" z niepustymi stringami."""
+    keys = [str(k) for k in range(n)]
+    return {"type": "json_schema", "json_schema": {
+        "name": "wyniki_wierszy",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {k: {"type": "string"} for k in keys},
+            "required": keys,
+            "additionalProperties": False,
+        },
+    }}
+
+
+def llm_indexed_batch(client, model, system, render_user, items, temperature=None, use_cache=True):
+    """
+    Jeden batch: items → ({indeks_w_batchu: wynik}, odpowiedź llm_chat).
+    Wiersze z pustą / brakującą odpowiedzią po prostu nie trafiają do wyniku.
+    render_user(blok) wstawia ponumerowane wiersze do promptu użytkownika.
+    """
+    user = render_user("\n".join(f"[{k}] {t}" for k, t in enumerate(items)))
+    resp = llm_chat(
+        client, model,
+        [{"role": "system", "content": system + INDEXED_INSTRUCTION},
+         {"role": "user", "content": user}],
+        temperature=temperature, response_format=index_schema(len(items)),
+        use_cache=use_cache, cache_if=is_json,
+    )
+    try:
+        data = json.loads(resp["content"])
+    except (TypeError, ValueError):
+        data = {}
+    got = {}
+    if isinstance(data, dict):
+        for k in range(len(items)):
+            v = data.get(str(k))
+            if isinstance(v, str) and v.strip():
+                got[k] = v.strip()
+    return got, resp
+
+
+class BatchSizer:
+    """
+    Automatyczny rozmiar batcha. Batch dostaje tyle wierszy, ile zmieści się w budżecie
+    tokenów wejścia i przewidywanych tokenów wyjścia (średnia na wiersz uczona z usage).
+    Zły JSON, finish_reason == "length" albo >10% braków → rozmiar o połowę (pojedynczy
+    brak tylko wstrzymuje wzrost); `grow_after` czystych pełnych batchy z rzędu → +25%. Rozmiar dochodzi więc do największego,
+    który jeszcze daje czyste odpowiedzi — prompt systemowy płacony jest jak najrzadziej.
+    """
+
+    def __init__(self, start_rows=10, min_rows=1, max_rows=200, max_input_tokens=30_000,
+                 max_output_tokens=6_000, out_tokens_per_row=30, grow_after=3):
+        self.size = start_rows
+        self.min_rows, self.max_rows = min_rows, max_rows
+        self.max_input_tokens, self.max_output_tokens = max_input_tokens, max_output_tokens
+        self.out_per_row = float(out_tokens_per_row)
+        self.grow_after = grow_after
+        self._clean = 0
+        self._lock = threading.Lock()
+
+    def rows_for(self, row_tokens):
+        """Ile z kolejnych wierszy (ich szacunkowe tokeny wejścia) wziąć do batcha."""
+        with self._lock:
+            cap = min(self.size, self.max_rows, max(1, int(self.max_output_tokens / self.out_per_row)))
+        n, tok = 0, 0
+        for t in row_tokens[:cap]:
+            if n and tok + t > self.max_input_tokens:
+                break
+            n, tok = n + 1, tok + t
+        return max(1, n)
+
+    def record(self, n_rows, n_ok, finish_reason=None, completion_tokens=None, resize=True):
+        with self._lock:
+            if completion_tokens and n_ok:
+                self.out_per_row = 0.7 * self.out_per_row + 0.3 * completion_tokens / n_rows
+            if not resize:
+                return
+            if finish_reason == "length" or n_rows - n_ok > max(1, 0.1 * n_rows):
+                # połowa rozmiaru TEGO batcha — równoległe porażki jednej fali nie kumulują się
+                self.size = max(self.min_rows, min(self.size, n_rows // 2))
+                self._clean = 0
+            elif n_ok < n_rows:
+                self._clean = 0
+            elif n_rows >= self.size:          # rośniemy tylko na batchach, które były pełne
+                self._clean += 1
+                if self._clean >= self.grow_after:
+                    self.size = min(self.max_rows, max(self.size + 1, int(self.size * 1.25)))
+                    self._clean = 0
+
+
+def run_indexed_batches(client, model, system, render_user, items, rows, batch_size=None,
+                        limiter=None, max_workers=8, rounds=3, temperature=None,
+                        use_cache=True, on_rows=None, sizer=None, max_retries=5, row_cache=False):
+    """
+    Przetwarza wiersze `rows` (indeksy do `items`) batchami równolegle. Wiersze bez
+    poprawnej odpowiedzi (zły JSON, brak klucza, błąd API) wracają do kolejki i idą
+    w coraz mniejszych batchach za każdą porażką (max `rounds` prób) — jeden zły wiersz
+    nie kosztuje pozostałych 49.
+    batch_size=None → rozmiar każdego batcha dobiera `sizer` (domyślnie nowy BatchSizer).
+    Batche składane są dopiero przy wysyłce, więc korekta rozmiaru działa w trakcie.
+    on_rows({wiersz: wynik}) woła się w wątku głównym po każdym batchu (checkpoint, postęp).
+    row_cache=True → cache odpowiedzi per wiersz zamiast per batch: skład batchy zależy od tempa
+    (sizer, kolejność pobrań), więc klucz całego promptu batcha prawie nigdy się nie powtarza.
+    Zwraca (results, errors): {wiersz: wynik} i {wiersz: komunikat} dla tych, które nie przeszły.
+    """
+    limiter = limiter or RateLimiter()
+    if batch_size is None:
+        sizer = sizer or BatchSizer()
+    results, row_key = {}, {}
+    if row_cache and use_cache and LLM_CACHE["enabled"]:
+        prompt = system + "\n" + render_user("")
+        row_key = {r: llm_cache_key(model, [prompt, str(items[r])], temperature) for r in rows}
+        for r in rows:
+            hit = _cache_get(row_key[r])
+            if hit is not None:
+                results[r] = hit["row"]
+        rows = [r for r in rows if r not in results]
+        if on_rows and results:
+            on_rows(dict(results))
+    row_tok = {r: estimate_tokens(str(items[r])) + 2 for r in rows}   # +2 na "[k] "
+    base_tok = estimate_tokens(system + INDEXED_INSTRUCTION + render_user(""))
+    fresh, retry = deque(rows), deque()
+    attempts, errors = {}, {}
+
+    def take():
+        # najpierw ponowienia, w batchach tym mniejszych, im więcej razy wiersz padł
+        queue = retry if retry else fresh
+        if sizer:
+            size = sizer.rows_for([row_tok[r] for r in islice(queue, sizer.max_rows)])
+        else:
+            size = max(1, int(batch_size))
+        if queue is retry:
+            # sizer sam już zmalał po porażce, więc w trybie auto dzielimy łagodniej
+            size = max(1, size // (2 if sizer else 4) ** attempts[retry[0]])
+        return [queue.popleft() for _ in range(min(size, len(queue)))], queue is retry
+
+    def call(b):
+        out_per_row = sizer.out_per_row if sizer else 30
+        return _call_limited(
+            lambda b: llm_indexed_batch(client, model, system, render_user, [items[r] for r in b],
+                                        temperature=temperature, use_cache=use_cache and not row_key),
+            b, limiter, base_tok + sum(row_tok[r] for r in b) + int(out_per_row * len(b)), max_retries,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        running = {}
+        while fresh or retry or running:
+            while (fresh or retry) and len(running) < max_workers:
+                b, is_retry = take()
+                running[ex.submit(call, b)] = b, is_retry
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                b, is_retry = running.pop(fut)
+                try:
+                    (got, resp), err = fut.result(), None
+                except Exception as e:
+                    got, resp, err = {}, {}, e
+                if sizer:
+                    sizer.record(len(b), len(got), resp.get("finish_reason"),
+                                 (resp.get("usage") or {}).get("completion_tokens"),
+                                 resize=not is_retry)   # małe batche ponowień nie mówią nic o rozmiarze
+                ok = {}
+                for k, r in enumerate(b):
+                    if k in got:
+                        results[r] = ok[r] = got[k]
+                        errors.pop(r, None)
+                        if row_key:
+                            _cache_put(row_key[r], {"row": got[k]})
+                        continue
+                    errors[r] = f"Błąd API: {err}" if err else "BRAK ODPOWIEDZI"
+                    attempts[r] = attempts.get(r, 0) + 1
+                    if attempts[r] < rounds:
+                        retry.append(r)
+                if on_rows:
+                    on_rows(ok)
+    return results, errors
+
+
+# =========================================================
+# CHECKPOINTY ZADAŃ  (wznawianie po crashu / przeładowaniu karty)
+# =========================================================
+# .seo_data/jobs/<klucz>.jsonl — jedna linia na ukończony batch:
+#   {"rows": [indeksy wierszy], "results": [wyniki]}
+# Klucz = hash pliku wejściowego + promptów + modelu, więc ten sam plik
+# z tymi samymi ustawieniami wznawia się od pierwszego brakującego wiersza.
+def job_fingerprint(*parts):
+    """Hash części klucza; plik (obiekt z .read) czytany blokami — ten sam wynik co jego bajty."""
+    h = hashlib.sha256()
+    for p in parts:
+        if hasattr(p, "read"):
+            p.seek(0)
+            for block in iter(lambda: p.read(1 << 20), b""):
+                h.update(block)
+            p.seek(0)
+        else:
+            h.update(p if isinstance(p, bytes) else str(p).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()[:24]
+
+
+def _checkpoint_path(key):
+    return os.path.join(DATA_DIR, "jobs", f"{key}.jsonl")
+
+
+def load_checkpoint(key, rows=None):
+    """{indeks_wiersza: wynik} ze wszystkich zapisanych batchy.
+    rows=range(...) → tylko wiersze z tego zakresu (wznawianie pliku częściami bez wczytywania całości)."""
+    done = {}
+    try:
+        with open(_checkpoint_path(key), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue          # ucięta ostatnia linia po crashu
+                pairs = zip(rec["rows"], rec["results"])
+                done.update(pairs if rows is None else ((r, v) for r, v in pairs if r in rows))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def append_checkpoint(key, rows, results):
+    if not rows:
+        return
+    path = _checkpoint_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"rows": list(rows), "results": list(results)}, ensure_ascii=False) + "\n")
+
+
+def clear_checkpoint(key):
+    try:
+        os.remove(_checkpoint_path(key))
+    except FileNotFoundError:
+        pass
+
+
+# =========================================================
+# ZAPIS PRZYROSTOWY  (CSV albo Parquet, wiersz po wierszu na dysk)
+# =========================================================
+OUTPUTS_DIR = os.path.join(DATA_DIR, "outputs")
+OUTPUT_KEEP_DAYS = 7     # pliki wynikowe z przebiegów w aplikacji — potem sprzątane
+
+
+def output_path(name):
+    """Ścieżka pliku wynikowego w .seo_data/outputs/; przy okazji usuwa pliki starsze niż OUTPUT_KEEP_DAYS."""
+    os.makedirs(OUTPUTS_DIR, exist_ok=True)
+    cutoff = time.time() - OUTPUT_KEEP_DAYS * 86400
+    for old in os.scandir(OUTPUTS_DIR):
+        try:
+            if old.is_file() and old.stat().st_mtime < cutoff:
+                os.remove(old.path)
+        except OSError:
+            pass
+    return os.path.join(OUTPUTS_DIR, name)
+
+
+_URL_COLUMN_WORDS = {"url", "urls", "zrodlo", "cel", "link", "reprezentant"}
+
+
+def is_url_column(name):
+    """Kolumna z adresami (url, URL A, zrodlo, cel, link…) — mało unikalnych, długich wartości."""
+    return bool(_URL_COLUMN_WORDS & set(re.split(r"[^a-z0-9]+", str(name).lower())))
+
+
+def _as_int(v):
+    f = float(v)
+    if not f.is_integer():
+        raise ValueError(v)
+    return int(f)
+
+
+def _cast_cell(v, cast):
+    """Wartość komórki na typ kolumny Parquet; pusta (None/NaN/"") albo nieprzekładalna → None."""
+    if v is None or v != v:
+        return None
+    if cast is str:
+        return str(v)
+    try:
+        return cast(v)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class TableSink:
+    """
+    Zapis wierszy (dict) strumieniowo: .csv — nagłówek raz, potem dopisywanie;
+    .parquet — bufor i row group co rows_per_group wierszy (pyarrow ładowany leniwie).
+    Plik powstaje pod nazwą tymczasową i dopiero close() podmienia go na docelowy,
+    więc przerwane zadanie nie zostawia uciętego wyniku pod właściwą nazwą.
+    Kolumny z URL-ami (is_url_column) idą w Parquet jako słownik: każdy adres raz,
+    w wierszach tylko indeksy — a pd.read_parquet oddaje je jako category.
+    Schemat Parquet ustala pierwszy row group, a typy porcji z pandas potrafią się różnić
+    (int → float po pustej komórce, liczby → tekst) — dlatego text_columns (kolumny przepisywane
+    z wejścia) idą zawsze jako tekst, a w pozostałych wartości są rzutowane na typ ze schematu.
+    """
+
+    def __init__(self, path, columns, sep=",", rows_per_group=10_000, text_columns=()):
+        self.path, self.columns, self.sep = path, list(columns), sep
+        self.text_columns = set(text_columns)
+        self.fmt = "parquet" if path.lower().endswith(".parquet") else "csv"
+        self._tmp = path + ".part"
+        self._buf, self._rows_per_group = [], rows_per_group
+        self._writer = self._schema = None
+        self.rows = 0
+        if self.fmt == "csv":
+            self._fh = open(self._tmp, "w", newline="", encoding="utf-8-sig")
+            self._csv = csv.DictWriter(self._fh, self.columns, delimiter=sep, extrasaction="ignore")
+            self._csv.writeheader()
+
+    def write(self, records):
+        records = list(records)
+        self.rows += len(records)
+        if self.fmt == "csv":
+            self._csv.writerows(records)
+            self._fh.flush()
+            return
+        self._buf.extend(records)
+        if len(self._buf) >= self._rows_per_group:
+            self._flush_parquet()
+
+    def write_frame(self, df, chunk=50_000):
+        """DataFrame porcjami — bez pełnej kopii tekstowej/rekordowej w pamięci."""
+        for start in range(0, len(df), chunk):
+            part = df.iloc[start:start + chunk]
+            if self.fmt == "csv":
+                part.to_csv(self._fh, sep=self.sep, header=False, index=False, columns=self.columns,
+                            lineterminator="\r\n")    # jak csv.DictWriter nagłówka
+                self._fh.flush()
+                self.rows += len(part)
+            else:
+                self.write(part.to_dict("records"))
+
+    def _flush_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._schema is None:
+            self._schema = self._arrow_schema(pa, self._buf)
+            self._writer = pq.ParquetWriter(self._tmp, self._schema)
+        cols = {}
+        for f in self._schema:
+            if pa.types.is_string(f.type) or pa.types.is_dictionary(f.type):
+                cast = str
+            else:
+                cast = _as_int if pa.types.is_integer(f.type) else float
+            cols[f.name] = [_cast_cell(r.get(f.name), cast) for r in self._buf]
+        self._writer.write_table(pa.Table.from_pydict(cols, schema=self._schema))
+        self._buf = []
+
+    def _arrow_schema(self, pa, records):
+        """Typ kolumny z pierwszej niepustej wartości: float / int / reszta (i text_columns) jako string."""
+        fields = []
+        for c in self.columns:
+            if c in self.text_columns:
+                fields.append(pa.field(c, pa.dictionary(pa.int32(), pa.string()) if is_url_column(c) else pa.string()))
+                continue
+            # NaN z pandas (pusta komórka) nie przesądza o typie
+            v = next((r.get(c) for r in records if r.get(c) not in (None, "") and r.get(c) == r.get(c)), None)
+            if isinstance(v, float):
+                t = pa.float64()
+            elif isinstance(v, int) and not isinstance(v, bool):
+                t = pa.int64()
+            elif is_url_column(c):
+                t = pa.dictionary(pa.int32(), pa.string())
+            else:
+                t = pa.string()
+            fields.append(pa.field(c, t))
+        return pa.schema(fields)
+
+    def close(self):
+        if self.fmt == "csv":
+            self._fh.close()
+        else:
+            if self._buf or self._writer is None:
+                self._flush_parquet()
+            self._writer.close()
+        os.replace(self._tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """Zamyka bez podmiany — zostaje .part z tym, co zdążyło się zapisać."""
+        if self.fmt == "csv":
+            self._fh.close()
+        elif self._writer is not None:
+            self._writer.close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class OrderedRows:
+    """Wyniki przychodzą w dowolnej kolejności, do pliku idą w kolejności wejścia —
+    put(pozycja, rekord) wypycha najdłuższy gotowy ciąg od pierwszej niezapisanej pozycji.
+    flat=True → rekord to lista wierszy (np. wszystkie propozycje jednego źródła)."""
+
+    def __init__(self, sink, flat=False):
+        self.sink, self.flat, self.next, self._ready = sink, flat, 0, {}
+
+    @property
+    def count(self):
+        """Ile pozycji już dotarło (zapisanych + czekających na wcześniejsze)."""
+        return self.next + len(self._ready)
+
+    def put(self, pos, record):
+        self._ready[pos] = record
+        run = []
+        while self.next in self._ready:
+            rec = self._ready.pop(self.next)
+            if self.flat:
+                run.extend(rec)
+            else:
+                run.append(rec)
+            self.next += 1
+        if run:
+            self.sink.write(run)
+
+
+class LiveTable:
+    """
+    Podgląd długiego przebiegu w Streamlit: ostatnie wiersze tego, co już gotowe, czytane
+    z końca pliku zapisywanego przyrostowo (TableSink → path.part) — pamięć i dane do przeglądarki
+    nie rosną z rozmiarem wyniku. Zamiast pliku można podać rows= (lista dictów albo funkcja
+    ją zwracająca) dla małych wyników liczonych od nowa przy każdej porcji.
+    Pobranie częściowego wyniku tylko na żądanie: „Zatrzymaj” przerywa przebieg (checkpointy
+    zostają), a partial_download(key) po rerunie przygotowuje plik — jak na stronie kolejki.
+    """
+
+    TAIL_BYTES = 256 * 1024
+
+    def __init__(self, key, file_name, path=None, sep=",", preview_rows=200, every=5.0):
+        self.key, self.path, self.sep = key, path, sep
+        self.preview_rows, self.every = preview_rows, every
+        self._slot, self._ctl, self._last = st.empty(), st.empty(), 0.0
+        self._state = st.session_state[f"{key}_partial"] = {"file_name": file_name, "path": path,
+                                                            "sep": sep, "rows": None}
+        self._ctl.button("⏸ Zatrzymaj i pobierz to, co gotowe", key=f"{key}_stop",
+                         help="Przerywa przebieg — zapisany postęp zostaje, ponowne uruchomienie go wznowi.")
+
+    def _tail_rows(self):
+        src = _partial_source(self.path)
+        if src is None:
+            return None
+        with open(src, "rb") as f:
+            header = f.readline()
+            end = f.seek(0, os.SEEK_END)
+            start = max(len(header), end - self.TAIL_BYTES)
+            f.seek(start)
+            tail = f.read(end - start)
+        if start > len(header):
+            tail = tail[tail.find(b"\n") + 1:]          # pierwsza linia ucięta w połowie
+        tail = tail[:tail.rfind(b"\n") + 1]             # ostatnia może być w trakcie zapisu
+        text = (header + tail).decode("utf-8-sig", errors="replace")
+        return list(deque(csv.DictReader(io.StringIO(text), delimiter=self.sep), maxlen=self.preview_rows))
+
+    def update(self, caption, rows=None, force=False):
+        now = time.monotonic()
+        if not force and now - self._last < self.every:
+            return
+        self._last = now
+        if rows is None:
+            rows = self._tail_rows()
+            if rows is None:
+                return
+            caption += f" · ostatnie {len(rows)} wierszy"
+        else:
+            rows = self._state["rows"] = rows() if callable(rows) else rows
+            rows = rows[:self.preview_rows]
+        with self._slot.container():
+            st.caption(f"🔴 Na żywo: {caption}")
+            st.dataframe(rows, use_container_width=True)
+
+    def clear(self):
+        """Przebieg skończony — podgląd i przycisk znikają, częściowy wynik nie jest już potrzebny."""
+        self._slot.empty()
+        self._ctl.empty()
+        st.session_state.pop(f"{self.key}_partial", None)
+
+    @staticmethod
+    def partial_download(key):
+        """Po przerwanym przebiegu (przycisk albo błąd): „Przygotuj” → pobranie tego, co zdążyło się zapisać."""
+        state = st.session_state.get(f"{key}_partial")
+        if not state:
+            return
+        src = _partial_source(state["path"]) if state["path"] else None
+        if src is None and not state["rows"]:
+            return
+        st.warning("⏸ Przebieg przerwany — można pobrać to, co zdążyło się policzyć, albo uruchomić ponownie.")
+        if st.button("Przygotuj częściowy wynik", key=f"{key}_prep"):
+            if src is not None:
+                with open(src, "rb") as f:
+                    payload = f.read()
+                state["payload"] = payload[:payload.rfind(b"\n") + 1]
+            else:
+                buf = io.StringIO()
+                w = csv.DictWriter(buf, list(state["rows"][0]), delimiter=state["sep"])
+                w.writeheader()
+                w.writerows(state["rows"])
+                state["payload"] = buf.getvalue().encode("utf-8-sig")
+        if state.get("payload"):
+            st.download_button("📥 Pobierz częściowy wynik", state["payload"], "czesciowy_" + state["file_name"],
+                               key=f"{key}_dl", on_click="ignore")
+
+
+def _partial_source(path):
+    return next((p for p in (path + ".part", path) if os.path.exists(p)), None)
+
+
+def save_table(src, path, sep=",", src_sep=",", chunk=50_000):
+    """
+    Tabela → plik .csv / .parquet (wg rozszerzenia) porcjami przez TableSink.
+    src: DataFrame albo ścieżka CSV (czytana po `chunk` wierszy, wszystko jako tekst).
+    """
+    import pandas as pd
+
+    if isinstance(src, str):
+        parts = pd.read_csv(src, sep=src_sep, dtype=str, keep_default_na=False,
+                            encoding="utf-8-sig", chunksize=chunk)
+    else:
+        parts = iter([src])
+    first = next(parts, None)
+    if first is None:
+        raise ValueError("Pusta tabela.")
+    with TableSink(path, list(first.columns), sep=sep, text_columns=first.columns) as sink:
+        for part in chain([first], parts):
+            sink.write_frame(part, chunk)
+    return path
+
+
+def load_table(file, sep=None):
+    """Wczytuje zapisany wynik (.csv albo .parquet; ścieżka albo plik z st.file_uploader).
+    sep=None → separator CSV zgadywany z nagłówka (; albo ,)."""
+    import pandas as pd
+
+    name = str(getattr(file, "name", file)).lower()
+    if name.endswith(".parquet"):
+        return pd.read_parquet(file)
+    if sep is None:
+        head = file.readline() if hasattr(file, "readline") else open(file, "rb").readline()
+        if hasattr(file, "seek"):
+            file.seek(0)
+        head = head.decode("utf-8-sig", errors="replace") if isinstance(head, bytes) else head
+        sep = ";" if head.count(";") > head.count(",") else ","
+    return pd.read_csv(file, sep=sep, encoding="utf-8-sig")
+
+
+def _table_token(src):
+    """Ślad wyniku: plik → mtime i rozmiar, DataFrame → hash zawartości (id, gdy się nie da)."""
+    if isinstance(src, str):
+        info = os.stat(src)
+        return (src, info.st_mtime, info.st_size)
+    import pandas as pd
+    try:
+        return (tuple(map(str, src.columns)), len(src), int(pd.util.hash_pandas_object(src, index=False).sum()))
+    except TypeError:
+        return (id(src), len(src))
+
+
+def session_file(key, ext):
+    """Plik eksportu w outputs/ — jeden na klucz i sesję przeglądarki (nadpisywany, nie mnożony)."""
+    sid = state_dict("_session_id", lambda: [uuid.uuid4().hex[:8]])[0]
+    return output_path(f"{key}_{sid}.{ext}")
+
+
+def table_download(src, file_name, key=None, sep=";", src_sep=","):
+    """
+    Przyciski „CSV” i „Parquet” dla tabeli wyniku (DataFrame albo ścieżka CSV).
+    Eksport powstaje dopiero po „Przygotuj …” — porcjami (save_table), zawsze do tego samego
+    pliku dla klucza i sesji, więc rerun czy każda litera w filtrze nie zapisują ani nie czytają
+    niczego z dysku. Gotowy plik jest do pobrania, dopóki tabela się nie zmieni (_table_token);
+    potem znów „Przygotuj”. Parquet: URL-e jako słownik, typy kolumn zachowane.
+    Kliknięcie pobrania nie robi reruna (on_click="ignore").
+    """
+    stem = os.path.splitext(file_name)[0]
+    key = key or stem
+    ready = state_dict("_table_exports")     # {(klucz, format): (ślad tabeli, ścieżka)}
+    token = []                               # ślad liczony leniwie — hash dużej tabeli nie jest darmowy
+
+    def current():
+        if not token:
+            token.append(_table_token(src))
+        return token[0]
+
+    c_csv, c_pq = st.columns(2)
+    for fmt, col in (("csv", c_csv), ("parquet", c_pq)):
+        if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            col.caption("Parquet wymaga pakietu `pyarrow`.")
+            continue
+        got = ready.get((key, fmt))
+        if got is None or got[0] != current() or not os.path.exists(got[1]):
+            if not col.button(f"Przygotuj {fmt.upper()}", key=f"{key}_prep_{fmt}", use_container_width=True):
+                continue
+            if fmt == "csv" and isinstance(src, str) and sep == src_sep:
+                path = src          # plik wyniku już jest CSV — bez kopiowania
+            else:
+                path = save_table(src, session_file(key, fmt), sep=sep, src_sep=src_sep)
+            got = ready[(key, fmt)] = (current(), path)
+        with open(got[1], "rb") as f:
+            col.download_button(f"📥 Pobierz {fmt.upper()}", f, f"{stem}.{fmt}",
+                                "text/csv" if fmt == "csv" else "application/vnd.apache.parquet",
+                                key=f"{key}_{fmt}", on_click="ignore", use_container_width=True)
+
+
+def filter_table(df, key):
+    """Filtr tekstowy nad wczytanym/gotowym wynikiem: wiersze, w których któraś kolumna tekstowa zawiera frazę."""
+    q = st.text_input("🔎 Filtruj wiersze (fragment tekstu / URL-a)", key=f"{key}_filter").strip().lower()
+    if not q:
+        return df
+    mask = None
+    for c in df.columns:
+        if df[c].dtype == object or str(df[c].dtype) == "category":
+            m = df[c].astype(str).str.lower().str.contains(q, regex=False)
+            mask = m if mask is None else (mask | m)
+    return df if mask is None else df[mask]
+
+
+def result_file_uploader(key, label="📂 Wczytaj zapisany wynik (.csv / .parquet)"):
+    """Uploader poprzedniego wyniku → DataFrame tylko raz, zaraz po wgraniu nowego pliku
+    (kolejne reruny → None, więc wczytany wynik nie nadpisuje świeżo policzonego).
+    Błąd odczytu pokazuje na stronie."""
+    up = st.file_uploader(label, type=["csv", "parquet"], key=key)
+    if up is None:
+        st.session_state.pop(f"{key}_id", None)
+        return None
+    if st.session_state.get(f"{key}_id") == (up.name, up.size):
+        return None
+    st.session_state[f"{key}_id"] = (up.name, up.size)
+    try:
+        return load_table(up)
+    except Exception as e:
+        st.error(f"Nie udało się wczytać pliku: {e}")
+        return None
+
+
+def result_browser(key, file_name, sep=";"):
+    """Przegląd zapisanego wyniku dowolnego narzędzia: wczytanie .csv/.parquet, filtr, tabela, eksport."""
+    df = result_file_uploader(f"{key}_up")
+    if df is not None:
+        st.session_state[f"{key}_df"] = df
+    df = st.session_state.get(f"{key}_df")
+    if df is None:
+        return
+    view = filter_table(df, key)
+    st.caption(f"{len(view)} z {len(df)} wierszy")
+    st.dataframe(view, use_container_width=True)
+    table_download(view, file_name, key=f"{key}_dl", sep=sep)
 
 
 # =========================================================
@@ -228,6 +1491,46 @@ def _title_h1_raw(url):
     return f"{t} {h}".strip()
 
 
+def _meta_raw(url, timeout=8):
+    """Title + H1 + meta description. Błąd pobrania → {"error": powód} zamiast cichego None."""
+    try:
+        r = requests.get(url, headers=HEADERS, timeout=timeout)
+    except requests.Timeout:
+        return {"error": "timeout"}
+    except requests.RequestException as e:
+        return {"error": type(e).__name__}
+    if r.status_code != 200:
+        return {"error": f"HTTP {r.status_code}"}
+    r.encoding = r.apparent_encoding or r.encoding
+    soup = BeautifulSoup(r.text, "html.parser")
+    title = soup.title.get_text(strip=True) if soup.title else ""
+    h1 = soup.find("h1")
+    h1 = h1.get_text(strip=True) if h1 else ""
+    meta = soup.find("meta", attrs={"name": re.compile(r"^description$", re.I)})
+    desc = (meta.get("content") or "").strip() if meta else ""
+    return {"title": title, "h1": h1, "desc": desc}
+
+
+def _clean_text_raw(url, max_chars=20000):
+    """Cały tekst strony bez script/style/nav/footer/header/form (macierz cosinusów URL)."""
+    html = _fetch_html(url, timeout=10)
+    if not html:
+        return None
+    soup = BeautifulSoup(html, "html.parser")
+    for el in soup(["script", "style", "nav", "footer", "header", "form"]):
+        el.decompose()
+    text = " ".join(soup.get_text(separator=" ").split())
+    return text[:max_chars] if len(text) > 100 else None
+
+
+def meta_text(payload, min_chars=10):
+    """Tekst do embeddingu z _meta_raw (Title + H1 + Description) albo None, gdy błąd / za krótki."""
+    if not payload or payload.get("error"):
+        return None
+    t = " ".join(f"{payload['title']} {payload['h1']} {payload['desc']}".split())
+    return t if len(t) > min_chars else None
+
+
 def _parallel_map(fn, items, max_workers=8, progress=None):
     out = {}
     if not items:
@@ -248,8 +1551,8 @@ def _parallel_map(fn, items, max_workers=8, progress=None):
 
 
 def scrape_texts(urls, progress=None, max_chars=20000):
-    """Treść główna dla listy URL-i. Cache w session_state, scraping równoległy."""
-    cache = st.session_state.setdefault("_scrape_cache", {})
+    """Treść główna dla listy URL-i. Cache w stanie sesji, scraping równoległy."""
+    cache = state_dict("_scrape_cache")
     todo = [u for u in urls if u not in cache]
     if todo:
         cache.update(
@@ -261,7 +1564,7 @@ def scrape_texts(urls, progress=None, max_chars=20000):
 
 def scrape_topics(urls, progress=None):
     """Title + H1 (lekkie 'o czym jest strona') dla listy URL-i."""
-    cache = st.session_state.setdefault("_topic_cache", {})
+    cache = state_dict("_topic_cache")
     todo = [u for u in urls if u not in cache]
     if todo:
         cache.update(_parallel_map(_title_h1_raw, todo, progress=progress))
@@ -270,7 +1573,7 @@ def scrape_topics(urls, progress=None):
 
 def scrape_sources(urls, progress=None, max_chars=20000):
     """Dla źródeł: {url: {'text': ..., 'links': {norm_url: anchor}}}. Cache + równolegle."""
-    cache = st.session_state.setdefault("_source_cache", {})
+    cache = state_dict("_source_cache")
     todo = [u for u in urls if u not in cache]
     if todo:
         cache.update(
@@ -280,19 +1583,648 @@ def scrape_sources(urls, progress=None, max_chars=20000):
     return {u: cache.get(u) for u in urls}
 
 
+# =========================================================
+# TRWAŁY CACHE EMBEDDINGÓW I STRON  (ta sama baza .seo_data/cache.sqlite)
+# =========================================================
+# Embeddingi: klucz = model + tekst, wektor float32 jako BLOB — ten sam tekst
+# nigdy nie jest embedowany dwa razy, także po restarcie serwera.
+# Strony: wynik scrapera per (rodzaj, URL) z TTL — tylko tam, gdzie wywołujący
+# tego chce (audyty zmian treści, jak Site Focus, pobierają zawsze na świeżo).
+EMB_CACHE = {"enabled": True, "max_entries": 100_000}
+_SQL_CHUNK = 500  # limit parametrów w jednym IN (...)
+
+
+def _emb_key(model, text):
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+def emb_cache_get_many(model, texts):
+    """{tekst: wektor} dla tekstów, które już są w cache."""
+    if not EMB_CACHE["enabled"] or not texts:
+        return {}
+    keys = {_emb_key(model, t): t for t in texts}
+    out, conn, ks = {}, _db(), list(keys)
+    for i in range(0, len(ks), _SQL_CHUNK):
+        part = ks[i:i + _SQL_CHUNK]
+        q = f"SELECT key, vec FROM emb_cache WHERE key IN ({','.join('?' * len(part))})"
+        for k, blob in conn.execute(q, part):
+            out[keys[k]] = np.frombuffer(blob, dtype=np.float32).copy()
+    return out
+
+
+def emb_cache_put_many(model, texts, vecs):
+    if not EMB_CACHE["enabled"] or not texts:
+        return
+    now = time.time()
+    conn = _db()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO emb_cache VALUES (?, ?, ?)",
+                         [(_emb_key(model, t), np.asarray(v, dtype=np.float32).tobytes(), now)
+                          for t, v in zip(texts, vecs)])
+        n = conn.execute("SELECT COUNT(*) FROM emb_cache").fetchone()[0]
+        if n > EMB_CACHE["max_entries"]:
+            conn.execute("DELETE FROM emb_cache WHERE key IN "
+                         "(SELECT key FROM emb_cache ORDER BY created LIMIT ?)", (n - EMB_CACHE["max_entries"],))
+
+
+def page_cache_get_many(kind, urls, ttl_days):
+    """{url: wynik scrapera} pobrany nie dawniej niż ttl_days temu."""
+    out, conn, urls = {}, _db(), list(urls)
+    oldest = time.time() - ttl_days * 86400
+    for i in range(0, len(urls), _SQL_CHUNK):
+        part = urls[i:i + _SQL_CHUNK]
+        q = (f"SELECT url, payload FROM page_cache WHERE kind = ? AND created >= ? "
+             f"AND url IN ({','.join('?' * len(part))})")
+        for u, payload in conn.execute(q, [kind, oldest, *part]):
+            out[u] = json.loads(payload)
+    return out
+
+
+def page_cache_put_many(kind, payloads):
+    now = time.time()
+    with _db() as conn:
+        conn.executemany("INSERT OR REPLACE INTO page_cache VALUES (?, ?, ?, ?)",
+                         [(kind, u, json.dumps(p, ensure_ascii=False), now) for u, p in payloads.items()])
+
+
+def _embed_cached(client, texts, model=EMBED_MODEL):
+    """Batch embeddingów przez trwały cache: do API idą tylko teksty, których jeszcze nie ma."""
+    found = emb_cache_get_many(model, texts)
+    todo = [t for t in texts if t not in found]
+    if todo:
+        vecs = _embed_batch(client, todo, model)
+        emb_cache_put_many(model, todo, vecs)
+        found.update(zip(todo, vecs))
+    return [found[t] for t in texts]
+
+
 # =========================================================
 # EMBEDDINGI  (batch + dedup + cache → dużo taniej i szybciej)
 # =========================================================
+EMBED_BATCH_TOKENS = 120_000   # limit API to 300k tokenów na request — bierzemy z zapasem
+EMBED_BATCH_MAX = 256
+
+
+def estimate_tokens(text):
+    # zgrubnie, bez tokenizera: ~3 znaki na token dla polskiego tekstu
+    return len(text) // 3 + 1
+
+
+def _pack_batches(texts):
+    """Dzieli teksty na batche wg szacowanej liczby tokenów (a nie sztywno po 100 sztuk)."""
+    batch, tokens = [], 0
+    for t in texts:
+        n = estimate_tokens(t)
+        if batch and (tokens + n > EMBED_BATCH_TOKENS or len(batch) >= EMBED_BATCH_MAX):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(t)
+        tokens += n
+    if batch:
+        yield batch
+
+
+def _embed_batch(client, texts, model=EMBED_MODEL):
+    resp = client.embeddings.create(input=texts, model=model)
+    return [np.array(d.embedding, dtype=np.float32) for d in resp.data]
+
+
 def embed_texts(client, texts, model=EMBED_MODEL, progress=None):
-    cache = st.session_state.setdefault("_emb_cache", {})
+    cache = state_dict("_emb_cache")
     norm = [t if isinstance(t, str) and t.strip() else " " for t in texts]
     todo = list({t for t in norm if t not in cache})
-    B = 100
-    for i in range(0, len(todo), B):
-        chunk = todo[i:i + B]
-        resp = client.embeddings.create(input=chunk, model=model)
-        for t, d in zip(chunk, resp.data):
-            cache[t] = np.array(d.embedding, dtype=np.float32)
+    done = 0
+    cache.update(emb_cache_get_many(model, todo))
+    todo = [t for t in todo if t not in cache]
+    for chunk in _pack_batches(todo):
+        cache.update(zip(chunk, _embed_cached(client, chunk, model)))
+        done += len(chunk)
         if progress:
-            progress(min((i + B) / max(len(todo), 1), 1.0))
+            progress(done / max(len(todo), 1))
     return np.array([cache[t] for t in norm])
+
+
+# =========================================================
+# POTOK  scraping → embeddingi  (oba etapy naraz, zamiast jeden po drugim)
+# =========================================================
+def pipeline_map(items, fetch, process, to_process=None, batch_full=None,
+                 fetch_workers=8, process_workers=2, progress=None, on_batch=None):
+    """
+    Dwuetapowy potok producent/konsument.
+    Etap 1: fetch(item) równolegle w puli wątków. Wynik trafia do bufora
+    (to_process(item, wynik) → wartość albo None = pomiń); gdy batch_full(bufor)
+    albo etap 1 się skończył, bufor leci do etapu 2: process([(item, wartość), ...])
+    → {item: wynik} w osobnej puli. Sieć i API pracują jednocześnie.
+
+    Pętla sterująca działa w wątku głównym → progress(fetched, processed, total)
+    może bezpiecznie rysować w Streamlit; tak samo on_batch({item: wynik}) po każdym
+    batchu etapu 2 (podgląd wyników na żywo). Zwraca (fetched, processed, errors):
+    wyniki etapu 1, wyniki etapu 2 i {item: komunikat} dla batchy, które padły.
+    """
+    to_process = to_process or (lambda it, res: res)
+    batch_full = batch_full or (lambda buf: len(buf) >= 50)
+    items = list(dict.fromkeys(items))
+    fetched, processed, errors = {}, {}, {}
+    total, n_fetched, n_processed = len(items), 0, 0
+    if not items:
+        return fetched, processed, errors
+
+    buf = []
+    # pobrania zlecane porcjami (2× liczba wątków w locie) — wyjątek z progress/on_batch
+    # (np. anulowanie zadania) nie czeka na pobranie całej reszty listy
+    todo, n_fetching = iter(items), 0
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fex, \
+            ThreadPoolExecutor(max_workers=process_workers) as pex:
+        pending = {}
+        while True:
+            for it in islice(todo, 2 * fetch_workers - n_fetching):
+                pending[fex.submit(fetch, it)] = ("fetch", it)
+                n_fetching += 1
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                stage, payload = pending.pop(fut)
+                if stage == "fetch":
+                    n_fetching -= 1
+                    try:
+                        res = fut.result()
+                    except Exception:
+                        res = None
+                    fetched[payload] = res
+                    n_fetched += 1
+                    val = to_process(payload, res) if res is not None else None
+                    if val is None:
+                        n_processed += 1          # nie ma czego przetwarzać → etap 2 "zaliczony"
+                    else:
+                        buf.append((payload, val))
+                else:
+                    try:
+                        got = fut.result()
+                    except Exception as e:
+                        errors.update({it: str(e) for it in payload})
+                    else:
+                        processed.update(got)
+                        if on_batch:
+                            on_batch(got)
+                    n_processed += len(payload)
+            if buf and (batch_full(buf) or n_fetched == total):
+                pending[pex.submit(process, buf)] = ("process", [it for it, _ in buf])
+                buf = []
+            if progress:
+                progress(n_fetched, n_processed, total)
+    return fetched, processed, errors
+
+
+_EXTRACTORS = {
+    # kind: (funkcja pobierająca, klucz cache w stanie sesji, tekst do embeddingu)
+    "text": (_extract_main_content_raw, "_scrape_cache", lambda p: p),
+    "source": (_extract_source_raw, "_source_cache", lambda p: p.get("text")),
+    "topic": (_title_h1_raw, "_topic_cache", lambda p: p),
+    "meta": (_meta_raw, "_meta_cache", meta_text),
+    "clean": (_clean_text_raw, "_clean_cache", lambda p: p),
+}
+
+
+def scrape_and_embed(client, urls, kind="text", embed_chars=None, model=EMBED_MODEL, progress=None,
+                     page_ttl_days=None, on_vectors=None):
+    """
+    Scraping + embeddingi w jednym potoku: teksty trafiają do batchy (pakowanych
+    wg tokenów) od razu, gdy się uzbiera ich wystarczająco — nie czekamy na
+    pobranie wszystkich URL-i. kind: "text" (treść główna), "source" (treść + linki),
+    "topic" (Title + H1), "meta" (Title + H1 + Description, błędy jako {"error": ...}). Cache scrapingu i embeddingów wspólny z scrape_*/embed_texts.
+
+    Zwraca (payloads, vecs, errors): {url: wynik scrapera albo None},
+    {url: wektor} dla stron z tekstem i {url: błąd} dla nieudanych batchy embeddingów.
+    Embeddingi zawsze idą przez trwały cache; page_ttl_days=N → strony pobrane w ciągu
+    ostatnich N dni też biorą się z dysku (bez sieci).
+    on_vectors({url: wektor}) po każdym batchu embeddingów (wątek główny).
+    """
+    extract, cache_key, text_of = _EXTRACTORS[kind]
+    page_cache = state_dict(cache_key)
+    emb_cache = state_dict("_emb_cache")
+    if page_ttl_days:
+        page_cache.update(page_cache_get_many(kind, [u for u in urls if u not in page_cache], page_ttl_days))
+
+    def fetch(u):
+        return page_cache[u] if u in page_cache else extract(u)
+
+    def to_process(u, payload):
+        t = text_of(payload)
+        if not t or not t.strip():
+            return None
+        return t[:embed_chars] if embed_chars else t
+
+    def process(batch):
+        todo = list(dict.fromkeys(t for _, t in batch if t not in emb_cache))
+        if todo:
+            emb_cache.update(zip(todo, _embed_cached(client, todo, model)))
+        return {u: emb_cache[t] for u, t in batch}
+
+    def batch_full(buf):
+        return (sum(estimate_tokens(t) for _, t in buf) >= EMBED_BATCH_TOKENS // 2
+                or len(buf) >= EMBED_BATCH_MAX)
+
+    payloads, vecs, errors = pipeline_map(urls, fetch, process, to_process=to_process,
+                                          batch_full=batch_full, progress=progress, on_batch=on_vectors)
+    # nieudane pobrania nie idą do cache — kolejne uruchomienie spróbuje jeszcze raz
+    ok = {u: p for u, p in payloads.items()
+          if p is not None and not (isinstance(p, dict) and p.get("error")) and page_cache.get(u) is not p}
+    page_cache.update(ok)
+    if page_ttl_days and ok:
+        page_cache_put_many(kind, ok)
+    return payloads, vecs, errors
+
+
+def stage_progress(report, fetch_label="Pobieranie", process_label="Embeddingi"):
+    """Callback dla pipeline_map/scrape_and_embed → report(tekst, ułamek 0–1) dla obu etapów naraz.
+    report=None → None (bez raportowania)."""
+    if report is None:
+        return None
+
+    def _cb(fetched, processed, total):
+        report(f"{fetch_label}: {fetched}/{total} · {process_label}: {processed}/{total}",
+               (fetched + processed) / (2 * total))
+    return _cb
+
+
+def pipeline_progress(pb, fetch_label="Pobieranie", process_label="Embeddingi"):
+    """Callback dla pipeline_map/scrape_and_embed rysujący oba etapy na jednym st.progress."""
+    return stage_progress(lambda text, frac: pb.progress(frac, text=text), fetch_label, process_label)
+
+
+# =========================================================
+# PODOBIEŃSTWO  (blokowo — nigdy nie budujemy gęstej macierzy n×n)
+# =========================================================
+def _unit_rows(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+
+# Tryb szybki (prefiks): pierwszy przebieg liczy cosinus tylko na pierwszych PREFIX_DIMS
+# wymiarach (znormalizowanych) — text-embedding-3 są trenowane "Matryoshka", więc pierwsze
+# wymiary niosą większość informacji, a GEMM jest ~6× tańszy. Przebieg szuka kandydatów
+# z zapasem PREFIX_MARGIN, a wynik każdej pary z listy jest liczony DOKŁADNIE na pełnych wektorach.
+PREFIX_DIMS = 256
+PREFIX_MARGIN = 0.05
+
+
+def prefix_rows(unit, dims=PREFIX_DIMS):
+    """Prefiks `dims` pierwszych wymiarów, ponownie znormalizowany (krótsze wektory → bez zmian)."""
+    return _unit_rows(unit[:, :dims]) if dims < unit.shape[1] else unit
+
+
+def _exact_scores(unit, rows, cols, chunk=65536):
+    out = np.empty(len(rows), dtype=np.float32)
+    for k in range(0, len(rows), chunk):
+        out[k:k + chunk] = np.einsum("ij,ij->i", unit[rows[k:k + chunk]], unit[cols[k:k + chunk]])
+    return out
+
+
+def iter_similar_pairs(vecs, threshold, block_size=512, prefilter=False):
+    """
+    Pary (i < j) z cosinusem >= threshold, liczone blokami wierszy.
+    Generator bloków (i, j, score) jako tablice numpy — w pamięci jest naraz
+    tylko pas [block_size × n], a nie cała macierz.
+    prefilter=True → kandydaci z prefiksu PREFIX_DIMS wymiarów, wyniki i tak dokładne.
+    """
+    unit = _unit_rows(vecs)
+    n = len(unit)
+    if prefilter:
+        head = prefix_rows(unit)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        if prefilter:
+            approx = head[start:stop] @ head[start:].T
+            r, c = np.nonzero(approx >= threshold - PREFIX_MARGIN)
+        else:
+            sims = unit[start:stop] @ unit[start:].T   # tylko kolumny >= start (górny trójkąt)
+            r, c = np.nonzero(sims >= threshold)
+        keep = c > r                                # bez przekątnej i bez duplikatów (j > i)
+        r, c = r[keep], c[keep]
+        if prefilter:
+            scores = _exact_scores(unit, r + start, c + start)   # rescoring na pełnych wektorach
+            keep = scores >= threshold
+            r, c, scores = r[keep], c[keep], scores[keep]
+        else:
+            scores = sims[r, c].astype(np.float32)
+        if len(r):
+            yield (r + start).astype(np.int32), (c + start).astype(np.int32), scores
+
+
+def iter_top_similar(src_vecs, tgt_vecs, k, min_sim=0.0, block_size=512, prefilter=False):
+    """
+    Dla każdego wiersza src: do k najbliższych celów z cosinusem >= min_sim,
+    malejąco. Generator (i, [(j, score), ...]) liczony blokami (bez macierzy n_src × n_tgt).
+    prefilter=True → wstępna lista z prefiksu (z zapasem), potem dokładny rescoring i cięcie do k.
+    """
+    src, tgt = _unit_rows(src_vecs), _unit_rows(tgt_vecs)
+    n_tgt = len(tgt)
+    if prefilter:
+        s_head, t_head = prefix_rows(src), prefix_rows(tgt)
+        pool = min(n_tgt, 4 * k + 16)   # zapas kandydatów na błąd prefiksu
+    else:
+        pool = min(n_tgt, k)
+    for start in range(0, len(src), block_size):
+        stop = min(start + block_size, len(src))
+        if prefilter:
+            sims = s_head[start:stop] @ t_head.T
+        else:
+            sims = src[start:stop] @ tgt.T
+        idx = np.argpartition(-sims, pool - 1, axis=1)[:, :pool] if pool < n_tgt \
+            else np.tile(np.arange(n_tgt), (stop - start, 1))
+        for r in range(stop - start):
+            cand = idx[r]
+            scores = src[start + r] @ tgt[cand].T if prefilter else sims[r, cand]
+            order = np.argsort(-scores)[:k]
+            picks = [(int(cand[o]), float(scores[o])) for o in order if scores[o] >= min_sim]
+            yield start + r, picks
+
+
+def prefilter_recall(vecs, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9), sample=2000, seed=0):
+    """
+    Recall trybu szybkiego (prefiks) względem dokładnego, na losowej próbce (max `sample` wektorów).
+    Precyzja zawsze = 1 (każda para jest rescorowana), więc liczy się tylko recall.
+    """
+    vecs = np.asarray(vecs, dtype=np.float32)
+    if len(vecs) > sample:
+        vecs = vecs[np.random.default_rng(seed).choice(len(vecs), sample, replace=False)]
+    out = []
+    for th in thresholds:
+        exact = {(i, j) for ii, jj, _ in iter_similar_pairs(vecs, th)
+                 for i, j in zip(ii.tolist(), jj.tolist())}
+        fast = {(i, j) for ii, jj, _ in iter_similar_pairs(vecs, th, prefilter=True)
+                for i, j in zip(ii.tolist(), jj.tolist())}
+        out.append({"threshold": th, "exact_pairs": len(exact), "found": len(exact & fast),
+                    "recall": len(exact & fast) / len(exact) if exact else 1.0})
+    return out
+
+
+def prefilter_topk_recall(src_vecs, tgt_vecs, k, min_sim=0.0, sample=300, seed=0):
+    """Recall@k trybu szybkiego (udział dokładnych top-k odnalezionych przez tryb szybki), na próbce źródeł."""
+    src_vecs = np.asarray(src_vecs, dtype=np.float32)
+    if len(src_vecs) > sample:
+        src_vecs = src_vecs[np.random.default_rng(seed).choice(len(src_vecs), sample, replace=False)]
+    exact = {(i, j) for i, picks in iter_top_similar(src_vecs, tgt_vecs, k, min_sim) for j, _ in picks}
+    fast = {(i, j) for i, picks in iter_top_similar(src_vecs, tgt_vecs, k, min_sim, prefilter=True)
+            for j, _ in picks}
+    return len(exact & fast) / len(exact) if exact else 1.0
+
+
+def _find(parent, x):
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]   # path halving
+        x = parent[x]
+    return x
+
+
+def cannibalization_groups(n, pair_blocks):
+    """
+    Grupy kanibalizacji = spójne składowe grafu podobieństwa (union-find).
+    Krawędzie przychodzą strumieniem (np. z iter_similar_pairs) i nie są
+    nigdzie przechowywane — per węzeł trzymamy tylko stopień i sumę wag,
+    z czego na końcu wychodzi gęstość i średnie podobieństwo w grupie.
+
+    Zwraca listę dictów (od największej grupy):
+      representative — URL-indeks o największej sumie podobieństw w grupie,
+      members, size, edges, density (krawędzie / wszystkie możliwe pary), mean_sim.
+    """
+    parent = list(range(n))
+    degree = np.zeros(n, dtype=np.int64)
+    strength = np.zeros(n, dtype=np.float64)
+
+    for ii, jj, ss in pair_blocks:
+        np.add.at(degree, ii, 1)
+        np.add.at(degree, jj, 1)
+        np.add.at(strength, ii, ss)
+        np.add.at(strength, jj, ss)
+        for a, b in zip(ii.tolist(), jj.tolist()):
+            ra, rb = _find(parent, a), _find(parent, b)
+            if ra != rb:
+                parent[rb] = ra
+
+    members = {}
+    for x in range(n):
+        if degree[x]:
+            members.setdefault(_find(parent, x), []).append(x)
+
+    groups = []
+    for m in members.values():
+        size = len(m)
+        edges = int(degree[m].sum()) // 2
+        groups.append({
+            "representative": m[int(np.argmax(strength[m]))],
+            "members": m,
+            "size": size,
+            "edges": edges,
+            "density": edges / (size * (size - 1) / 2),
+            "mean_sim": float(strength[m].sum()) / 2 / max(edges, 1),
+        })
+    groups.sort(key=lambda g: (-g["size"], -g["mean_sim"]))
+    return groups
+
+
+# =========================================================
+# EKSPORT GRAFU PODOBIEŃSTW  (CSR .npz / Parquet: słownik URL + int32 + float16)
+# =========================================================
+# Bloki (i, j, score) muszą przychodzić w kolejności wierszy — tak jak z
+# iter_similar_pairs. Indeksy i wyniki lecą od razu na dysk, w pamięci
+# zostaje tylko licznik par na wiersz (indptr).
+def _npz_put(zf, name, arr):
+    with zf.open(f"{name}.npy", "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asarray(arr), allow_pickle=False)
+
+
+def _npz_put_raw(zf, name, dtype, count, src_path):
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+              "fortran_order": False, "shape": (count,)}
+    with zf.open(f"{name}.npy", "w", force_zip64=True) as f, open(src_path, "rb") as src:
+        np.lib.format.write_array_header_1_0(f, header)
+        shutil.copyfileobj(src, f, 1 << 20)
+
+
+def _write_graph_npz(path, row_urls, col_urls, pair_blocks):
+    counts = np.zeros(len(row_urls), dtype=np.int64)
+    nnz = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        idx_path, val_path = os.path.join(tmp, "indices"), os.path.join(tmp, "data")
+        with open(idx_path, "wb") as f_idx, open(val_path, "wb") as f_val:
+            for ii, jj, ss in pair_blocks:
+                counts += np.bincount(ii, minlength=len(row_urls))
+                np.asarray(jj, dtype=np.int32).tofile(f_idx)
+                np.asarray(ss, dtype=np.float16).tofile(f_val)
+                nnz += len(jj)
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            _npz_put(zf, "indptr", np.concatenate([[0], np.cumsum(counts)]))
+            _npz_put(zf, "row_urls", np.array(row_urls, dtype=str))
+            if col_urls is not None:
+                _npz_put(zf, "col_urls", np.array(col_urls, dtype=str))
+            _npz_put_raw(zf, "indices", np.int32, nnz, idx_path)
+            _npz_put_raw(zf, "data", np.float16, nnz, val_path)
+    return nnz
+
+
+def _write_graph_parquet(path, row_urls, col_urls, pair_blocks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    meta = {b"row_urls": json.dumps(row_urls, ensure_ascii=False).encode("utf-8")}
+    if col_urls is not None:
+        meta[b"col_urls"] = json.dumps(col_urls, ensure_ascii=False).encode("utf-8")
+    schema = pa.schema([("src", pa.int32()), ("dst", pa.int32()), ("score", pa.float16())],
+                       metadata=meta)
+    nnz = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as w:
+        for ii, jj, ss in pair_blocks:
+            w.write_table(pa.table({
+                "src": pa.array(np.asarray(ii, dtype=np.int32)),
+                "dst": pa.array(np.asarray(jj, dtype=np.int32)),
+                "score": pa.array(np.asarray(ss, dtype=np.float16)),
+            }, schema=schema))   # jeden row group na blok
+            nnz += len(jj)
+    return nnz
+
+
+def write_similarity_graph(path, row_urls, pair_blocks, col_urls=None, fmt="npz"):
+    """
+    Zapisuje graf podobieństw strumieniowo. col_urls=None → graf kwadratowy
+    (wiersze i kolumny to te same URL-e, zapisany tylko górny trójkąt).
+    Zwraca liczbę zapisanych par.
+    """
+    writer = _write_graph_parquet if fmt == "parquet" else _write_graph_npz
+    return writer(path, list(row_urls), None if col_urls is None else list(col_urls), pair_blocks)
+
+
+def similarity_graph_file(key, row_urls, pair_blocks, col_urls=None, fmt="npz"):
+    """
+    Jak write_similarity_graph, do pliku eksportu sesji (session_file) — pary idą na dysk
+    blokami, a strona trzyma tylko ścieżkę, nie bajty całego grafu. Zapis obok i os.replace,
+    więc poprzedni eksport pod tym kluczem jest podmieniany dopiero gotowym plikiem.
+    """
+    path = session_file(key, fmt)
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        write_similarity_graph(tmp, row_urls, pair_blocks, col_urls=col_urls, fmt=fmt)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+def load_similarity_graph(file):
+    """
+    Wczytuje graf zapisany przez write_similarity_graph (ścieżka albo plik z
+    st.file_uploader). Zwraca {row_urls, col_urls, square, src, dst, score};
+    square=True → graf kwadratowy (te same URL-e w wierszach i kolumnach).
+    """
+    name = str(getattr(file, "name", file))
+    if name.lower().endswith(".parquet"):
+        import pyarrow.parquet as pq
+        t = pq.read_table(file)
+        meta = t.schema.metadata or {}
+        row_urls = json.loads(meta[b"row_urls"])
+        square = b"col_urls" not in meta
+        col_urls = row_urls if square else json.loads(meta[b"col_urls"])
+        src = t.column("src").to_numpy()
+        dst = t.column("dst").to_numpy()
+        score = t.column("score").to_numpy().astype(np.float32)
+    else:
+        with np.load(file, allow_pickle=False) as z:
+            row_urls = z["row_urls"].tolist()
+            square = "col_urls" not in z.files
+            col_urls = row_urls if square else z["col_urls"].tolist()
+            indptr = z["indptr"]
+            dst = z["indices"]
+            score = z["data"].astype(np.float32)
+        src = np.repeat(np.arange(len(row_urls), dtype=np.int32), np.diff(indptr))
+    return {"row_urls": row_urls, "col_urls": col_urls, "square": square,
+            "src": src, "dst": dst, "score": score}
+
+
+def graph_pair_blocks(graph, threshold=None, block_size=1_000_000):
+    """Pary z wczytanego grafu jako bloki (i, j, score) — ten sam format co iter_similar_pairs."""
+    src, dst, score = graph["src"], graph["dst"], graph["score"]
+    for start in range(0, len(src), block_size):
+        ii, jj, ss = src[start:start + block_size], dst[start:start + block_size], score[start:start + block_size]
+        if threshold is not None:
+            keep = ss >= threshold
+            ii, jj, ss = ii[keep], jj[keep], ss[keep]
+        if len(ii):
+            yield ii, jj, ss
+
+# =========================================================
+# SNAPSHOTY AUDYTÓW  (Site Focus: wektory po URL-u + centroid jako suma bieżąca)
+# =========================================================
+# Układ na dysku:  .seo_data/site_focus/<projekt>/
+#   vectors.npz              — magazyn wektorów {url: embedding}, wspólny dla snapshotów
+#   snapshot_<czas>.npz      — urls, radii, status, vec_sum, n, ts (wektory tylko przez URL)
+def _project_dir(project):
+    safe = re.sub(r"[^\w.-]+", "_", project.strip()) or "default"
+    return os.path.join(DATA_DIR, "site_focus", safe)
+
+
+def load_vector_store(project):
+    path = os.path.join(_project_dir(project), "vectors.npz")
+    if not os.path.exists(path):
+        return {}
+    with np.load(path, allow_pickle=False) as z:
+        return dict(zip(z["urls"].tolist(), z["vecs"]))
+
+
+def save_vector_store(project, store):
+    d = _project_dir(project)
+    os.makedirs(d, exist_ok=True)
+    urls = list(store)
+    vecs = np.stack([store[u] for u in urls]).astype(np.float32) if urls else np.zeros((0, 0), np.float32)
+    tmp = os.path.join(d, "vectors.tmp.npz")
+    np.savez(tmp, urls=np.array(urls, dtype=str), vecs=vecs)
+    os.replace(tmp, os.path.join(d, "vectors.npz"))
+
+
+def latest_snapshot(project):
+    d = _project_dir(project)
+    if not os.path.isdir(d):
+        return None
+    snaps = sorted(f for f in os.listdir(d) if f.startswith("snapshot_") and f.endswith(".npz"))
+    if not snaps:
+        return None
+    with np.load(os.path.join(d, snaps[-1]), allow_pickle=False) as z:
+        return {
+            "urls": z["urls"].tolist(),
+            "radii": z["radii"],
+            "status": z["status"].tolist(),
+            "vec_sum": z["vec_sum"],
+            "n": int(z["n"]),
+            "ts": str(z["ts"]),
+        }
+
+
+def save_snapshot(project, urls, radii, status, vec_sum, n):
+    """Zapis pod wolną nazwą: dwa audyty w tej samej sekundzie dostają sufiks _02, _03…
+    (sortuje się po nazwie bez sufiksu). Plik powstaje obok i jest podpinany os.link —
+    atomowo i tylko, gdy nazwa jest wolna, więc nikt nie czyta ani nie nadpisuje połowy."""
+    d = _project_dir(project)
+    os.makedirs(d, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    tmp = os.path.join(d, f".snapshot_{uuid.uuid4().hex}.tmp.npz")
+    try:
+        for k in range(1, 100):
+            ts = stamp if k == 1 else f"{stamp}_{k:02d}"
+            np.savez(
+                tmp,
+                urls=np.array(urls, dtype=str), radii=np.asarray(radii, dtype=np.float32),
+                status=np.array(status, dtype=str), vec_sum=np.asarray(vec_sum, dtype=np.float64),
+                n=np.int64(n), ts=np.array(ts),
+            )
+            try:
+                os.link(tmp, os.path.join(d, f"snapshot_{ts}.npz"))
+                return ts
+            except FileExistsError:
+                continue
+        raise RuntimeError(f"Brak wolnej nazwy snapshotu dla {stamp}.")
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
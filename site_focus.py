@@ -4,23 +4,30 @@ site_focus.py — Audyt spójności tematycznej (Site Focus & Site Radius)
 Zmiany względem wersji poprzedniej:
 - analizuje PEŁNĄ treść główną strony (trafilatura), a nie tylko Title+H1+Desc
   → centroid i radius są dużo bardziej wiarygodne;
-- scraping równoległy + cache, batchowane embeddingi z cache (taniej i szybciej);
-- wyniki trzymane w session_state (pobranie CSV nie kasuje raportu).
+- scraping i embeddingi w jednym potoku (batche ruszają, zanim skończy się scraping),
+  cache scrapingu i embeddingów (taniej i szybciej);
+- wyniki trzymane w session_state (pobranie CSV nie kasuje raportu);
+- audyty zapisywane jako snapshoty projektu (.seo_data/site_focus/) — kolejny audyt
+  pobiera i embeduje tylko NOWE strony, centroid aktualizowany jako suma bieżąca,
+  a widok zmian pokazuje strony, które przeszły między CORE/SUPPORT/OFF-TOPIC.
 
 Uruchom:  streamlit run site_focus.py
+Bez UI:   python seo_cli.py site-focus urls.txt -o radius.csv --project <nazwa>
 """
 
 import numpy as np
-import pandas as pd
 import plotly.express as px
 import streamlit as st
-from sklearn.metrics.pairwise import cosine_similarity
 
-from seo_utils import require_login, get_client, scrape_texts, embed_texts
+from seo_utils import (require_login, get_client, telemetry_sidebar, LiveTable, result_file_uploader,
+                       filter_table, table_download)
+from seo_pipelines import site_focus_audit, sf_provisional_rows, sf_status
+from jobs import submit_job
 
 st.set_page_config(page_title="Site Focus & Radius", page_icon="🎯", layout="wide")
 require_login("Site Focus")
-client = get_client()
+client = get_client("Site Focus")
+telemetry_sidebar()
 
 st.title("🎯 Audyt spójności tematycznej — Site Focus & Radius")
 st.markdown("""
@@ -40,51 +47,82 @@ urls_raw = st.text_area(
     key="sf_urls",
 )
 
-if st.button("🚀 Oblicz Topical Authority", type="primary"):
-    urls = [u.strip() for u in urls_raw.splitlines() if u.strip()]
+c_proj, c_full = st.columns([2, 1])
+project = c_proj.text_input(
+    "Projekt (nazwa audytu, opcjonalnie):",
+    key="sf_project",
+    placeholder="np. domena.pl",
+    help="Pod tą nazwą zapisujemy snapshoty. Kolejny audyt tego projektu liczy embeddingi "
+         "tylko dla nowych stron i pokazuje, co zmieniło status od ostatniego razu.",
+)
+full_refresh = c_full.checkbox(
+    "Przelicz wszystko od nowa",
+    key="sf_full",
+    help="Ignoruje zapisane wektory — pobiera i embeduje ponownie każdą stronę (np. po zmianie treści).",
+)
+
+
+c_run, c_bg = st.columns(2)
+run_now = c_run.button("🚀 Oblicz Topical Authority", type="primary")
+if c_bg.button("⏳ W tle (kolejka zadań)", key="sf_bg",
+               help="Liczy proces roboczy — można zamknąć kartę, raport czeka na stronie Kolejka zadań."):
+    urls_bg = list(dict.fromkeys(u.strip() for u in urls_raw.splitlines() if u.strip()))
+    if len(urls_bg) < 3:
+        st.warning("Podaj przynajmniej 3 adresy URL, aby wyznaczyć sensowny środek tematyczny.")
+    else:
+        job_id = submit_job("site-focus", ["urls.txt", "--project", project.strip(), "--out-sep", ";"]
+                            + (["--full"] if full_refresh else []),
+                            files={"urls.txt": "\n".join(urls_bg)}, user=st.session_state.get("username"),
+                            title=f"Site Focus: {project.strip() or f'{len(urls_bg)} URL-i'}")
+        st.success(f"Zadanie {job_id} w kolejce — postęp i raport na stronie „Kolejka zadań”.")
+
+if run_now:
+    urls = list(dict.fromkeys(u.strip() for u in urls_raw.splitlines() if u.strip()))
     if len(urls) < 3:
         st.warning("Podaj przynajmniej 3 adresy URL, aby wyznaczyć sensowny środek tematyczny.")
         st.stop()
 
-    pb = st.progress(0.0, text="Pobieranie treści...")
-    pairs = scrape_texts(urls, progress=lambda p: pb.progress(p, text="Pobieranie treści głównej..."))
-    valid = [(u, t) for u, t in pairs if t]
-
-    if len(valid) < 3:
+    # rdzeń audytu (snapshoty, centroid jako suma bieżąca, diff) wspólny z seo_cli.py
+    pb = st.progress(0.0, text="Pobieranie treści głównej i embeddingi...")
+    # podgląd na żywo: radius liczony od centroidu stron, które już mają wektor
+    # (środek się przesuwa, więc tabela jest przeliczana, a nie dopisywana)
+    live, seen = LiveTable("sf_live", "site_radius.csv", sep=";"), {}
+
+    def on_vectors(got):
+        seen.update(got)
+        live.update(f"{len(seen)}/{len(urls)} stron — radius wstępny, względem dotychczasowego centroidu",
+                    rows=lambda: sf_provisional_rows(seen))
+
+    try:
+        st.session_state["sf_result"] = site_focus_audit(
+            client, urls, project=project, full_refresh=full_refresh,
+            report=lambda text, frac: pb.progress(frac, text=text), on_vectors=on_vectors,
+        )
+    except ValueError as e:
         pb.empty()
-        st.error(f"Pobrano poprawnie tylko {len(valid)} stron (min. 3). Sprawdź URL-e.")
+        st.error(str(e))
         st.stop()
-
-    urls_v = [u for u, _ in valid]
-    texts = [t for _, t in valid]
-
-    pb.progress(0.0, text="Liczenie embeddingów...")
-    mat = embed_texts(client, texts, progress=lambda p: pb.progress(p, text="Liczenie embeddingów..."))
+    # przy błędzie / „Zatrzymaj” stan zostaje → po rerunie partial_download poniżej
+    live.clear()
     pb.empty()
 
-    centroid = mat.mean(axis=0, keepdims=True)
-    radii = 1.0 - cosine_similarity(mat, centroid).flatten()
-
-    df = pd.DataFrame({"url": urls_v, "SiteRadius": radii})
-
-    def status(r):
-        if r < 0.25:
-            return "🟢 CORE"
-        if r < 0.55:
-            return "🟡 SUPPORT"
-        return "🔴 OFF-TOPIC"
-
-    df["Status"] = df["SiteRadius"].apply(status)
-    df = df.sort_values("SiteRadius").reset_index(drop=True)
-
-    avg = float(df["SiteRadius"].mean())
-    st.session_state["sf_result"] = {
-        "df": df,
-        "avg": avg,
-        "focus": 1.0 / (1.0 + avg),
-        "n_ok": len(valid),
-        "n_in": len(urls),
-    }
+LiveTable.partial_download("sf_live")
+
+with st.expander("📂 Wczytaj zapisany raport (.csv / .parquet)"):
+    st.caption("Raport z wcześniejszego audytu (z aplikacji, CLI albo kolejki zadań) — "
+               "do przejrzenia i filtrowania bez ponownego liczenia.")
+    loaded = result_file_uploader("sf_load")
+    if loaded is not None:
+        if not {"url", "SiteRadius"} <= set(loaded.columns):
+            st.error("Plik musi mieć kolumny 'url' i 'SiteRadius'.")
+        else:
+            loaded = loaded.sort_values("SiteRadius").reset_index(drop=True)
+            loaded["Status"] = loaded["SiteRadius"].apply(sf_status)
+            avg = float(loaded["SiteRadius"].mean())
+            st.session_state["sf_result"] = {
+                "df": loaded, "avg": avg, "focus": 1.0 / (1.0 + avg), "n_ok": len(loaded),
+                "n_in": len(loaded), "n_new": 0, "n_reused": 0, "snapshot": None, "diff": None,
+            }
 
 # ---------------- RENDER (poza blokiem przycisku → przeżywa rerun) ----------------
 if "sf_result" in st.session_state:
@@ -92,6 +130,12 @@ if "sf_result" in st.session_state:
     df = r["df"]
 
     st.success(f"✅ Analiza zakończona ({r['n_ok']}/{r['n_in']} stron pobranych poprawnie).")
+    if r.get("embed_errors"):
+        st.warning(f"Błąd API embeddingów dla {len(r['embed_errors'])} URL-i: "
+                   f"{next(iter(r['embed_errors'].values()))}")
+    if r.get("snapshot"):
+        st.caption(f"💾 Snapshot {r['snapshot']} — nowo pobrane: {r['n_new']}, "
+                   f"wektory z poprzedniego audytu: {r['n_reused']}.")
 
     m1, m2, m3 = st.columns(3)
     m1.metric("Liczba stron", r["n_ok"])
@@ -99,6 +143,21 @@ if "sf_result" in st.session_state:
     m3.metric("Średni Radius", f"{r['avg']:.4f}", help="Niżej = lepsze skupienie")
 
     st.divider()
+    diff = r.get("diff")
+    if diff is not None:
+        with st.expander(f"🔀 Zmiany od snapshotu {diff['ts']} ({len(diff['df'])})", expanded=len(diff["df"]) > 0):
+            if len(diff["df"]):
+                st.dataframe(
+                    diff["df"], use_container_width=True,
+                    column_config={
+                        "url": st.column_config.LinkColumn(),
+                        "Radius przed": st.column_config.NumberColumn(format="%.4f"),
+                        "Radius teraz": st.column_config.NumberColumn(format="%.4f"),
+                    },
+                )
+            else:
+                st.write("Żadna strona nie zmieniła statusu.")
+
     st.subheader("Mapa spójności")
 
     plot_df = df.copy()
@@ -117,17 +176,15 @@ if "sf_result" in st.session_state:
     st.plotly_chart(fig, use_container_width=True)
 
     st.subheader("Szczegóły")
+    statuses = st.multiselect("Status", sorted(df["Status"].unique()), key="sf_status_filter",
+                              placeholder="wszystkie")
+    view = filter_table(df[df["Status"].isin(statuses)] if statuses else df, "sf")
     st.dataframe(
-        df[["Status", "SiteRadius", "url"]],
+        view[["Status", "SiteRadius", "url"]],
         use_container_width=True,
         column_config={
             "SiteRadius": st.column_config.NumberColumn(format="%.4f"),
             "url": st.column_config.LinkColumn(),
         },
     )
-    st.download_button(
-        "📥 Pobierz raport (CSV)",
-        df.to_csv(sep=";", index=False).encode("utf-8"),
-        "raport_topical_authority.csv",
-        "text/csv",
-    )
+    table_download(view, "raport_topical_authority.csv", key="sf_dl")
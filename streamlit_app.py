@@ -1,12 +1,20 @@
 import streamlit as st
+import html
 import json
+import os
 import bcrypt
 import pandas as pd
-import time
 from openai import OpenAI
 import re
 from docx import Document
 
+from seo_utils import (LiveTable, output_path, table_download, result_browser, job_fingerprint,
+                       load_checkpoint, clear_checkpoint, chat_json_resp, llm_cache_sidebar, metered_client,
+                       telemetry_sidebar)
+from jobs import submit_job
+from seo_pipelines import (macerate_csv, generate_meta_descriptions, meta_prompts,
+                           META_MIN_LEN, META_MAX_LEN, META_SYSTEM_PROMPT, META_USER_PROMPT)
+
 # ==========================================
 # KONFIGURACJA I STAŁE
 # ==========================================
@@ -14,6 +22,7 @@ st.set_page_config(page_title="SEO Macerator & Semantic Tool", layout="wide")
 
 USER_DATA_PATH = 'users.json'
 AVAILABLE_MODELS = ["gpt-5.4-mini","gpt-4o-mini", "gpt-5-mini", "gpt-5-nano"]
+MACERATOR_PREVIEW_ROWS = 1000   # podgląd wyniku; całość tylko w pliku do pobrania
 
 # --- DOMYŚLNY SZABLON HTML (Można go edytować w aplikacji) ---
 DEFAULT_HTML_TEMPLATE = """<!DOCTYPE html>
@@ -145,69 +154,36 @@ def get_csv_template():
     df = pd.DataFrame({'input': ['przykładowa fraza', 'https://example.com']})
     return df
 
-def escape_braces(s):
-    """Zamienia { na {{ i } na }} w stringu, by uniknąć KeyError przy .format()"""
-    return str(s).replace('{', '{{').replace('}', '}}')
-
-def process_rows_in_batches(df, batch_size, system_prompt, user_prompt, model, client):
-    results = []
-    
-    # Tworzymy pasek postępu
+def process_rows_in_batches(src, out_path, batch_size, system_prompt, user_prompt, model, client,
+                            max_workers=8, rpm=500, tpm=200_000, checkpoint=None, use_cache=True):
+    """Macerator (seo_pipelines.macerate_csv) z paskiem postępu: CSV czytany po kawałku,
+    wyniki dopisywane do out_path w kolejności wejścia — w pamięci tylko bieżąca część pliku.
+    batch_size=None → rozmiar batcha dobiera BatchSizer.
+    checkpoint=klucz → wiersze już zapisane w pliku zadania nie są wysyłane ponownie."""
     progress_bar = st.progress(0, text="Przetwarzanie...")
-    total_rows = len(df)
-    
-    for i in range(0, len(df), batch_size):
-        batch = df.iloc[i:i+batch_size]
-        # Escapowanie klamer w każdej frazie!
-        keywords = [escape_braces(x) for x in batch['input'].tolist()]
-        prompt_filled = user_prompt.format(input="\n".join(keywords))
-        
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt_filled},
-                ],
-            )
-            content = response.choices[0].message.content.strip()
-            
-            # Sprawdź czy odpowiedź nie jest pusta
-            if not content:
-                for _ in keywords:
-                    results.append("Błąd: Pusta odpowiedź AI")
-                continue
-                
-            try:
-                # Próba parsowania JSON
-                batch_result = json.loads(content)
-                # batch_result powinien być dict: {fraza: kategoria}
-                if isinstance(batch_result, dict):
-                    for keyword in keywords:
-                        # Odkręcamy escape braces dla klucza słownika przy wyszukiwaniu
-                        raw_key = keyword.replace('{{', '{').replace('}}', '}')
-                        val = batch_result.get(raw_key) or batch_result.get(keyword, "BRAK ODPOWIEDZI")
-                        results.append(val)
-                else:
-                    # Jeśli model zwrócił coś innego niż dict (np. listę), fallback
-                    results.extend([str(content)] * len(keywords))
-                    
-            except json.JSONDecodeError:
-                # Odpowiedź nie jest poprawnym JSON-em - zapisujemy błąd dla całego batcha
-                for _ in keywords:
-                    results.append(f"Błąd JSON: {content[:100]}...")
-                    
-        except Exception as e:
-            for _ in keywords:
-                results.append(f"Błąd API: {e}")
-        
-        # Aktualizacja paska postępu
-        current_progress = min((i + batch_size) / total_rows, 1.0)
-        progress_bar.progress(current_progress, text=f"Przetworzono {min(i + batch_size, total_rows)} z {total_rows} wierszy")
-        time.sleep(0.5)  # By nie przekroczyć limitów API
-        
+    # podgląd z końca pliku wynikowego (.part w trakcie); częściowy wynik po „Zatrzymaj”
+    live = LiveTable("mac_live", "wyniki_generator.csv", path=out_path, every=10.0)
+
+    def report(text, frac):
+        progress_bar.progress(min(frac, 1.0), text=text)
+        live.update(text)
+
+    stats = macerate_csv(
+        src, out_path, system_prompt, user_prompt, model, client, batch_size,
+        max_workers=max_workers, rpm=rpm, tpm=tpm, checkpoint=checkpoint, use_cache=use_cache,
+        report=report,
+    )
     progress_bar.empty()
-    return results
+    live.clear()
+    if stats["resumed"]:
+        st.info(f"♻️ Wznowiono zadanie: {stats['resumed']} z {stats['rows']} wierszy "
+                "wzięte z zapisanego postępu (bez ponownego płacenia za nie).")
+    if stats["batch_size"]:
+        st.caption(f"Automatyczny rozmiar batcha ustalił się na {stats['batch_size']} wierszy.")
+    if stats["errors"]:
+        st.warning(f"⚠️ {stats['errors']} wierszy bez poprawnej odpowiedzi po ponowieniach — "
+                   "uruchom ponownie, by dociągnąć tylko je.")
+    return stats
 
 # ==========================================
 # FUNKCJE DLA ZAKŁADKI 3 (INTELIGENTNY MERGE)
@@ -240,50 +216,90 @@ def get_full_text_from_docx(docx_file):
         
     return "\n".join(full_text)
 
-def generate_smart_html(html_template, content_text, date_str, client, model="gpt-4o"):
-    """
-    Wysyła szablon HTML i treść Worda do AI z poleceniem ich połączenia.
-    """
-    system_prompt = """Jesteś ekspertem HTML i redaktorem newslettera.
-Twoim zadaniem jest wypełnienie dostarczonego szablonu HTML treścią z pliku tekstowego.
+SLOT_RE = re.compile(r"<!--\s*TU WSTAW\s+(.+?)\s*-->")
+LINK_STYLE = "color: #33D76F; font-weight: bold; text-decoration: none;"
+
+SMART_HTML_SYSTEM = """Jesteś redaktorem newslettera. Dostajesz treść z Worda i listę sekcji newslettera.
+Rozdziel treść na newsy i przypisz każdy do jednej sekcji. NIE piszesz HTML — szablon wypełnia kod.
 
 ZASADY:
-1. Przeanalizuj 'Treść Newslettera' i zidentyfikuj sekcje (Breaking News, Informacje Ogólne, Projekty, Przetargi).
-2. Wstaw odpowiednie fragmenty tekstu w odpowiednie miejsca w 'Szablonie HTML' (np. w miejsce komentarzy <!-- TU WSTAW... -->).
-3. Podmień [DATA] w nagłówku na podaną datę.
-4. FORMATOWANIE TREŚCI (BARDZO WAŻNE):
-   - Każdy news wstaw jako element `<li>...</li>`.
-   - Zachowaj istniejącą strukturę `<ul>` z szablonu.
-   - POGRUB (używając tagu `<b>`) wszystkie: Imiona i nazwiska, Marki (np. Media Markt), Firmy, Narzędzia, Kluczowe daty.
-   - Linki w formacie `[tekst](url)` zamień na `<a href="url" style="color: #33D76F; font-weight: bold; text-decoration: none;">tekst</a>`.
-5. Zwróć TYLKO kompletny kod HTML. Nie usuwaj stylów CSS.
-"""
+1. Każdy news = jeden element listy "items" danej sekcji, w kolejności z treści. Nie skracaj i nie dopisuj treści.
+2. News składa się z fragmentów ("spans") sklejanych jeden za drugim:
+   - {"t": "tekst"} — zwykły tekst,
+   - {"t": "tekst", "b": true} — POGRUBIENIE: imiona i nazwiska, marki (np. Media Markt), firmy, narzędzia, kluczowe daty,
+   - {"t": "tekst", "href": "url"} — link; w treści linki mają postać [tekst](url).
+   Spacje między fragmentami wpisuj w "t" (np. "Zespół ", potem pogrubione "Media Markt", potem " wygrał...").
+3. Sekcja bez newsów → pusta lista. Używaj DOKŁADNIE podanych kluczy sekcji.
+
+Zwróć JSON: {"sections": {"<klucz sekcji>": {"items": [{"spans": [...]}, ...]}, ...}}"""
+
+
+def template_slots(html_template):
+    """[(klucz, nagłówek sekcji)] dla każdego <!-- TU WSTAW ... --> w szablonie.
+    Nagłówek = ostatni <b>…</b> przed komentarzem (np. „📢 Breaking News:”) — kontekst dla modelu."""
+    slots = []
+    for m in SLOT_RE.finditer(html_template):
+        heads = re.findall(r"<b(?:\s[^>]*)?>(.*?)</b>", html_template[:m.start()], flags=re.S)
+        slots.append((m.group(1), re.sub(r"<[^>]+>", "", heads[-1]).strip() if heads else ""))
+    return slots
+
+
+def render_news_item(spans):
+    """Fragmenty newsa → zawartość <li>: tekst escapowany, <b> dla pogrubień, <a> tylko dla http(s)/mailto."""
+    out = []
+    for sp in spans if isinstance(spans, list) else []:
+        if not isinstance(sp, dict):
+            continue
+        text = html.escape(str(sp.get("t") or ""))
+        href = str(sp.get("href") or "").strip()
+        if href.lower().startswith(("http://", "https://", "mailto:")):
+            text = f'<a href="{html.escape(href, quote=True)}" style="{LINK_STYLE}">{text or html.escape(href)}</a>'
+        elif sp.get("b") and text.strip():
+            text = f"<b>{text}</b>"
+        out.append(text)
+    return "".join(out).strip()
+
+
+def fill_html_slots(html_template, sections, date_str):
+    """Wstawia <li> sekcji w miejsca <!-- TU WSTAW ... --> (z wcięciem komentarza) i podmienia [DATA].
+    Szablon poza slotami zostaje bajt w bajt — style CSS nie przechodzą przez model."""
+    def fill(m):
+        items = (sections.get(m.group(1)) or {}).get("items") or []
+        lis = [f"<li>{body}</li>" for body in (render_news_item(it.get("spans")) for it in items
+                                               if isinstance(it, dict)) if body]
+        if not lis:
+            return ""
+        indent = re.search(r"[ \t]*$", html_template[:m.start()]).group(0)
+        return ("\n" + indent).join(lis)
+
+    return SLOT_RE.sub(fill, html_template).replace("[DATA]", html.escape(date_str))
 
-    user_message = f"""
---- DATA WYDANIA: {date_str} ---
 
---- SZABLON HTML: ---
-{html_template}
+def generate_smart_html(html_template, content_text, date_str, client, model="gpt-4o"):
+    """
+    Newsletter: model dostaje tylko treść Worda i listę sekcji szablonu, a zwraca JSON
+    z newsami (fragmenty z pogrubieniami i linkami). HTML składa kod (fill_html_slots) —
+    wyjście modelu to sama treść, nie kopia szablonu ze stylami.
+    """
+    slots = template_slots(html_template)
+    if not slots:
+        return "<h3>Szablon nie ma miejsc na treść</h3><p>Dodaj komentarze &lt;!-- TU WSTAW NAZWA SEKCJI --&gt;.</p>"
+
+    section_list = "\n".join(f'- "{key}"' + (f" (nagłówek w szablonie: {head})" if head else "")
+                              for key, head in slots)
+    user_message = f"""SEKCJE (klucze):
+{section_list}
 
 --- TREŚĆ Z WORDA: ---
 {content_text}
 """
 
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.1
-        )
-        content = response.choices[0].message.content.strip()
-        # Usunięcie znaczników markdown
-        content = content.replace("```html", "").replace("```", "").strip()
-        return content
+        resp = chat_json_resp(client, model, SMART_HTML_SYSTEM, user_message, temperature=0.1)
+        sections = json.loads(resp["content"]).get("sections") or {}
+        return fill_html_slots(html_template, sections if isinstance(sections, dict) else {}, date_str)
     except Exception as e:
-        return f"<h3>Wystąpił błąd AI:</h3><p>{e}</p>"
+        return f"<h3>Wystąpił błąd AI:</h3><p>{html.escape(str(e))}</p>"
 
 
 
@@ -309,6 +325,8 @@ def main():
     st.sidebar.title(f"👤 {st.session_state['username']}")
     if st.sidebar.button("Wyloguj"):
         logout()
+    use_llm_cache = llm_cache_sidebar()
+    telemetry_sidebar()
     
     st.title("🛠️ SEO Narzędzia")
     
@@ -601,7 +619,9 @@ Zwróć wynik jako JSON w formacie:
         # Wczytanie DataFrame
         df = None
         if uploaded_file is not None:
-            df = pd.read_csv(uploaded_file, encoding="utf-8")
+            # tylko nagłówek i kilka wierszy — całość czyta Macerator kawałkami
+            df = pd.read_csv(uploaded_file, encoding="utf-8", nrows=5)
+            uploaded_file.seek(0)
             st.write("Nagłówki pliku CSV:", df.columns.tolist())
             if 'input' not in df.columns:
                 st.error("Plik CSV musi zawierać kolumnę o nazwie 'input'.")
@@ -621,39 +641,92 @@ Zwróć wynik jako JSON w formacie:
             height=150
         )
         model = st.selectbox("Wybierz model AI", AVAILABLE_MODELS)
+        auto_batch = st.checkbox(
+            "Automatyczny rozmiar batcha",
+            value=True,
+            key="mac_auto_batch",
+            help="Rozmiar dobierany z szacunku tokenów wejścia i odpowiedzi: maleje po uciętej lub "
+                 "zepsutej odpowiedzi, rośnie, dopóki odpowiedzi są czyste."
+        )
         batch_size = st.number_input(
             "Ile wierszy przetwarzać jednocześnie?",
             min_value=1,
             max_value=50,
             value=5,
+            disabled=auto_batch,
             help="Im większa liczba, tym szybciej przetworzysz plik, ale dokładność odpowiedzi AI może być niższa."
         )
+        with st.expander("⚙️ Współbieżność i limity API"):
+            col_w, col_rpm, col_tpm = st.columns(3)
+            max_workers = col_w.number_input("Równoległe zapytania", min_value=1, max_value=32, value=8)
+            rpm = col_rpm.number_input("Limit zapytań / min (RPM)", min_value=1, value=500, step=50)
+            tpm = col_tpm.number_input("Limit tokenów / min (TPM)", min_value=1000, value=200_000, step=10_000)
+            st.caption("Ustaw nieco poniżej limitów swojego klucza. Po błędzie 429 tempo automatycznie spada "
+                       "i wraca, gdy odpowiedzi znów przechodzą.")
+        fresh_start = st.checkbox(
+            "Zacznij od nowa (ignoruj zapisany postęp dla tego pliku)",
+            key="mac_fresh",
+            help="Postęp zapisuje się po każdym batchu. Ten sam plik z tymi samymi promptami i modelem "
+                 "wznawia się od pierwszego nieukończonego wiersza."
+        )
 
-        if st.button("🚀 Maceruję!") and df is not None:
+        col_run, col_bg = st.columns(2)
+        run_now = col_run.button("🚀 Maceruję!")
+        run_bg = col_bg.button("⏳ W tle (kolejka zadań)", key="mac_bg",
+                               help="Liczy proces roboczy — można zamknąć kartę, wynik czeka na stronie Kolejka zadań.")
+        if run_bg and df is not None:
+            if not system_prompt or not user_prompt:
+                st.error("Uzupełnij oba prompty.")
+            else:
+                job_id = submit_job(
+                    "macerator",
+                    ["input.csv", "--system", "system.txt", "--user", "user.txt", "--model", model,
+                     "--workers", max_workers, "--rpm", rpm, "--tpm", tpm]
+                    + ([] if auto_batch else ["--batch-size", batch_size])
+                    + (["--fresh"] if fresh_start else []) + ([] if use_llm_cache else ["--no-cache"]),
+                    files={"input.csv": uploaded_file.getvalue(), "system.txt": system_prompt, "user.txt": user_prompt},
+                    user=st.session_state['username'], title=f"Macerator: {uploaded_file.name}",
+                )
+                st.success(f"Zadanie {job_id} w kolejce — postęp i wynik na stronie „Kolejka zadań”.")
+
+        if run_now and df is not None:
             if not system_prompt or not user_prompt:
                 st.error("Uzupełnij oba prompty.")
             else:
                 try:
                     # Pobieranie klucza z secrets
                     api_key = st.secrets["OPENAI_API_KEY"]
-                    client = OpenAI(api_key=api_key)
+                    client = metered_client(OpenAI(api_key=api_key), "Macerator")
                     
+                    # klucz zadania: plik + prompty + model → ten sam zestaw wznawia się po crashu
+                    job_key = job_fingerprint("macerator", uploaded_file, system_prompt, user_prompt, model)
+                    if fresh_start:
+                        clear_checkpoint(job_key)
+                    out_path = output_path(f"macerator_{job_key}.csv")
+
                     st.info("Przetwarzanie... To może chwilę potrwać.")
-                    results = process_rows_in_batches(df, batch_size, system_prompt, user_prompt, model, client)
-                    df['wynik'] = results
-                    
-                    st.success("Gotowe! Oto wyniki:")
-                    st.write(df)
-                    st.download_button(
-                        label="Pobierz wyniki jako CSV",
-                        data=df.to_csv(index=False, encoding="utf-8-sig").encode('utf-8-sig'),
-                        file_name="wyniki_generator.csv",
-                        mime="text/csv"
-                    )
+                    stats = process_rows_in_batches(uploaded_file, out_path, None if auto_batch else batch_size,
+                                                    system_prompt, user_prompt, model, client,
+                                                    max_workers=max_workers, rpm=rpm, tpm=tpm,
+                                                    checkpoint=job_key, use_cache=use_llm_cache)
+
+                    # wynik zostaje w pliku — render poniżej przeżywa rerun (np. przygotowanie Parquet)
+                    st.session_state["mac_out"] = (out_path, stats["rows"])
                 except Exception as e:
                     st.error(f"Wystąpił błąd: {e}")
                     st.warning("Upewnij się, że masz ustawiony klucz OPENAI_API_KEY w secrets.")
 
+        LiveTable.partial_download("mac_live")
+        mac_out = st.session_state.get("mac_out")
+        if mac_out and os.path.exists(mac_out[0]):
+            out_path, n_rows = mac_out
+            st.success(f"Gotowe! {n_rows} wierszy — poniżej pierwsze {MACERATOR_PREVIEW_ROWS}:")
+            st.write(pd.read_csv(out_path, nrows=MACERATOR_PREVIEW_ROWS, encoding="utf-8-sig"))
+            table_download(out_path, "wyniki_generator.csv", key="mac_dl", sep=",")
+
+        with st.expander("📂 Przeglądaj zapisany wynik (.csv / .parquet)"):
+            result_browser("mac_prev", "wyniki_generator.csv", sep=",")
+
 # ==========================================
     # ZAKŁADKA 2: GENERATOR META DESCRIPTION
     # ==========================================
@@ -732,35 +805,17 @@ Zwróć wynik jako JSON w formacie:
             st.markdown("---")
             st.subheader("2. Konfiguracja Promptu")
 
-            # --- DOMYŚLNE PROMPTY DLA META ---
-            default_meta_system = """Jesteś ekspertem SEO i Copywriterem. Twoim celem jest zwiększenie CTR (Click Through Rate) z wyników wyszukiwania Google.
-Zasady pisania:
-1. Długość: od 130 do 155 znaków (to krytyczne, nie przekraczaj tego).
-2. Zawrzyj słowa kluczowe z Title i H1, ale w naturalny sposób.
-3. Język korzyści (benefit-oriented).
-4. Zakończ Call to Action (np. Sprawdź!, Zobacz ofertę, Wejdź).
-5. Nie używaj cudzysłowów na początku i końcu odpowiedzi.
-6. Pisz w języku Polskim."""
-
-            default_meta_user = """Stwórz Meta Description dla podstrony.
-Dane:
-- URL: {url}
-- Meta Title: {title}
-- Nagłówek H1: {h1}
-
-Meta Description:"""
-
             # --- EDYTOWALNE POLA TEKSTOWE ---
             system_prompt_meta = st.text_area(
                 "System Prompt (Rola AI i zasady)", 
-                value=default_meta_system, 
+                value=META_SYSTEM_PROMPT, 
                 height=200,
                 key="meta_sys_prompt"
             )
             
             user_prompt_meta = st.text_area(
                 "User Prompt (Szablon zapytania)", 
-                value=default_meta_user, 
+                value=META_USER_PROMPT, 
                 height=200, 
                 help="Użyj {title}, {h1} oraz {url} jako zmiennych, które zostaną podmienione danymi z pliku.",
                 key="meta_usr_prompt"
@@ -768,72 +823,109 @@ Meta Description:"""
 
             # Wybór modelu (korzystamy z listy zdefiniowanej na początku skryptu)
             model_meta = st.selectbox("Wybierz model AI", AVAILABLE_MODELS, key="meta_model")
+            with st.expander("⚙️ Batche, współbieżność i poprawki długości"):
+                col_b1, col_b2, col_b3 = st.columns(3)
+                meta_auto_batch = col_b1.checkbox("Automatyczny rozmiar batcha", value=True, key="meta_auto_batch")
+                meta_batch_size = col_b2.number_input("Wierszy w batchu", min_value=1, max_value=50, value=10,
+                                                      disabled=meta_auto_batch, key="meta_batch_size")
+                meta_repairs = col_b3.number_input(
+                    "Rundy poprawek długości", min_value=0, max_value=5, value=2, key="meta_repairs",
+                    help=f"Opisy spoza {META_MIN_LEN}–{META_MAX_LEN} znaków idą ponownie (tylko one)."
+                )
+                col_w, col_rpm, col_tpm = st.columns(3)
+                meta_workers = col_w.number_input("Równoległe zapytania", min_value=1, max_value=32, value=8,
+                                                  key="meta_workers")
+                meta_rpm = col_rpm.number_input("Limit zapytań / min (RPM)", min_value=1, value=500, step=50,
+                                                key="meta_rpm")
+                meta_tpm = col_tpm.number_input("Limit tokenów / min (TPM)", min_value=1000, value=200_000,
+                                                step=10_000, key="meta_tpm")
+            fresh_meta = st.checkbox("Zacznij od nowa (ignoruj zapisany postęp dla tego pliku)", key="meta_fresh")
+
+            if st.button("⏳ W tle (kolejka zadań)", key="meta_bg"):
+                job_id = submit_job(
+                    "meta",
+                    ["input.csv", "--sep", sep_char, "--url-col", url_col, "--title-col", title_col,
+                     "--h1-col", h1_col, "--system", "system.txt", "--user", "user.txt", "--model", model_meta,
+                     "--repairs", meta_repairs, "--workers", meta_workers, "--rpm", meta_rpm, "--tpm", meta_tpm]
+                    + ([] if meta_auto_batch else ["--batch-size", meta_batch_size])
+                    + (["--fresh"] if fresh_meta else []) + ([] if use_llm_cache else ["--no-cache"]),
+                    files={"input.csv": uploaded_file_meta.getvalue(), "system.txt": system_prompt_meta,
+                           "user.txt": user_prompt_meta},
+                    user=st.session_state['username'], title=f"Meta Description: {uploaded_file_meta.name}",
+                )
+                st.success(f"Zadanie {job_id} w kolejce — postęp i wynik na stronie „Kolejka zadań”.")
 
             # Przycisk generowania
             if st.button("🚀 Generuj Meta Description"):
                 try:
                     api_key = st.secrets["OPENAI_API_KEY"]
-                    client = OpenAI(api_key=api_key)
+                    client = metered_client(OpenAI(api_key=api_key), "Meta Description")
                     
                     progress_bar = st.progress(0, text="Rozpoczynam generowanie...")
-                    results_meta = []
                     total_rows = len(df_meta)
-                    
-                    for index, row in df_meta.iterrows():
-                        # 1. Pobieramy dane z wiersza
-                        r_url = str(row[url_col])
-                        r_title = str(row[title_col])
-                        r_h1 = str(row[h1_col])
-                        
-                        # 2. Formatujemy prompt (podmieniamy {title}, {h1} na dane)
-                        # escape_braces nie jest tu potrzebne jeśli user nie używa JSON w prompcie, 
-                        # ale dla bezpieczeństwa można by to dodać. Tutaj proste formatowanie:
-                        try:
-                            prompt_filled = user_prompt_meta.format(
-                                url=r_url,
-                                title=r_title,
-                                h1=r_h1
-                            )
-                        except KeyError as e:
-                            st.error(f"Błąd w strukturze promptu! Użyłeś zmiennej której nie ma w kodzie: {e}")
-                            st.stop()
-
-                        # 3. Strzał do API
-                        try:
-                            response = client.chat.completions.create(
-                                model=model_meta,
-                                messages=[
-                                    {"role": "system", "content": system_prompt_meta},
-                                    {"role": "user", "content": prompt_filled},
-                                ]
-                            )
-                            content = response.choices[0].message.content.strip()
-                            results_meta.append(content)
-                        except Exception as e:
-                            results_meta.append(f"Błąd API: {e}")
-                        
-                        # Aktualizacja paska
-                        progress_bar.progress((index + 1) / total_rows, text=f"Przetworzono {index + 1} z {total_rows}")
+
+                    # checkpoint: plik + mapowanie kolumn + prompty + model
+                    job_key = job_fingerprint("meta", uploaded_file_meta.getvalue(), sep_char, url_col, title_col,
+                                              h1_col, system_prompt_meta, user_prompt_meta, model_meta)
+                    if fresh_meta:
+                        clear_checkpoint(job_key)
+                    done_meta = load_checkpoint(job_key)
+                    if done_meta:
+                        st.info(f"♻️ Wznawiam zadanie: {len(done_meta)} z {total_rows} opisów wzięte z zapisanego postępu.")
+
+                    # 1. Prompt każdego wiersza (podmieniamy {url}, {title}, {h1}) spłaszczony do jednej linii,
+                    #    bo w batchu jeden wiersz = jedna podstrona
+                    try:
+                        prompts_meta = meta_prompts(zip(df_meta[url_col], df_meta[title_col], df_meta[h1_col]),
+                                                    user_prompt_meta)
+                    except KeyError as e:
+                        st.error(f"Błąd w strukturze promptu! Użyłeś zmiennej której nie ma w kodzie: {e}")
+                        st.stop()
+                    pending_meta = [i for i in range(total_rows) if i not in done_meta]
+
+                    def meta_progress(n_ok):
+                        n = len(done_meta) + n_ok
+                        progress_bar.progress(n / total_rows,
+                                              text=f"Gotowe (w normie długości) {n} z {total_rows}")
+
+                    # 2. Batche równolegle + rundy poprawek tylko dla opisów spoza widełek
+                    generated, failed = generate_meta_descriptions(
+                        prompts_meta, system_prompt_meta, model_meta, client, pending_meta,
+                        batch_size=None if meta_auto_batch else meta_batch_size,
+                        max_workers=meta_workers, rpm=meta_rpm, tpm=meta_tpm,
+                        repair_rounds=meta_repairs, checkpoint=job_key,
+                        use_cache=use_llm_cache, progress=meta_progress,
+                    )
+                    all_meta = {**done_meta, **generated, **failed}
+                    results_meta = [all_meta[i] for i in range(total_rows)]
+                    progress_bar.empty()
+                    if failed:
+                        st.warning(f"⚠️ {len(failed)} wierszy bez odpowiedzi — uruchom ponownie, by dociągnąć tylko je.")
 
                     # Zapis wyników
                     df_meta['Generated_Meta_Description'] = results_meta
                     df_meta['Length'] = df_meta['Generated_Meta_Description'].str.len()
+                    out_of_range = (~df_meta['Length'].between(META_MIN_LEN, META_MAX_LEN)).sum()
+                    if out_of_range:
+                        st.caption(f"{out_of_range} opisów nadal poza {META_MIN_LEN}–{META_MAX_LEN} znaków "
+                                   "po rundach poprawek.")
                     
                     st.success("Zakończono!")
-                    st.dataframe(df_meta[[url_col, title_col, 'Generated_Meta_Description', 'Length']])
-                    
-                    # Pobieranie
-                    st.download_button(
-                        label="Pobierz wyniki CSV",
-                        data=df_meta.to_csv(index=False).encode('utf-8'),
-                        file_name='meta_descriptions.csv',
-                        mime='text/csv'
-                    )
+                    # wynik w sesji — render poniżej przeżywa rerun („Przygotuj CSV/Parquet”)
+                    st.session_state["meta_out"] = (df_meta, [url_col, title_col, 'Generated_Meta_Description', 'Length'])
 
                 except Exception as e:
                     st.error(f"Wystąpił błąd ogólny: {e}")
                     st.warning("Sprawdź klucz API w secrets.")
 
+            meta_out = st.session_state.get("meta_out")
+            if meta_out:
+                st.dataframe(meta_out[0][meta_out[1]])
+                table_download(meta_out[0], "meta_descriptions.csv", key="meta_dl", sep=",")
+
+        with st.expander("📂 Przeglądaj zapisany wynik (.csv / .parquet)"):
+            result_browser("meta_prev", "meta_descriptions.csv", sep=",")
+
 # ==========================================
     # ZAKŁADKA 3: INTELIGENTNY NEWSLETTER (SMART MERGE)
     # ==========================================
@@ -887,9 +979,9 @@ Meta Description:"""
                     # 2. Generowanie przez AI
                     try:
                         api_key = st.secrets["OPENAI_API_KEY"]
-                        client = OpenAI(api_key=api_key)
+                        client = metered_client(OpenAI(api_key=api_key), "Newsletter")
                         
-                        with st.spinner("AI łączy treść z szablonem i formatuje... To potrwa kilka sekund."):
+                        with st.spinner("AI rozdziela treść na sekcje, szablon wypełnia kod... To potrwa kilka sekund."):
                             # Używamy gpt-4o dla najlepszej jakości rozumienia kontekstu
                             final_html = generate_smart_html(html_template_input, content_to_process, date_str, client, model="gpt-4o")
                             